@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+#Resolve the calibrations of a stage's jobs before they run.
+#
+#Left to itself every Reduce asks the calibration database for the best
+#bias, flat, arc and standard of each input, one file at a time.  Once the
+#stages a stage depends on have finished, its inputs are grouped by the
+#descriptors the match depends on, one frame of each group is looked up,
+#all groups of a calibration type in a single query, and the answers are
+#handed to the jobs as user calibrations (ucals).  Answers are cached, so
+#frames with the same configuration on the same night never trigger a
+#second query; the cache for a calibration type is dropped whenever a
+#stage produces new calibrations of that type.
+#
+#Only calibration types whose match does not depend on the time of the
+#frame are resolved this way.  Flats and arcs are matched to the frame
+#nearest in time, which a per-night answer would override, so they are
+#always left to the calibration manager.
+#
+#A job gets a ucal only if all of its inputs resolve to the same file.
+#Otherwise, or if nothing matched, the calibration manager looks it up as
+#before.
+
+import threading
+
+import fitsheader
+from planner import MATCH
+
+
+#descriptors that decide which calibration a frame gets, for the types
+#that are resolved up front: the configuration and the night of the frame.
+#The answer for one frame is forced on every frame with the same key, so
+#the key must be at least as fine as the match of the calibration manager:
+#the readout mode for biases, the setup of the science for standards.
+ASSOCIATION = {
+    'processed_bias': MATCH['processed_bias'] + ('ut_date',),
+    'processed_standard': MATCH['processed_standard'] + (
+        'central_wavelength', 'detector_roi_setting', 'ut_date'),
+}
+
+
+class Associator:
+    """Batch calibration lookups with an in-memory cache."""
+
+    #the calibration types resolved up front
+    caltypes = tuple(ASSOCIATION)
+
+    def __init__(self, caldb, index):
+        self.caldb = caldb
+        self.index = index
+        self.queries = 0
+        self.hits = 0
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def key(self, caltype, path):
+        values = []
+        for name in ASSOCIATION[caltype]:
+            if name == 'ut_date':
+                value = self.index.descriptor(path, 'ut_datetime')
+                values.append(str(value)[:10] if value else None)
+            else:
+                value = self.index.descriptor(path, name)
+                #amp_read_area is a list, one entry per extension
+                values.append(tuple(value) if isinstance(value, list) else value)
+        return (caltype,) + tuple(values)
+
+    def _query(self, caltype, paths):
+        #one database query for a list of frames, opened from their headers
+        import astrodata
+        import gemini_instruments
+
+        ads = []
+        for path in paths:
+            ad = astrodata.open(fitsheader.header_hdulist(path))
+            ad.filename = path
+            ads.append(ad)
+        self.queries += 1
+        cals = self.caldb.get_calibrations(ads, caltype=caltype)
+        return list(cals.files)
+
+    def lookup(self, caltype, files):
+        """Calibration file of caltype for each of files (None if not found)."""
+        with self._lock:
+            keys = [self.key(caltype, f) for f in files]
+            todo = {}
+            for k, f in zip(keys, files):
+                if k in self._cache:
+                    self.hits += 1
+                elif k not in todo:
+                    todo[k] = f
+            if todo:
+                try:
+                    found = self._query(caltype, list(todo.values()))
+                except Exception as err:
+                    print(f'{caltype} lookup failed, Reduce will search itself: {err}')
+                    found = [None] * len(todo)
+                for k, cal in zip(todo, found):
+                    self._cache[k] = cal or None
+            return [self._cache[k] for k in keys]
+
+    def assign(self, stage, jobs):
+        """Set the ucals of jobs for the calibration types the stage needs
+        that do not depend on the time of the frame."""
+        for caltype in stage.needs:
+            if caltype not in ASSOCIATION:
+                #matched nearest in time by the calibration manager
+                continue
+            files = [f for job in jobs for f in job['files']]
+            cals = dict(zip(files, self.lookup(caltype, files)))
+            for job in jobs:
+                found = {cals[f] for f in job['files']}
+                if len(found) == 1 and None not in found:
+                    job.setdefault('ucals', {})[caltype] = found.pop()
+
+    def invalidate(self, caltypes):
+        """Forget the answers for calibration types that were just produced."""
+        with self._lock:
+            for k in [k for k in self._cache if k[0] in caltypes]:
+                del self._cache[k]
+
+    def summary(self):
+        return (f'calibration associations: {len(self._cache)} cached, '
+                f'{self.queries} database queries, {self.hits} cache hits')
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+#Offline benchmark of everything gem_reduce does around Reduce.
+#
+#For each night size a synthetic GMOS-S night is written to a scratch
+#directory (see synthetic.py) and the following phases are timed:
+#
+#  select_data   the original approach: every selection rescans every file
+#  index_cold    building the header index from scratch and selecting,
+#                with the bytes read and the peak memory of the scan
+#  index_warm    rerun with an unchanged index, no file is reopened
+#  manifest      fingerprinting all stages, cold and with cached checksums
+#  caldb         initializing a local calibration database (DRAGONS only)
+#  calregistry   registering the BPMs and the calibration frames through
+#                CalRegistry, first time and unchanged, with a database
+#                stub that only counts the files it is given
+#  orchestrate   scheduler, manifest and profiler with a Reduce that does
+#                nothing, in this process and on a pool of --jobs workers
+#
+#    python benchmarks/bench_gem_reduce.py --sizes 10 1000 10000
+#    python benchmarks/bench_gem_reduce.py --sizes 1000 --bias-ff 800 --bpms 6
+#
+#The --bias-ff, --bias-cs, --flats, --arcs, --standards, --science and
+#--bpms options fix the number of frames of a kind instead of taking its
+#share of the night size.
+#
+#Nothing needs network access.  Without DRAGONS the files are classified
+#by synthetic.read_synthetic; with --reader dragons astrodata is used.
+
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import synthetic
+from calregistry import CalRegistry
+from fileindex import FileIndex, read_metadata
+from manifest import Manifest
+from profiling import Profiler, measure
+from scheduler import Scheduler, Stage
+
+
+#the selections made by gem_reduce, as (tags, xtags, expression)
+SELECTIONS = [
+    (['BIAS'], [], 'True'),
+    (['BIAS'], [], 'detector_roi_setting=="Central Spectrum"'),
+    (['BIAS'], [], 'detector_roi_setting=="Full Frame"'),
+    (['FLAT'], [], 'True'),
+    (['ARC'], [], 'True'),
+    (['STANDARD'], [], 'True'),
+    ([], ['CAL'], 'True'),
+    ([], ['CAL'], 'object=="J2145+0031"'),
+    (['BPM'], [], 'True'),
+]
+
+
+def null_runner(job):
+    return []
+
+
+def null_worker(job, dbfile, workroot):
+    from profiling import measure
+    with measure(job['stage'], job['name'], job['files']) as m:
+        pass
+    return {'name': job['name'], 'stage': job['stage'], 'files': job['files'],
+            'workdir': workroot, 'log': None, 'outputs': [],
+            'calibrations': [], 'ok': True, 'error': None, 'metrics': m.record}
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def select_data_baseline(files, reader):
+    #every selection reopens every file, as dataselect.select_data does
+    nselected = 0
+    for tags, xtags, expression in SELECTIONS:
+        for path in files:
+            filetags, descriptors, nextn = reader(path)
+            if (set(tags).issubset(filetags) and not set(xtags) & set(filetags)
+                    and eval(expression, {'__builtins__': {}}, descriptors)):
+                nselected += 1
+    return nselected
+
+
+def index_selection(dbfile, files, reader):
+    index = FileIndex(dbfile)
+    nscanned = index.update(files, reader)
+    selected = [index.select(*s) for s in SELECTIONS]
+    index.close()
+    return nscanned, selected
+
+
+def stages_from(selected, per_file=True):
+    all_biases, biasstd, biassci, flats, arcs, stdstar, science, scitarget, bpms = selected
+    return [
+        Stage('biasstd', biasstd, provides=['processed_bias']),
+        Stage('biassci', biassci, provides=['processed_bias']),
+        Stage('flats', flats, needs=['processed_bias'],
+              provides=['processed_flat'], per_file=per_file),
+        Stage('arcs', arcs, needs=['processed_bias'],
+              provides=['processed_arc'], per_file=per_file),
+        Stage('std', stdstar, needs=['processed_bias', 'processed_flat', 'processed_arc'],
+              provides=['processed_standard']),
+        Stage('sci', scitarget, needs=['processed_bias', 'processed_flat',
+                                       'processed_arc', 'processed_standard']),
+    ]
+
+
+def orchestrate(stages, workdir, njobs):
+    scheduler = Scheduler(stages, None, njobs,
+                          Manifest(os.path.join(workdir, f'manifest_{njobs}.json')),
+                          force=True, profiler=Profiler())
+    scheduler.runner = null_runner
+    scheduler.worker = null_worker
+    #the stage banners would drown the results
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return scheduler.run()
+
+
+class StubDB:
+    """Stands in for the DRAGONS local database, counting add_cal calls."""
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.added = 0
+
+    def init(self):
+        open(self.dbfile, 'w').close()
+
+    def add_cal(self, path):
+        self.added += 1
+
+    def remove_cal(self, path):
+        pass
+
+
+def register(registry, bpms, calibrations):
+    #as gem_reduce does: the BPMs once, then the products of each stage
+    added = registry.add_cal(bpms)
+    for files in calibrations:
+        added += registry.add_cal(files)
+    return len(added)
+
+
+def caldb_init(workdir):
+    from recipe_system.cal_service import LocalDB
+    caldb = LocalDB(os.path.join(workdir, 'cal_manager.db'))
+    caldb.init()
+    return caldb
+
+
+def run(nfiles, args):
+    workdir = tempfile.mkdtemp(prefix=f'gmosls_bench_{nfiles}_', dir=args.scratch)
+    reader = synthetic.read_synthetic if args.reader == 'synthetic' else read_metadata
+    results = {'nfiles': nfiles}
+    try:
+        t, files = timed(synthetic.make_night, os.path.join(workdir, 'raw'),
+                         nfiles, args.suffix, args.counts)
+        results['generate_s'] = t
+        results['nfiles'] = len(files)
+
+        if len(files) <= args.baseline_max:
+            results['select_data_s'], _ = timed(select_data_baseline, files, reader)
+        dbfile = os.path.join(workdir, 'index.db')
+        with measure('select', level='stage') as m:
+            results['index_cold_s'], (nscanned, selected) = timed(
+                index_selection, dbfile, files, reader)
+        results['index_cold_read_mb'] = m.record['read_mb']
+        results['index_cold_peak_rss_mb'] = m.record['peak_rss_mb']
+        results['index_warm_s'], (nrescanned, _) = timed(
+            index_selection, dbfile, files, reader)
+        results['index_warm_reopened'] = nrescanned
+
+        stages = stages_from(selected)
+        manifest = Manifest(os.path.join(workdir, 'fingerprint.json'))
+        results['manifest_cold_s'], _ = timed(
+            lambda: [manifest.fingerprint(s) for s in stages])
+        results['manifest_warm_s'], _ = timed(
+            lambda: [manifest.fingerprint(s) for s in stages])
+
+        try:
+            results['caldb_init_s'], _ = timed(caldb_init, workdir)
+        except ImportError:
+            results['caldb_init_s'] = None
+
+        #the calibration frames stand in for the processed calibrations
+        bpms = selected[-1]
+        calibrations = [selected[i] for i in (1, 2, 3, 4, 5)]
+        stub = StubDB(os.path.join(workdir, 'stub_cal_manager.db'))
+        registry = CalRegistry(stub)
+        registry.init()
+        results['calregistry_cold_s'], results['calregistry_added'] = timed(
+            register, registry, bpms, calibrations)
+        results['calregistry_warm_s'], results['calregistry_readded'] = timed(
+            register, CalRegistry(stub), bpms, calibrations)
+        results['calregistry_db_calls'] = stub.added
+
+        results['orchestrate_inline_s'], _ = timed(orchestrate, stages, workdir, 1)
+        if args.jobs > 1:
+            results['orchestrate_pool_s'], _ = timed(
+                orchestrate, stages, workdir, args.jobs)
+    finally:
+        if args.keep:
+            print('kept', workdir)
+        else:
+            shutil.rmtree(workdir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='offline gem_reduce benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 10000],
+                        help='night sizes in files, default 10 1000 10000')
+    parser.add_argument('--reader', choices=['synthetic', 'dragons'], default='synthetic',
+                        help='classify with the synthetic header reader or astrodata')
+    parser.add_argument('--suffix', choices=['.fits', '.fits.bz2'], default='.fits',
+                        help='write plain or bzip2 compressed frames')
+    parser.add_argument('--jobs', type=int, default=4,
+                        help='pool size for the orchestration benchmark, default 4')
+    parser.add_argument('--baseline-max', type=int, default=1000,
+                        help='largest night for the select_data baseline, default 1000')
+    for option, kind in [('--bias-ff', 'bias_ff'), ('--bias-cs', 'bias_cs'),
+                         ('--flats', 'flat'), ('--arcs', 'arc'),
+                         ('--standards', 'standard'), ('--science', 'science'),
+                         ('--bpms', 'bpm')]:
+        parser.add_argument(option, type=int, default=None, dest=kind,
+                            help=f'number of {kind} frames, default: its share of the night')
+    parser.add_argument('--scratch', default=None, help='scratch directory')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic files')
+    parser.add_argument('--output', default=None, help='write the results as JSON')
+    args = parser.parse_args()
+    args.counts = {kind: getattr(args, kind) for kind, f in synthetic.FRACTIONS + [('bpm', 0)]
+                   if getattr(args, kind) is not None}
+
+    allresults = []
+    for nfiles in args.sizes:
+        results = run(nfiles, args)
+        allresults.append(results)
+        print(f"--- {results['nfiles']} files")
+        for key, value in results.items():
+            if key.endswith('_s'):
+                text = 'skipped' if value is None else f'{value:10.3f} s'
+                print(f'  {key[:-2]:<22} {text}')
+            elif key != 'nfiles':
+                print(f'  {key:<22} {value}')
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(allresults, fh, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+#Startup budget for the gem_reduce entry point.
+#
+#Imports the reduction scripts and every module of the repository they
+#import under python -X importtime, times "--help" of the scripts and a
+#gem_reduce(args, []) with no stage selected, and compares them with the
+#budget in startup_budget.json.  It also fails if any of the slow packages
+#(DRAGONS, matplotlib) is imported at startup, since those must only be
+#imported by the stage that uses them.
+#
+#    python benchmarks/bench_startup.py            check against the budget
+#    python benchmarks/bench_startup.py --update   record the current numbers
+
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'startup_budget.json')
+
+SCRIPTS = ['dragons_gem2025A.py', 'dragons_tutorial.py']
+
+#packages that must never be imported before a stage needs them
+FORBIDDEN = ['astrodata', 'gemini_instruments', 'recipe_system', 'geminidr',
+             'gempy', 'matplotlib', 'astropy', 'numpy', 'scipy']
+
+
+def local_imports(script):
+    """Modules of the repository that script imports, at any level."""
+    with open(os.path.join(REPO, script)) as fh:
+        tree = ast.parse(fh.read())
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.add(node.module.split('.')[0])
+    return sorted(n for n in names if os.path.exists(os.path.join(REPO, n + '.py')))
+
+
+def modules():
+    """The scripts and the repository modules they import."""
+    names = [os.path.splitext(script)[0] for script in SCRIPTS]
+    for script in SCRIPTS:
+        names += [n for n in local_imports(script) if n not in names]
+    return names
+
+
+def importtime(modules):
+    """Run python -X importtime.
+
+    Returns {module: (self_us, cumulative_us, toplevel)} where toplevel is
+    True for modules imported directly rather than by another module.
+    """
+    code = 'import ' + ', '.join(modules)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          cwd=REPO, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        toplevel = not name[1:].startswith(' ')
+        times[name.strip()] = (int(self_us), int(cumulative), toplevel)
+    return times
+
+
+def help_time(script, repeat=5):
+    """Best wall time of 'python script --help' in seconds."""
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, script, '--help'], cwd=REPO,
+                       capture_output=True, check=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+#gem_reduce with no stage selected: the helpers are imported, the header
+#index and the manifest are opened and nothing runs
+NO_STAGES = '''
+import time
+start = time.perf_counter()
+import {module}
+{module}.gem_reduce({module}.make_parser().parse_args([]), [])
+print(time.perf_counter() - start)
+'''
+
+
+def no_stages_time(script, repeat=5):
+    """Best wall time of gem_reduce(args, []) of script in seconds, in a
+    fresh directory each time."""
+    module = os.path.splitext(script)[0]
+    path = [REPO] + [p for p in os.environ.get('PYTHONPATH', '').split(os.pathsep) if p]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path))
+    best = None
+    for i in range(repeat):
+        with tempfile.TemporaryDirectory(prefix='gmosls_startup_') as tmp:
+            proc = subprocess.run([sys.executable, '-c', NO_STAGES.format(module=module)],
+                                  cwd=tmp, env=env, capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError(proc.stderr)
+        elapsed = float(proc.stdout.split()[-1])
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure():
+    times = importtime(modules())
+    results = {
+        'import_us': sum(t[1] for t in times.values() if t[2]),
+        'forbidden': sorted(m for m in times if m.split('.')[0] in FORBIDDEN),
+    }
+    for script in SCRIPTS:
+        results['help_s:' + script] = round(help_time(script), 4)
+        results['no_stages_s:' + script] = round(no_stages_time(script), 4)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='gem_reduce startup budget')
+    parser.add_argument('--update', action='store_true',
+                        help='write the current numbers (plus margin) as the budget')
+    parser.add_argument('--margin', type=float, default=0.5,
+                        help='fractional headroom used with --update, default 0.5')
+    args = parser.parse_args()
+
+    results = measure()
+    print(json.dumps(results, indent=1))
+
+    if args.update:
+        budget = {k: round(v * (1 + args.margin), 4) for k, v in results.items()
+                  if k != 'forbidden'}
+        with open(BUDGET, 'w') as fh:
+            json.dump(budget, fh, indent=1, sort_keys=True)
+            fh.write('\n')
+        print(f'wrote {BUDGET}')
+        return 0
+
+    failures = []
+    if results['forbidden']:
+        failures.append('slow packages imported at startup: '
+                        + ', '.join(results['forbidden']))
+    with open(BUDGET) as fh:
+        budget = json.load(fh)
+    for key, limit in budget.items():
+        if results.get(key, 0) > limit:
+            failures.append(f'{key} = {results[key]} exceeds budget {limit}')
+    for key in sorted(set(results) - set(budget) - {'forbidden'}):
+        print(f'note: no budget for {key}, record one with --update')
+
+    for failure in failures:
+        print('FAIL', failure)
+    if not failures:
+        print('startup within budget')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
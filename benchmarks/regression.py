@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+#Output and performance regression check of a full gem_reduce run.
+#
+#Runs every stage of a reduction script on its reference dataset (the
+#dataroot of the script) in a fresh directory and compares
+#
+#  products     every product of every stage against the golden copy:
+#               data, variance and DQ of every extension, tables such as
+#               the sensitivity function, and the wavelength solution of
+#               arcs and 1D spectra, within the tolerances of its kind in
+#               regression_tolerances.json
+#  performance  wall time and peak memory of every stage against the
+#               baseline of the golden run, failing beyond the fraction
+#               plus slack allowed in regression_tolerances.json
+#
+#    python benchmarks/regression.py --golden DIR --update   record golden
+#    python benchmarks/regression.py --golden DIR            check a change
+#    python benchmarks/regression.py --golden DIR --skip-run compare again
+#
+#Extra options for the script go after --args, e.g. --args "--jobs 4".
+#The golden products are large and are kept outside the repository.  The
+#workdir is emptied before every run, and the run has its own dragonsrc and
+#local calibration database in it, so it never sees the usual database or
+#the calibrations of an earlier run.
+
+import argparse
+import glob
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from profiling import report_base
+from spectrastore import wavelength
+
+
+TOLERANCES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'regression_tolerances.json')
+
+STAGE_FLAGS = ['--makebias', '--makeflats', '--makearcs', '--makestd', '--makesci']
+
+#tolerances used for the products of each stage; science products are
+#spectrum_1d or spectrum_2d depending on their extensions
+STAGE_KINDS = {'biasstd': 'bias', 'biassci': 'bias', 'flats': 'flat',
+               'arcs': 'arc', 'std': 'standard', 'sci': None}
+
+
+def private_config(workdir):
+    """Environment in which DRAGONS reads a dragonsrc in workdir, whose
+    local calibration database is also in workdir."""
+    config = os.path.join(workdir, 'dragonsrc')
+    with open(config, 'w') as fh:
+        fh.write('[calibs]\n')
+        fh.write(f"databases = {os.path.join(workdir, 'cal_manager.db')} get store\n")
+    return dict(os.environ, DRAGONSRC=config)
+
+
+def run_pipeline(script, workdir, extra=()):
+    """Run every stage of script in a fresh workdir with its own calibration
+    database.  Returns the manifest and the profile records of the run."""
+    workdir = os.path.abspath(workdir)
+    if os.path.exists(workdir):
+        if os.listdir(workdir) and not os.path.exists(
+                os.path.join(workdir, 'regression_run.log')):
+            raise RuntimeError(f'{workdir} is not empty and not a regression run, '
+                               'not removing it')
+        shutil.rmtree(workdir)
+    os.makedirs(workdir)
+    env = private_config(workdir)
+    manifest = os.path.join(workdir, 'regression_manifest.json')
+    cmd = ([sys.executable, os.path.abspath(script)] + STAGE_FLAGS
+           + ['--force', '--manifest', manifest,
+              '--index', os.path.join(workdir, 'regression_index.db')] + list(extra))
+    print(' '.join(shlex.quote(c) for c in cmd))
+    start = time.perf_counter()
+    with open(os.path.join(workdir, 'regression_run.log'), 'w') as log:
+        proc = subprocess.run(cmd, cwd=workdir, env=env, stdout=log,
+                              stderr=subprocess.STDOUT)
+    print(f'pipeline finished in {time.perf_counter() - start:.0f} s '
+          f'with exit code {proc.returncode}')
+    if proc.returncode != 0:
+        raise RuntimeError(f"pipeline failed, see {os.path.join(workdir, 'regression_run.log')}")
+    return load_run(workdir)
+
+
+def load_run(workdir):
+    """{stage: [products]} and {stage: profile record} of a finished run."""
+    with open(os.path.join(workdir, 'regression_manifest.json')) as fh:
+        manifest = json.load(fh)
+    products = {name: sorted(rec['outputs']) for name, rec in manifest['stages'].items()}
+    versions = {rec.get('dragons') for rec in manifest['stages'].values()}
+    profiles = glob.glob(os.path.join(workdir, report_base('*.log') + '.json'))
+    records = {}
+    for profile in profiles:
+        with open(profile) as fh:
+            for rec in json.load(fh):
+                if rec['level'] == 'stage':
+                    records[rec['stage']] = rec
+    return products, records, sorted(v for v in versions if v)
+
+
+def _kind(stage, ad):
+    kind = STAGE_KINDS.get(stage)
+    if kind is not None:
+        return kind
+    return 'spectrum_1d' if all(ext.data.ndim == 1 for ext in ad) else 'spectrum_2d'
+
+
+def compare_arrays(name, new, old, tol):
+    """Differences between two arrays beyond tol, as a list of messages."""
+    import numpy as np
+
+    if new is None and old is None:
+        return []
+    if new is None or old is None:
+        return [f"{name}: {'missing' if new is None else 'not in the golden product'}"]
+    new, old = np.asarray(new, dtype=np.float64), np.asarray(old, dtype=np.float64)
+    if new.shape != old.shape:
+        return [f'{name}: shape {new.shape}, golden {old.shape}']
+    finite = np.isfinite(new) & np.isfinite(old)
+    bad = (np.isfinite(new) != np.isfinite(old)) | (
+        finite & ~np.isclose(new, old, rtol=tol['rtol'], atol=tol['atol']))
+    fraction = bad.mean() if bad.size else 0.0
+    if fraction <= tol['max_bad_fraction']:
+        return []
+    worst = np.abs(new - old)[finite].max() if finite.any() else float('nan')
+    return [f'{name}: {fraction:.3%} of the pixels differ beyond rtol={tol["rtol"]} '
+            f'atol={tol["atol"]}, largest difference {worst:.4g}']
+
+
+def compare_masks(name, new, old, tol):
+    import numpy as np
+
+    if new is None or old is None:
+        return [] if new is None and old is None else [f'{name}: only in one product']
+    if new.shape != old.shape:
+        return [f'{name}: shape {new.shape}, golden {old.shape}']
+    fraction = np.mean(new != old) if new.size else 0.0
+    if fraction <= tol['mask_fraction']:
+        return []
+    return [f'{name}: DQ differs in {fraction:.3%} of the pixels']
+
+
+def compare_tables(name, new, old, tol):
+    import numpy as np
+
+    problems = []
+    if set(new.colnames) != set(old.colnames):
+        return [f'{name}: columns {new.colnames}, golden {old.colnames}']
+    if len(new) != len(old):
+        return [f'{name}: {len(new)} rows, golden {len(old)}']
+    for col in old.colnames:
+        a, b = np.asarray(new[col]), np.asarray(old[col])
+        if a.dtype.kind in 'fiuc' and b.dtype.kind in 'fiuc':
+            problems += compare_arrays(f'{name}.{col}', a, b,
+                                       dict(tol, rtol=tol['table_rtol'], atol=0.0,
+                                            max_bad_fraction=0.0))
+        elif not np.array_equal(a, b):
+            problems.append(f'{name}.{col}: values differ')
+    return problems
+
+
+def _wavelengths(ext):
+    #along the middle row of a 2D frame, None without a usable solution
+    import numpy as np
+
+    if ext.data.ndim == 1:
+        wave, unit = wavelength(ext, ext.data.size)
+        return wave if unit != 'pixel' else None
+    ny, nx = ext.data.shape
+    try:
+        return ext.wcs(np.arange(nx), np.full(nx, ny // 2))[0]
+    except Exception:
+        return None
+
+
+def compare_product(stage, path, golden, tolerances):
+    """Messages for every difference between a product and its golden copy."""
+    import astrodata
+    import gemini_instruments
+
+    new, old = astrodata.open(path), astrodata.open(golden)
+    kind = _kind(stage, old)
+    tol = tolerances[kind]
+    name = os.path.basename(path)
+    if len(new) != len(old):
+        return kind, [f'{name}: {len(new)} extensions, golden {len(old)}']
+    problems = []
+    for table in sorted(set(old.tables)):
+        if table not in new.tables:
+            problems.append(f'{name}.{table}: missing')
+        else:
+            problems += compare_tables(f'{name}.{table}', getattr(new, table),
+                                       getattr(old, table), tol)
+    for i, (a, b) in enumerate(zip(new, old)):
+        ext = f'{name}[{i + 1}]'
+        problems += compare_arrays(ext + '.data', a.data, b.data, tol)
+        problems += compare_arrays(ext + '.variance', a.variance, b.variance,
+                                   dict(tol, rtol=tol['variance_rtol']))
+        problems += compare_masks(ext + '.mask', a.mask, b.mask, tol)
+        for table in sorted(set(b.tables)):
+            if table not in a.tables:
+                problems.append(f'{ext}.{table}: missing')
+            else:
+                problems += compare_tables(f'{ext}.{table}', getattr(a, table),
+                                           getattr(b, table), tol)
+        if 'wavelength_atol_nm' in tol:
+            wa, wb = _wavelengths(a), _wavelengths(b)
+            if wb is not None:
+                problems += compare_arrays(
+                    ext + '.wavelength', wa, wb,
+                    dict(tol, rtol=0.0, atol=tol['wavelength_atol_nm'],
+                         max_bad_fraction=0.0))
+    return kind, problems
+
+
+def compare_products(products, golden, tolerances):
+    """[(stage, product, kind, problems)] for every golden product."""
+    with open(os.path.join(golden, 'products.json')) as fh:
+        expected = json.load(fh)
+    results = []
+    for stage, names in sorted(expected.items()):
+        produced = {os.path.basename(p): p for p in products.get(stage, [])}
+        for name in names:
+            if name not in produced:
+                results.append((stage, name, None, [f'{name}: not produced']))
+                continue
+            goldfile = os.path.join(golden, 'products', stage, name)
+            try:
+                kind, problems = compare_product(stage, produced[name], goldfile,
+                                                 tolerances['products'])
+            except Exception as err:
+                kind, problems = None, [f'{name}: could not compare, {type(err).__name__}: {err}']
+            results.append((stage, name, kind, problems))
+        for name in sorted(set(produced) - set(names)):
+            print(f'note: {stage} made {name}, which has no golden copy')
+    return results
+
+
+def compare_performance(records, golden, tolerances):
+    """[(stage, quantity, value, baseline, limit)] of every stage."""
+    with open(os.path.join(golden, 'baseline.json')) as fh:
+        baseline = json.load(fh)['stages']
+    perf = tolerances['performance']
+    results = []
+    for stage, base in sorted(baseline.items()):
+        rec = records.get(stage)
+        for quantity, fraction, slack in (
+                ('wall_s', perf['wall_fraction'], perf['wall_slack_s']),
+                ('peak_rss_mb', perf['memory_fraction'], perf['memory_slack_mb'])):
+            value = None if rec is None else rec[quantity]
+            limit = base[quantity] * (1 + fraction) + slack
+            results.append((stage, quantity, value, base[quantity], limit))
+    return results
+
+
+def update_golden(products, records, versions, golden):
+    if os.path.exists(os.path.join(golden, 'products')):
+        shutil.rmtree(os.path.join(golden, 'products'))
+    expected = {}
+    for stage, files in products.items():
+        os.makedirs(os.path.join(golden, 'products', stage))
+        expected[stage] = sorted(os.path.basename(f) for f in files)
+        for f in files:
+            shutil.copyfile(f, os.path.join(golden, 'products', stage, os.path.basename(f)))
+    with open(os.path.join(golden, 'products.json'), 'w') as fh:
+        json.dump(expected, fh, indent=1, sort_keys=True)
+    update_baseline(records, versions, golden)
+
+
+def update_baseline(records, versions, golden):
+    baseline = {'dragons': versions, 'recorded': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'stages': {stage: {'wall_s': rec['wall_s'], 'peak_rss_mb': rec['peak_rss_mb']}
+                           for stage, rec in records.items()}}
+    os.makedirs(golden, exist_ok=True)
+    with open(os.path.join(golden, 'baseline.json'), 'w') as fh:
+        json.dump(baseline, fh, indent=1, sort_keys=True)
+        fh.write('\n')
+
+
+def best(runs):
+    """Stage records with the smallest wall time and memory of each stage."""
+    records = {}
+    for run in runs:
+        for stage, rec in run.items():
+            if stage not in records:
+                records[stage] = dict(rec)
+            else:
+                for quantity in ('wall_s', 'peak_rss_mb'):
+                    records[stage][quantity] = min(records[stage][quantity], rec[quantity])
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description='gem_reduce output and performance regression check')
+    parser.add_argument('--golden', required=True,
+                        help='directory of the golden products and the performance baseline')
+    parser.add_argument('--script', default=os.path.join(REPO, 'dragons_gem2025A.py'),
+                        help='default=dragons_gem2025A.py; reduction script to run')
+    parser.add_argument('--workdir', default='regression_run',
+                        help='default=regression_run; directory the pipeline runs in')
+    parser.add_argument('--args', default='',
+                        help='extra options for the script, e.g. "--jobs 4"')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='default=1; runs to take the best timing of')
+    parser.add_argument('--skip-run', action='store_true',
+                        help='compare the products of the last run in workdir')
+    parser.add_argument('--update', action='store_true',
+                        help='store the products and timings of this run as golden')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='store only the timings of this run, e.g. on a new machine')
+    args = parser.parse_args()
+
+    if args.skip_run:
+        products, records, versions = load_run(args.workdir)
+    else:
+        runs = []
+        for i in range(max(1, args.repeat)):
+            products, records, versions = run_pipeline(args.script, args.workdir,
+                                                       shlex.split(args.args))
+            runs.append(records)
+        records = best(runs)
+
+    if args.update or args.update_baseline:
+        if args.update:
+            update_golden(products, records, versions, args.golden)
+        else:
+            update_baseline(records, versions, args.golden)
+        print(f'wrote {args.golden}')
+        return 0
+
+    with open(TOLERANCES) as fh:
+        tolerances = json.load(fh)
+    with open(os.path.join(args.golden, 'baseline.json')) as fh:
+        golden_versions = json.load(fh).get('dragons')
+    if golden_versions != versions:
+        print(f'note: golden run used DRAGONS {golden_versions}, this run {versions}')
+
+    failures = []
+    report = {'products': [], 'performance': []}
+    for stage, name, kind, problems in compare_products(products, args.golden, tolerances):
+        print(f"{'FAIL' if problems else 'ok  '} {stage:8s} {name} ({kind})")
+        for problem in problems:
+            print('       ', problem)
+        failures += problems
+        report['products'].append({'stage': stage, 'product': name, 'kind': kind,
+                                   'problems': problems})
+    for stage, quantity, value, base, limit in compare_performance(records, args.golden, tolerances):
+        bad = value is None or value > limit
+        print(f"{'FAIL' if bad else 'ok  '} {stage:8s} {quantity} = {value}, "
+              f'baseline {base}, limit {limit:.1f}')
+        if bad:
+            failures.append(f'{stage} {quantity} = {value} exceeds {limit:.1f}')
+        report['performance'].append({'stage': stage, 'quantity': quantity, 'value': value,
+                                      'baseline': base, 'limit': round(limit, 3)})
+
+    with open(os.path.join(args.workdir, 'regression_report.json'), 'w') as fh:
+        json.dump(dict(report, failures=failures), fh, indent=1)
+    print(f'{len(failures)} regressions' if failures else 'no regressions')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+#Synthetic GMOS-S longslit nights for the benchmarks.
+#
+#Writes small multi-extension FITS files with GMOS-like primary and
+#extension headers (Hamamatsu, 12 amplifiers) for Full Frame and Central
+#Spectrum biases, flats, arcs, a spectrophotometric standard, science
+#targets and bad pixel masks.  Only the standard library is used so the benchmarks run without
+#DRAGONS, astropy or network access.  read_synthetic() classifies the files
+#from their headers in the same form as fileindex.read_metadata, so the
+#selection benchmarks can run with or without DRAGONS installed.
+
+import bz2
+import datetime
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fitsheader
+
+
+BLOCK = 2880
+
+NAMPS = 12
+
+#full detector rows and the rows read out for the Central Spectrum ROI
+FULL_ROWS = 4224
+CENTRAL_ROWS = 1024
+
+TARGETS = ['J2145+0031', 'J2146+0015', 'J2147-0012', 'J2148+0102']
+STANDARD = 'LTT9239'
+
+#fraction of the frames of a night of each kind; the science takes the rest
+FRACTIONS = [('bias_ff', 0.2), ('bias_cs', 0.2), ('flat', 0.15),
+             ('arc', 0.1), ('standard', 0.05), ('science', 0.3)]
+
+#bad pixel masks do not scale with the night: one per ROI
+BPMS = 2
+
+
+def _card(key, value=None, comment=''):
+    if key in ('END', ''):
+        return key.ljust(80)
+    if isinstance(value, bool):
+        text = ('T' if value else 'F').rjust(20)
+    elif isinstance(value, str):
+        text = ("'" + value.replace("'", "''").ljust(8) + "'").ljust(20)
+    elif isinstance(value, float):
+        text = repr(value).rjust(20)
+    else:
+        text = str(value).rjust(20)
+    card = f'{key:<8}= {text}'
+    if comment:
+        card += ' / ' + comment
+    return card[:80].ljust(80)
+
+
+def _header(cards):
+    text = ''.join(_card(*c) for c in cards) + _card('END')
+    text += ' ' * (-len(text) % BLOCK)
+    return text.encode('ascii')
+
+
+def _data(nx, ny):
+    nbytes = nx * ny * 2
+    return bytes(nbytes + (-nbytes % BLOCK))
+
+
+def night_counts(nfiles, counts=None):
+    """Number of frames of each kind in a night of about nfiles frames.
+
+    About 40% biases (half Full Frame, half Central Spectrum), 15% flats,
+    10% arcs, 5% standard and 30% science, with at least one frame of
+    every kind, and BPMS bad pixel masks.  counts overrides the number of
+    frames of any kind; the science takes what the others leave of nfiles.
+    """
+    counts = dict(counts or {})
+    out = {kind: counts.get(kind, max(1, int(round(nfiles * f)))) for kind, f in FRACTIONS}
+    if 'science' not in counts:
+        out['science'] = max(1, nfiles - sum(c for k, c in out.items() if k != 'science'))
+    out['bpm'] = counts.get('bpm', BPMS)
+    return out
+
+
+def night_plan(nfiles, counts=None):
+    """Split a night into (kind, roi, object) frame descriptions, with the
+    science spread over TARGETS.  See night_counts.
+    """
+    counts = night_counts(nfiles, counts)
+    plan = []
+    for kind in [k for k, f in FRACTIONS] + ['bpm']:
+        for i in range(counts[kind]):
+            if kind == 'bias_ff':
+                plan.append(('BIAS', 'Full Frame', 'Bias'))
+            elif kind == 'bias_cs':
+                plan.append(('BIAS', 'Central Spectrum', 'Bias'))
+            elif kind == 'flat':
+                plan.append(('FLAT', 'Full Frame', 'GCALflat'))
+            elif kind == 'arc':
+                plan.append(('ARC', 'Full Frame', 'CuAr'))
+            elif kind == 'standard':
+                plan.append(('OBJECT', 'Central Spectrum', STANDARD))
+            elif kind == 'bpm':
+                plan.append(('BPM', ('Full Frame', 'Central Spectrum')[i % 2], 'BPM'))
+            else:
+                plan.append(('OBJECT', 'Full Frame', TARGETS[i % len(TARGETS)]))
+    return plan
+
+
+def write_frame(path, obstype, roi, obj, index, nx=16, ny=16, namps=NAMPS,
+                binning=2):
+    """Write one synthetic GMOS-S frame, bzip2 compressed if the path
+    ends in .bz2.
+    """
+    start = datetime.datetime(2017, 10, 22, 0, 0, 0)
+    when = start + datetime.timedelta(seconds=30 * index)
+    obsclass = {'BIAS': 'dayCal', 'FLAT': 'partnerCal', 'ARC': 'dayCal',
+                'BPM': 'dayCal'}.get(obstype, 'partnerCal' if obj == STANDARD else 'science')
+    rows = CENTRAL_ROWS if roi == 'Central Spectrum' else FULL_ROWS
+    ystart = (FULL_ROWS - rows) // 2 + 1
+    phu = [
+        ('SIMPLE', True), ('BITPIX', 16), ('NAXIS', 0), ('EXTEND', True),
+        ('INSTRUME', 'GMOS-S'), ('TELESCOP', 'Gemini-South'),
+        ('OBSERVAT', 'Gemini-South'), ('DETECTOR', 'GMOS + Hamamatsu'),
+        ('DETTYPE', 'S10892'),
+        ('OBSTYPE', obstype), ('OBSCLASS', obsclass), ('OBSMODE', 'LONGSLIT'),
+        ('OBJECT', obj), ('GEMPRGID', 'GS-2017B-Q-15'),
+        ('OBSID', 'GS-2017B-Q-15-7'),
+        ('DATALAB', f'GS-2017B-Q-15-7-{index + 1:03d}'),
+        ('DATE-OBS', when.strftime('%Y-%m-%d')),
+        ('TIME-OBS', when.strftime('%H:%M:%S.0')),
+        ('UT', when.strftime('%H:%M:%S.0')),
+        ('EXPTIME', 0.0 if obstype == 'BIAS' else 60.0),
+        ('AIRMASS', 1.0 if obstype == 'BIAS' else 1.2),
+        ('GRATING', 'B600+_G5323'), ('CENTWAVE', 520.0), ('GRWLEN', 520.0),
+        ('FILTER1', 'open1-6'), ('FILTER2', 'open2-8'),
+        ('MASKNAME', '1.0arcsec' if obstype != 'BIAS' else 'None'),
+        ('MASKTYP', 1 if obstype != 'BIAS' else 0),
+        ('GCALLAMP', {'FLAT': 'QH', 'ARC': 'CuAr'}.get(obstype, 'None')),
+        ('GCALSHUT', 'OPEN' if obstype in ('FLAT', 'ARC') else 'CLOSED'),
+        ('NAMPS', 1), ('NEXTEND', namps),
+        ('DETNROI', 1), ('DETRO1X', 1), ('DETRO1XS', 6144),
+        ('DETRO1Y', ystart), ('DETRO1YS', rows),
+    ]
+    opener = bz2.open if path.endswith('.bz2') else open
+    with opener(path, 'wb') as fh:
+        fh.write(_header(phu))
+        for amp in range(namps):
+            x0 = amp * 512 + 1
+            ext = [
+                ('XTENSION', 'IMAGE'), ('BITPIX', 16), ('NAXIS', 2),
+                ('NAXIS1', nx), ('NAXIS2', ny), ('PCOUNT', 0), ('GCOUNT', 1),
+                ('BZERO', 32768.0), ('BSCALE', 1.0),
+                ('EXTNAME', 'SCI'), ('EXTVER', amp + 1),
+                ('CCDNAME', f'BI{amp // 4 + 5}-{amp % 4 + 1}'),
+                ('CCDSUM', f'{binning} {binning}'),
+                ('AMPNAME', f'BI{amp // 4 + 5}-{amp % 4 + 1}-{amp % 4 + 1}'),
+                ('DETSEC', f'[{x0}:{x0 + 511},{ystart}:{ystart + rows - 1}]'),
+                ('CCDSEC', f'[{(amp % 4) * 512 + 1}:{(amp % 4) * 512 + 512},1:{rows}]'),
+                ('DATASEC', f'[1:{nx},1:{ny}]'),
+                ('GAIN', 1.83), ('RDNOISE', 3.9),
+            ]
+            fh.write(_header(ext))
+            fh.write(_data(nx, ny))
+
+
+def make_night(directory, nfiles, suffix='.fits', counts=None, **kwargs):
+    """Write a synthetic night of about nfiles frames, return the paths.
+
+    suffix '.fits.bz2' writes bzip2 compressed frames; counts overrides
+    the number of frames of each kind, see night_counts.
+    """
+    os.makedirs(directory, exist_ok=True)
+    start = datetime.datetime(2017, 10, 22)
+    paths = []
+    for i, (obstype, roi, obj) in enumerate(night_plan(nfiles, counts)):
+        path = os.path.join(directory, f"S{start:%Y%m%d}S{i + 1:04d}{suffix}")
+        write_frame(path, obstype, roi, obj, i, **kwargs)
+        paths.append(path)
+    return paths
+
+
+def read_synthetic(path):
+    """Tags and descriptors of a synthetic frame, like read_metadata."""
+    headers = [fitsheader.parse(h) for h in fitsheader.read_headers(path)]
+    phu = headers[0]
+    obstype = phu['OBSTYPE']
+    tags = {'GEMINI', 'GMOS', 'SOUTH', 'RAW', 'UNPREPARED'}
+    if obstype == 'BPM':
+        tags = {'GEMINI', 'GMOS', 'SOUTH', 'BPM', 'CAL', 'PROCESSED'}
+    elif obstype == 'BIAS':
+        tags |= {'BIAS', 'CAL'}
+    elif obstype == 'FLAT':
+        tags |= {'FLAT', 'GCALFLAT', 'CAL', 'SPECT', 'LS'}
+    elif obstype == 'ARC':
+        tags |= {'ARC', 'CAL', 'SPECT', 'LS'}
+    else:
+        tags |= {'SPECT', 'LS'}
+        if phu['OBJECT'] == STANDARD:
+            tags |= {'STANDARD', 'CAL'}
+    roi = 'Central Spectrum' if phu['DETRO1YS'] == CENTRAL_ROWS else 'Full Frame'
+    xbin, ybin = (int(v) for v in headers[1]['CCDSUM'].split())
+    descriptors = {
+        'detector_roi_setting': roi,
+        'object': phu['OBJECT'],
+        'observation_class': phu['OBSCLASS'],
+        'observation_type': obstype,
+        'ut_datetime': f"{phu['DATE-OBS']}T{phu['TIME-OBS']}",
+        'exposure_time': phu['EXPTIME'],
+        'airmass': phu['AIRMASS'],
+        'disperser': phu['GRATING'],
+        'central_wavelength': phu['CENTWAVE'] * 1e-9,
+        'detector_x_bin': xbin,
+        'detector_y_bin': ybin,
+        'detector_name': phu['DETTYPE'],
+        'data_label': phu['DATALAB'],
+        'gain_setting': 'low',
+        'read_speed_setting': 'slow',
+        'amp_read_area': [f"'{h['AMPNAME']}':{h['DETSEC']}" for h in headers[1:]],
+    }
+    return sorted(tags), descriptors, len(headers) - 1
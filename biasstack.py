@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+#Chunked, hierarchical stacking of large sets of biases.
+#
+#A master bias is one Reduce over all the bias frames, which holds every
+#frame in memory while stacking.  For seasonal master biases made from
+#hundreds of frames that is tens of GB.  In chunked mode:
+#
+#  1. the frames are split into chunks of a fixed size and each chunk is
+#     reduced by the default bias recipe up to, but not including,
+#     storeProcessedBias.  The chunks run in parallel on the pool;
+#  2. while there are more sub-stacks than the chunk size, they are
+#     combined in groups of the chunk size;
+#  3. the last group is combined and stored as the processed bias.
+#
+#Sub-stacks are combined by inverse-variance weighting, pixel by pixel and
+#ignoring pixels flagged in the DQ plane.  The variance of a stacked pixel
+#falls with the number of frames that survived rejection in its chunk, so
+#the weighting also accounts for rejection, and the combined variance is
+#1 / sum(1 / variance).  A pixel is only flagged if no sub-stack has a good
+#value for it, and then with every bit it is flagged with in any of them.
+#Rejection happens within each chunk, so the result agrees with a
+#single-pass stack to within the noise of the rejected pixels.
+#
+#Peak memory is set by the chunk size instead of the number of frames.
+
+import os
+import re
+
+
+def combine_planes(datas, variances, masks, counts=None):
+    """Inverse-variance weighted mean of stacked planes.
+
+    datas, variances, masks are lists of arrays of the same shape (masks or
+    variances may be None); counts, the number of frames in each stack,
+    weights the stacks that have no variance.  Returns (data, variance,
+    mask).
+    """
+    import numpy as np
+
+    shape = datas[0].shape
+    num = np.zeros(shape, dtype=np.float64)
+    wsum = np.zeros(shape, dtype=np.float64)
+    mask = None
+    for i, data in enumerate(datas):
+        good = np.ones(shape, dtype=bool) if masks[i] is None else masks[i] == 0
+        if variances[i] is not None:
+            var = variances[i]
+            weight = np.where(good & (var > 0), 1.0 / np.where(var > 0, var, 1.0), 0.0)
+        else:
+            weight = good * float(counts[i] if counts else 1)
+        num += weight * data
+        wsum += weight
+        if masks[i] is not None:
+            mask = masks[i].copy() if mask is None else mask | masks[i]
+
+    covered = wsum > 0
+    #pixels flagged everywhere keep the plain mean and all their flags
+    fallback = np.mean(datas, axis=0)
+    data = np.where(covered, num / np.where(covered, wsum, 1.0), fallback)
+    variance = None
+    if all(v is not None for v in variances):
+        variance = np.where(covered, 1.0 / np.where(covered, wsum, 1.0),
+                            np.mean(variances, axis=0) / len(variances))
+    if mask is not None:
+        mask = np.where(covered, 0, mask).astype(mask.dtype)
+    return data.astype(datas[0].dtype), variance, mask
+
+
+def combine(adinputs):
+    """Combine sub-stacks extension by extension into the first of them."""
+    out = adinputs[0]
+    counts = [ad.phu.get('NCOMBINE', 1) for ad in adinputs]
+    for i, ext in enumerate(out):
+        data, variance, mask = combine_planes(
+            [ad[i].data for ad in adinputs],
+            [ad[i].variance for ad in adinputs],
+            [ad[i].mask for ad in adinputs],
+            counts)
+        ext.data = data
+        if variance is not None:
+            ext.variance = variance.astype(data.dtype)
+        if mask is not None:
+            ext.mask = mask
+    out.phu.set('NCOMBINE', sum(counts), 'Number of frames in the chunked stack')
+    out.phu.set('NSUBSTK', len(adinputs), 'Number of sub-stacks combined')
+    #a new name, or the combined stack would overwrite its first input
+    root = re.sub(r'_n\d+$', '', os.path.splitext(os.path.basename(out.filename))[0])
+    out.filename = f'{root}_n{sum(counts)}.fits'
+    return out
+
+
+#recipes given to Reduce by path, see recipe_name()
+
+def stackChunk(p):
+    """Default bias recipe on one chunk, without storing it."""
+    import hybrid
+    hybrid.run_until(p, 'storeProcessedBias')
+
+
+def combineChunks(p):
+    """Combine a group of sub-stacks into one, without storing it."""
+    p.streams['main'] = [combine(p.streams['main'])]
+    p.writeOutputs()
+
+
+def combineAndStore(p):
+    """Combine the last sub-stacks and store the processed bias."""
+    p.streams['main'] = [combine(p.streams['main'])]
+    p.storeProcessedBias()
+
+
+def recipe_name(recipe):
+    module = os.path.splitext(os.path.abspath(__file__))[0]
+    return f'{module}.{recipe}'
+
+
+def chunks(files, size):
+    """Split files into the fewest chunks of at most size, as even as
+    possible so no sub-stack is made of a frame or two."""
+    n = -(-len(files) // size)
+    bounds = [round(i * len(files) / n) for i in range(n + 1)]
+    return [files[bounds[i]:bounds[i + 1]] for i in range(n)]
+
+
+def chunk_jobs(job, size, level=0, files=None):
+    """Jobs stacking the chunks of a job's files (level 0) or combining
+    groups of sub-stacks (later levels)."""
+    files = job['files'] if files is None else files
+    recipe = 'stackChunk' if level == 0 else 'combineChunks'
+    #only the chunks of raw frames count towards the files of the stage
+    return [dict(job, name=f"{job['name']}_L{level}_{i:03d}", files=group,
+                 recipename=recipe_name(recipe),
+                 uparms=dict(job.get('uparms') or {}) if level == 0 else {},
+                 nfiles=len(group) if level == 0 else 0)
+            for i, group in enumerate(chunks(files, size))]
+
+
+def final_job(job, files):
+    return dict(job, name=job['name'] + '_combine', files=list(files),
+                recipename=recipe_name('combineAndStore'), uparms={}, nfiles=0)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+#Reuse processed calibrations across nights and programs.
+#
+#Master biases, processed arcs and sensitivity functions depend on the
+#instrument configuration much more than on the night: the dither comment
+#in gem_reduce notes that ~10 nm in central wavelength does not matter for
+#the standard.  The cache keeps a copy of every such product, stored under
+#its checksum, together with the configuration it was made for:
+#
+#    processed_bias      detector, ROI, binning, gain, read speed, amplifiers
+#    processed_arc       detector, grating, central wavelength, ROI, binning
+#    processed_standard  detector, grating, central wavelength bucket,
+#                        ROI, binning
+#
+#Before a job of a calibration stage runs, the cache is asked for a product
+#with the configuration of the job's inputs, observed no more than the age
+#limit of its type apart.  A hit is verified against its checksum, copied
+#to the execution directory and registered in the calibration database,
+#and the job is not run.  Products are evicted least recently used first
+#once the cache grows past its size limit.
+
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from manifest import file_checksum
+from membudget import GB
+
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'), '.gmosls_calcache')
+
+#descriptors that make up the configuration of each cached type
+KEYS = {
+    'processed_bias': ('detector_name', 'detector_roi_setting',
+                       'detector_x_bin', 'detector_y_bin', 'gain_setting',
+                       'read_speed_setting', 'amp_read_area'),
+    'processed_arc': ('detector_name', 'disperser', 'central_wavelength',
+                      'detector_roi_setting', 'detector_x_bin', 'detector_y_bin'),
+    'processed_standard': ('detector_name', 'disperser', 'central_wavelength',
+                           'detector_roi_setting', 'detector_x_bin', 'detector_y_bin'),
+}
+
+#central wavelength bins of the sensitivity function, in nm
+WAVELENGTH_BUCKET = {'processed_standard': 25.0}
+
+#largest difference in observing date, in days, for a product to be reused
+MAX_AGE = {'processed_bias': 30, 'processed_arc': 180, 'processed_standard': 365}
+
+
+def _days(iso):
+    return datetime.fromisoformat(str(iso)[:19]).timestamp() / 86400.0
+
+
+class CalCache:
+    """Content-addressed store of processed calibrations.
+
+    directory   location of the cache, shared between nights and programs;
+                empty means DEFAULT_CACHE
+    index       header index of the input files
+    capacity    bytes the stored products may use
+    max_age     days, overrides MAX_AGE for every type if given
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE, index=None, capacity=10 * GB,
+                 max_age=None):
+        self.directory = os.path.abspath(os.path.expanduser(directory or DEFAULT_CACHE))
+        self.index = index
+        self.capacity = capacity
+        self.max_age = dict(MAX_AGE) if max_age is None else {k: max_age for k in KEYS}
+        self.stats = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0}
+        os.makedirs(os.path.join(self.directory, 'objects'), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(self.directory, 'calcache.db'),
+                                     check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS products ('
+            'checksum TEXT, caltype TEXT, key TEXT, filename TEXT, '
+            'obsdate TEXT, size INTEGER, created REAL, last_used REAL, '
+            'source TEXT, PRIMARY KEY (checksum, caltype, key))')
+        self._conn.commit()
+
+    def _object(self, checksum):
+        return os.path.join(self.directory, 'objects', checksum[:2], checksum + '.fits')
+
+    def key(self, caltype, files):
+        """Configuration key of a job's inputs, None if they disagree."""
+        keys = set()
+        for path in files:
+            values = []
+            for name in KEYS[caltype]:
+                value = self.index.descriptor(path, name)
+                if name == 'central_wavelength' and value is not None:
+                    nm = value * 1e9
+                    bucket = WAVELENGTH_BUCKET.get(caltype)
+                    value = round(nm / bucket) * bucket if bucket else round(nm, 1)
+                values.append(str(value))
+            keys.add('|'.join(values))
+        return keys.pop() if len(keys) == 1 else None
+
+    def _obsdate(self, files):
+        dates = [self.index.descriptor(f, 'ut_datetime') for f in files]
+        dates = sorted(d for d in dates if d)
+        return dates[len(dates) // 2] if dates else None
+
+    def _caltype(self, stage):
+        cached = [c for c in stage.provides if c in KEYS]
+        return cached[0] if len(cached) == 1 else None
+
+    def fetch(self, stage, jobs, caldb=None, destdir='.'):
+        """Restore cached products for the jobs of a calibration stage.
+
+        Returns a dict of job name to the restored files; those jobs need
+        not run.
+        """
+        caltype = self._caltype(stage)
+        if caltype is None:
+            return {}
+        restored = {}
+        for job in jobs:
+            key = self.key(caltype, job['files'])
+            obsdate = self._obsdate(job['files'])
+            if key is None or obsdate is None:
+                continue
+            with self._lock:
+                rows = self._conn.execute(
+                    'SELECT checksum, filename, obsdate FROM products '
+                    'WHERE caltype=? AND key=?', (caltype, key)).fetchall()
+            #the product observed closest in time to the job's inputs
+            rows = [r for r in rows
+                    if abs(_days(r[2]) - _days(obsdate)) <= self.max_age[caltype]]
+            rows.sort(key=lambda r: abs(_days(r[2]) - _days(obsdate)))
+            for checksum, filename, date in rows:
+                path = self._object(checksum)
+                if not os.path.exists(path) or file_checksum(path) != checksum:
+                    print(f'cached {filename} is damaged, dropping it')
+                    self._remove(checksum)
+                    continue
+                dest = os.path.join(destdir, filename)
+                shutil.copyfile(path, dest)
+                caldir = os.path.join(destdir, 'calibrations', caltype)
+                os.makedirs(caldir, exist_ok=True)
+                calfile = os.path.join(caldir, filename)
+                shutil.copyfile(path, calfile)
+                if caldb is not None:
+                    caldb.add_cal(calfile)
+                with self._lock:
+                    self._conn.execute('UPDATE products SET last_used=? WHERE checksum=?',
+                                       (time.time(), checksum))
+                    self._conn.commit()
+                print(f"{job['name']}: reusing {caltype} {filename} observed {date[:10]}")
+                restored[job['name']] = [os.path.abspath(dest)]
+                self.stats['hits'] += 1
+                break
+            else:
+                self.stats['misses'] += 1
+        return restored
+
+    def store(self, stage, job, outputs):
+        """Keep the products of a finished calibration job."""
+        caltype = self._caltype(stage)
+        if caltype is None or not outputs:
+            return
+        key = self.key(caltype, job['files'])
+        obsdate = self._obsdate(job['files'])
+        if key is None or obsdate is None:
+            return
+        for path in outputs:
+            checksum = file_checksum(path)
+            obj = self._object(checksum)
+            if not os.path.exists(obj):
+                os.makedirs(os.path.dirname(obj), exist_ok=True)
+                shutil.copyfile(path, obj + '.tmp')
+                os.replace(obj + '.tmp', obj)
+            now = time.time()
+            with self._lock:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO products VALUES (?,?,?,?,?,?,?,?,?)',
+                    (checksum, caltype, key, os.path.basename(path), obsdate,
+                     os.path.getsize(obj), now, now,
+                     ','.join(os.path.basename(f) for f in job['files'])))
+                self._conn.commit()
+            self.stats['stored'] += 1
+        self.evict()
+
+    def _remove(self, checksum):
+        with self._lock:
+            self._conn.execute('DELETE FROM products WHERE checksum=?', (checksum,))
+            self._conn.commit()
+        try:
+            os.remove(self._object(checksum))
+        except OSError:
+            pass
+
+    def evict(self):
+        """Drop the least recently used products beyond the size limit."""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT checksum, MAX(size), MAX(last_used) FROM products '
+                'GROUP BY checksum ORDER BY MAX(last_used)').fetchall()
+        used = sum(r[1] for r in rows)
+        for checksum, size, last_used in rows:
+            if used <= self.capacity:
+                break
+            self._remove(checksum)
+            used -= size
+            self.stats['evicted'] += 1
+
+    def summary(self):
+        s = self.stats
+        return (f"calibration cache {self.directory}: {s['hits']} reused, "
+                f"{s['misses']} not found, {s['stored']} stored, {s['evicted']} evicted")
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+#Idempotent registration of files in the local calibration database.
+#
+#Registering a file that is already in the database costs as much as the
+#first time, and gem_reduce used to re-add every BPM on every run.  The
+#registry keeps a cache, next to the database, of the size, mtime and
+#checksum of every file it has added.  Only new or changed files are
+#passed to the database, one add_cal call per file as the database takes a
+#single filename.  The cache is thrown away whenever the database file
+#itself is recreated.  Stages running in threads register files at the
+#same time, so the cache and its file are guarded by a lock.
+#
+#CalRegistry has the dbfile attribute and add_cal method of the DRAGONS
+#database object, so it can be handed to the scheduler and the worker
+#pool in its place.
+
+import json
+import os
+import threading
+
+from manifest import file_checksum
+
+
+class CalRegistry:
+    """Checksum-cached bulk registration in a DRAGONS local database."""
+
+    def __init__(self, caldb):
+        self.caldb = caldb
+        self.dbfile = os.path.abspath(os.path.expanduser(caldb.dbfile))
+        self.cachefile = self.dbfile + '.registered.json'
+        self._cache = {}
+        self._inode = None
+        self._lock = threading.RLock()
+        if os.path.exists(self.cachefile):
+            with open(self.cachefile) as fh:
+                content = json.load(fh)
+            self._cache = content.get('files', {})
+            self._inode = content.get('inode')
+
+    def _save(self):
+        with self._lock:
+            tmp = f'{self.cachefile}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp, 'w') as fh:
+                json.dump({'inode': self._inode, 'files': self._cache}, fh, indent=1)
+            os.replace(tmp, self.cachefile)
+
+    def exists(self):
+        return os.path.exists(self.dbfile)
+
+    def init(self):
+        """Create the database if it does not exist yet.
+
+        Returns True if it was created.  The cache only describes the
+        database file it was written for, so it is reset if the database
+        is new or was replaced since.
+        """
+        created = False
+        if self.exists():
+            print('cal database already exists:', self.dbfile)
+        else:
+            self.caldb.init()
+            created = True
+        inode = os.stat(self.dbfile).st_ino
+        if created or inode != self._inode:
+            self._cache = {}
+            self._inode = inode
+            self._save()
+        return created
+
+    def changed(self, files):
+        """The files that are not registered or changed since they were."""
+        changed = []
+        for path in files:
+            path = os.path.abspath(path)
+            st = os.stat(path)
+            cached = self._cache.get(path)
+            if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+                continue
+            checksum = file_checksum(path)
+            if cached is not None and cached[2] == checksum:
+                #touched but identical, just remember the new mtime
+                self._cache[path] = [st.st_size, st.st_mtime_ns, checksum]
+                continue
+            changed.append((path, [st.st_size, st.st_mtime_ns, checksum]))
+        return changed
+
+    def add_cal(self, files):
+        """Register the new or changed files.
+
+        Accepts a single filename or a list; the database is given one
+        filename at a time.  Returns the files that were actually added.
+        """
+        if isinstance(files, str):
+            files = [files]
+        with self._lock:
+            changed = self.changed(files)
+            for path, stat in changed:
+                self.caldb.add_cal(path)
+                self._cache[path] = stat
+            self._save()
+        return [path for path, stat in changed]
+
+    def remove_cal(self, files):
+        if isinstance(files, str):
+            files = [files]
+        with self._lock:
+            for path in files:
+                self.caldb.remove_cal(path)
+                self._cache.pop(os.path.abspath(path), None)
+            self._save()
+
+    def list_files(self):
+        return self.caldb.list_files()
+
+    def get_calibrations(self, adinputs, **kwargs):
+        return self.caldb.get_calibrations(adinputs, **kwargs)
@@ -1,16 +1,29 @@
 #!/usr/bin/env python
 
 
-def gem_reduce(args, all_files):
-
-
-    import astrodata
-    import gemini_instruments
-    from recipe_system.reduction.coreReduce import Reduce
-    from gempy.adlibrary import dataselect
-    from gempy.utils import logutils
-    from gempy.adlibrary import plotting
-    import matplotlib.pyplot as plt
+def gem_reduce(args, all_files, pattern=None):
+
+
+    #DRAGONS and matplotlib take seconds to import, so they are only
+    #imported where they are used: astrodata when the header index has
+    #new files to scan, recipe_system and the gempy logging when a stage
+    #runs and matplotlib when a spectrum is plotted.
+    from fileindex import SCIENCE_GROUPING, FileIndex, group_labels
+    from scheduler import Scheduler, Stage
+    from manifest import Manifest
+    from profiling import Profiler
+    from watch import Watcher
+    from calregistry import CalRegistry
+    from membudget import MemoryEstimator, parse_size
+    from planner import Planner, load_history, plan_text
+    from journal import Journal, journal_path
+    from staging import Stager
+    from associations import Associator
+    from calcache import CalCache
+    from quicklook import QuickLook
+    from spectrastore import export
+    from telemetry import Telemetry
+    from profiling import report_base
 
 
     #initialize variables that govern which parts of the script to execute
@@ -27,56 +40,44 @@ def gem_reduce(args, all_files):
 
 
     #this will be print to the directory in which you are working
-    logutils.config(file_name='gmosls_2025B.log')
-
-
-    #set up calibration services You can manually add processed
-    # calibrations with caldb.add_cal(<filename>), list the database
-    # content with caldb.list_files(), and caldb.remove_cal(<filename>) to
-    # remove a file from the database (it will not remove the file on
-    # disk.)
+    logfile = 'gmosls_2025B.log'
 
-    from recipe_system import cal_service
-
-    caldb = cal_service.set_local_database()
-
-    #only initialize the database if it hasn't been initialized
-    try:
-         caldb.init()
-    except:
-         print("cal database already exists")
-         caldb.list_files()
 
     all_files.sort()
     print(all_files)
 
     #set up lists of bias files.  Start with all files
-    #The syntax for select_data is
-    #select_data(inputs, tags=[], xtags=[], expression='True')
-    #where tags and xtags are tags to include or exclude respectively.
+    #The syntax for index.select mirrors dataselect.select_data
+    #select(tags=[], xtags=[], expression='True')
+    #where tags and xtags are tags to include or exclude respectively and
+    #the expression is written in terms of descriptor names.
     print('#############################################')
     print('collect file names')
     print('#############################################')
 
-    all_biases = dataselect.select_data(all_files, ['BIAS'])
+    #scan the headers once into a persistent index keyed by path, size
+    #and mtime.  All selections below are answered from the index and
+    #files that have not changed since the last run are never reopened.
+    index = FileIndex(args.index)
+    nscanned = index.update(all_files)
+    print(f'header index {args.index}: scanned {nscanned} of {len(all_files)} files')
+
+    all_biases = index.select(['BIAS'])
 
     for bias in all_biases:
-        ad = astrodata.open(bias)
-        print(bias, '  ', ad.detector_roi_setting())
+        print(bias, '  ', index.descriptor(bias, 'detector_roi_setting'))
 
     #Now split up the biases into full frame and the central spectrum
-    biasstd = dataselect.select_data(
-        all_files,
+    biasstd = index.select(
         ['BIAS'],
         [],
-        dataselect.expr_parser('detector_roi_setting=="Central Spectrum"')
+        'detector_roi_setting=="Central Spectrum"'
     )
 
-    biassci = dataselect.select_data(
-        all_files,
+    biassci = index.select(
         ['BIAS'],
         [],
-        dataselect.expr_parser('detector_roi_setting=="Full Frame"')
+        'detector_roi_setting=="Full Frame"'
     )
 
     #select files of differen types
@@ -84,52 +85,61 @@ def gem_reduce(args, all_files):
     #stack the flats. This allows us to use only one list of the
     #flats. Each will be reduced individually, never interacting with the
     #others.
-    flats = dataselect.select_data(all_files, ['FLAT'])
+    flats = index.select(['FLAT'])
 
     #arcs - The default recipe does not stack the arcs. This allows us to use
     #only one list of arcs. Each will be reduce individually, never
     #interacting with the others.
-    arcs = dataselect.select_data(all_files, ['ARC'])
+    arcs = index.select(['ARC'])
 
     #If a spectrophotometric standard is recognized as such by DRAGONS, it
     #will receive the Astrodata tag STANDARD. To be recognized, the name
     #of the star must be in a lookup table. All spectrophotometric
     #standards normally used at Gemini are in that table.
-    stdstar = dataselect.select_data(all_files, ['STANDARD'])
+    stdstar = index.select(['STANDARD'])
 
     #this prints all the data not flagged as a calibration file.  This
     #could include daytime calibrations with daycal flag
-    all_science = dataselect.select_data(all_files, [], ['CAL'])
+    all_science = index.select([], ['CAL'])
     for sci in all_science:
-        ad = astrodata.open(sci)
-        print(sci, '  ', ad.object())
-
-    scitarget = dataselect.select_data(
-        all_files,
-        [],
-        ['CAL'],
-        dataselect.expr_parser('object=="J2145+0031"')
-    )
-    print('scitarget = ', scitarget)
-
-    #load bad pixel maps to the database.  this has to be downloaded
-    #separately from the database
-    for bpm in dataselect.select_data(all_files, ['BPM']):
-        caldb.add_cal(bpm)
-
+        print(sci, '  ', index.descriptor(sci, 'object'))
+
+    #group the science frames by target and instrument configuration,
+    #keeping the central wavelength dithers of a target together.  Each
+    #group is reduced by its own Reduce so with --jobs the targets are
+    #reduced concurrently.  --targets picks a subset by object name.
+    scigroups = group_labels({key: files for key, files
+                              in index.group(all_science, SCIENCE_GROUPING).items()
+                              if not args.targets or key[0] in args.targets})
+    for label, files in scigroups.items():
+        print('science group', label, ':', files)
+    if args.targets:
+        missing = set(args.targets) - {index.descriptor(f, 'object')
+                                       for files in scigroups.values()
+                                       for f in files}
+        if missing:
+            print('WARNING no science frames for targets', sorted(missing))
+
+    #Each stage declares the calibration types it takes from the local
+    #calibration database and the ones it produces, and the scheduler runs
+    #the selected stages in that dependency order.  With --jobs N every
+    #stage whose calibrations are ready runs at the same time on a pool of
+    #N worker processes: the two master biases together, then flats and
+    #arcs together once the biases exist.  Interactive fitting needs the
+    #terminal, so with --interactive the stages run one after another in
+    #this process.  With --interactive --hybrid only the primitive that
+    #needs a human (the interactive= of each stage) runs here, file by
+    #file as the steps before it finish on the pool.
+    stages = []
 
     #make master bias from full frames and standard frames
     if makebias==True:
-        print('#############################################')
-        print('make master bias')
-        print('#############################################')
-        reduce_biasstd = Reduce()
-        reduce_biasstd.files.extend(biasstd)
-        reduce_biasstd.runr()
-
-        reduce_biassci = Reduce()
-        reduce_biassci.files.extend(biassci)
-        reduce_biassci.runr()
+        stages.append(Stage('biasstd', biasstd,
+                            provides=['processed_bias'], chunk=args.bias_chunk,
+                            title='make master bias (Central Spectrum)'))
+        stages.append(Stage('biassci', biassci,
+                            provides=['processed_bias'], chunk=args.bias_chunk,
+                            title='make master bias (Full Frame)'))
     else:
         print('#############################################')
         print('Skipping master bias construction')
@@ -146,21 +156,22 @@ def gem_reduce(args, all_files):
     #We can send all the flats, regardless of characteristics, to Reduce
     #and each will be reduce individually. When a calibration is needed,
     #in this case, a master bias, the best match will be obtained
-    #automatically from the local calibration manager.
+    #automatically from the local calibration manager.  Since the flats
+    #never interact, with --jobs each one is reduced by its own Reduce.
     if makeflats==True:
-        print('#############################################')
-        print('make master flats')
-        print('#############################################')
-
-        reduce_flats = Reduce()
-        reduce_flats.files.extend(flats)
+        uparms = {}
 
         #The primitive normalizeFlat, used in the recipe, has an interactive
         #mode. 
         if interactive==True:
-            reduce_flats.uparms = dict([('interactive', True)])
-
-        reduce_flats.runr()
+            uparms = dict([('interactive', True)])
+
+        stages.append(Stage('flats', flats,
+                            needs=['processed_bias'],
+                            provides=['processed_flat'],
+                            per_file=True, uparms=uparms,
+                            interactive='normalizeFlat',
+                            title='make master flats'))
     else:
         print('#############################################')
         print('Skipping master flat construction')
@@ -168,17 +179,18 @@ def gem_reduce(args, all_files):
 
     #reduce arcs.  As for spectroscopic flats, these images are not stacked
     if makearcs==True:
-        print('#############################################')
-        print('make arcs and determine wavelength solution')
-        print('#############################################')
-        reduce_arcs = Reduce()
-        reduce_arcs.files.extend(arcs)
+        uparms = {}
 
         #you can use an interactive feature to fit the arcs
         if interactive==True:
-            reduce_arcs.uparms = dict([('interactive', True)])
-
-        reduce_arcs.runr()
+            uparms = dict([('interactive', True)])
+
+        stages.append(Stage('arcs', arcs,
+                            needs=['processed_bias'],
+                            provides=['processed_arc'],
+                            per_file=True, uparms=uparms,
+                            interactive='determineWavelengthSolution',
+                            title='make arcs and determine wavelength solution'))
     else:
         print('#############################################')
         print('Skipping arc procession and wavelength solution determination')
@@ -189,31 +201,23 @@ def gem_reduce(args, all_files):
     #dither as it has been found that differences of ~10nm does not
     #significantly affect spectrophotometric calibration
     if makestd==True:
-        print('#############################################')
-        print('reduce standard and calculate sensitivity correction')
-        print('#############################################')
-
-        reduce_std = Reduce()
-        reduce_std.files.extend(stdstar)
+        uparms = {}
 
         #comment out to run in non-interactive mode for all the reduction.
         #This includes for sky subtraction and tracing the spectrum.
         #Standards are bright so this probably won't be needed
-        #reduce_std.uparms = dict([('interactive', True)])
+        #uparms = dict([('interactive', True)])
 
         #this is just to do the sensitivity function interactively.
         if interactive==True: 
-            reduce_std.uparms = dict([('calculateSensitivity:interactive', True)])
-
-        reduce_std.runr()
-
-        #this will plot the spectrum in aperture 1
-        plotspec=False
-        if plotspec==True:
-            ad = astrodata.open(reduce_std.output_filenames[0])
-            plt.ioff()
-            plotting.dgsplot_matplotlib(ad, 1)
-            plt.ion()
+            uparms = dict([('calculateSensitivity:interactive', True)])
+
+        stages.append(Stage('std', stdstar,
+                            needs=['processed_bias', 'processed_flat', 'processed_arc'],
+                            provides=['processed_standard'],
+                            uparms=uparms,
+                            interactive='calculateSensitivity',
+                            title='reduce standard and calculate sensitivity correction'))
     else:
         print('#############################################')
         print('skip making sensitivity correction')
@@ -224,41 +228,207 @@ def gem_reduce(args, all_files):
     #This makes a 2-D spectrum and an extracted 1D spectrum.  The 1D
     #spectrum is flux calibrated with the sensitivity function
     if makesci==True:
-        print('#############################################')
-        print('reduce science images')
-        print('#############################################')
-        reduce_science = Reduce()
-        reduce_science.files.extend(scitarget)
+        uparms = {}
 
         if interactive==True:
-            #reduce_science.uparms = dict([('findApertures:interactive', True)])
-            #reduce_science.uparms = dict([('skyCorrectFromSlit:interactive', True)])
-            #reduce_science.uparms = dict([('traceApertures:interactive', True)])
-            reduce_science.uparms = dict([('interactive', True)])
-
-        reduce_science.runr()
-
-        display = Reduce()
-        display.files = ['S20171022S0087_2D.fits']
-        display.recipename = 'display'
-        display.runr()
-
-        plotspec=False
-        if plotspec==True:
-            ad = astrodata.open(reduce_science.output_filenames[0])
-            plt.ioff()
-            plotting.dgsplot_matplotlib(ad, 1)
-            plt.ion()
+            #uparms = dict([('findApertures:interactive', True)])
+            #uparms = dict([('skyCorrectFromSlit:interactive', True)])
+            #uparms = dict([('traceApertures:interactive', True)])
+            uparms = dict([('interactive', True)])
+
+        stages.append(Stage('sci', groups=scigroups,
+                            needs=['processed_bias', 'processed_flat',
+                                   'processed_arc', 'processed_standard'],
+                            uparms=uparms,
+                            interactive='findApertures',
+                            title='reduce science images'))
     else:
         print('#############################################')
         print('skip reducing science images')
         print('#############################################')
 
-
-
-if __name__ == "__main__":
+    njobs = args.jobs
+    daemon = args.daemon
+    workqueue = args.queue
+    if interactive==True and not args.hybrid:
+        njobs = 1
+        daemon = None
+        workqueue = None
+
+    #stages whose inputs, uparms and DRAGONS version are unchanged since
+    #they last finished are skipped, and anything downstream of a stage
+    #that does run is redone.  --force rebuilds everything.
+    manifest = Manifest(args.manifest)
+
+    #--plan resolves which calibration every job will use, which stages
+    #would run and how long and how much memory they should take, writes
+    #the plan and stops without running Reduce or changing the database
+    if args.plan:
+        import json
+        import os
+
+        caldb = None
+        try:
+            from recipe_system import cal_service
+            caldb = cal_service.set_local_database()
+            if not os.path.exists(os.path.expanduser(caldb.dbfile)):
+                caldb = None
+        except ImportError:
+            print('recipe_system not available, calibration database not searched')
+        planner = Planner(stages, index, caldb, manifest,
+                          load_history(report_base(logfile) + '.json'),
+                          njobs, MemoryEstimator(index), args.force)
+        plan = planner.plan()
+        #keep the input checksums computed for the plan, so the run that
+        #follows it does not read every frame again
+        manifest.save()
+        print('#############################################')
+        print('reduction plan')
+        print('#############################################')
+        print(plan_text(plan))
+        with open(args.plan, 'w') as fh:
+            json.dump(plan, fh, indent=1)
+        print('plan written to', args.plan)
+        return plan
+
+    #the calibration database is only needed when a stage runs
+    outputs = {}
+    if stages or args.watch:
+        from gempy.utils import logutils
+
+        #the DRAGONS log goes to logfile
+        logutils.config(file_name=logfile)
+
+        #set up calibration services You can manually add processed
+        # calibrations with caldb.add_cal(<filename>), list the database
+        # content with caldb.list_files(), and caldb.remove_cal(<filename>) to
+        # remove a file from the database (it will not remove the file on
+        # disk.)
+
+        from recipe_system import cal_service
+
+        #everything below registers files through the registry, which
+        #remembers the checksum of every file it added and only passes new
+        #or changed files to the database, in one call
+        caldb = CalRegistry(cal_service.set_local_database())
+
+        #only initialize the database if it hasn't been initialized
+        caldb.init()
+        if args.listcals:
+            caldb.list_files()
+
+        #load bad pixel maps to the database.  this has to be downloaded
+        #separately from the database
+        added = caldb.add_cal(index.select(['BPM']))
+        print(f'registered {len(added)} new or changed BPMs')
+
+        #wall time, CPU time, peak memory and I/O of every stage and file
+        #are written to <log>_profile.json/.csv next to the log
+        profiler = Profiler()
+
+        #with --mem-budget a job only starts on the pool while the memory
+        #estimated from its frame geometry fits next to the running ones
+        mem_budget = parse_size(args.mem_budget)
+        estimator = MemoryEstimator(index)
+
+        #every Reduce job is checkpointed in a journal next to the
+        #manifest.  After a crash, rerun the same command with --resume
+        #and the jobs that already finished are not reduced again.
+        journal = Journal(journal_path(args.manifest))
+
+        #with --scratch the inputs of the running and the next stage are
+        #copied to local disk in the background while Reduce computes
+        stager = None
+        if args.scratch and workqueue:
+            print('--scratch is local to this host, ignoring it with --queue')
+        elif args.scratch:
+            stager = Stager(args.scratch, parse_size(args.scratch_size))
+
+        #calibrations are looked up once per configuration and night when a
+        #stage starts and handed to its jobs, instead of by every Reduce
+        associator = None
+        if not args.no_associate:
+            associator = Associator(caldb, index)
+
+        #with --calcache, master biases, processed arcs and sensitivity
+        #functions made on other nights with the same configuration are
+        #reused instead of reduced again
+        calcache = None
+        if args.calcache is not None:
+            calcache = CalCache(args.calcache, index, parse_size(args.calcache_size),
+                                args.calcache_max_age)
+
+        #with --plotspec the extracted spectra and 2D frames of the standard
+        #and science stages are plotted off-screen by a background pool as
+        #each stage finishes, into quicklook/index.html
+        quicklook = None
+        if plotspec==True:
+            quicklook = QuickLook()
+
+        #with --telemetry the progress of the run is written as JSON events
+        #for python telemetry.py, which shows throughput, ETA and stalls
+        telemetry = None
+        if args.telemetry:
+            telemetry = Telemetry(args.telemetry)
+        try:
+            if stages:
+                outputs = Scheduler(stages, caldb, njobs=njobs, manifest=manifest,
+                                    force=args.force, profiler=profiler,
+                                    mem_budget=mem_budget, estimator=estimator,
+                                    journal=journal, resume=args.resume,
+                                    stager=stager, associator=associator,
+                                    daemon=daemon, calcache=calcache,
+                                    hybrid=interactive and args.hybrid,
+                                    quicklook=quicklook, workqueue=workqueue,
+                                    telemetry=telemetry).run()
+
+            #with --export the 1D spectra of the standard and science
+            #stages go into one memory-mappable store, see spectrastore.py
+            if args.export is not None:
+                export(outputs, args.export)
+
+            #quick-look mode: keep polling the data directory and reduce
+            #each new frame as it lands, using the calibrations in the
+            #database.  Stops with Ctrl-C.
+            if args.watch:
+                Watcher(pattern, index, caldb, args.jobs, args.poll,
+                        args.settle, profiler, mem_budget, estimator,
+                        daemon).run()
+        finally:
+            print('#############################################')
+            print('stage timing')
+            print('#############################################')
+            print(profiler.summary())
+            for report in profiler.write(logfile):
+                print('profile written to', report)
+            if stager is not None:
+                stager.close()
+                print(stager.summary())
+            if associator is not None:
+                print(associator.summary())
+            if calcache is not None:
+                print(calcache.summary())
+            if quicklook is not None:
+                index_html = quicklook.close()
+                if index_html:
+                    print('quick-look plots in', index_html)
+            if telemetry is not None:
+                telemetry.close()
+
+    return outputs
+
+
+
+def make_parser():
+    """Command line options of gem_reduce."""
     import argparse
-    import glob
+
+    def chunk_size(text):
+        #a chunk of one frame never reduces the number of sub-stacks
+        value = int(text)
+        if value != 0 and value < 2:
+            raise argparse.ArgumentTypeError(f'{value}: use 0 (off) or at least 2')
+        return value
 
 
      #Code description - formatted to work with -h command line argument
@@ -276,7 +446,58 @@ if __name__ == "__main__":
     makestd:   default=False; reduce standard and make sensitivity correction\n\n\
     makesci:   default=False; reduce science frames and extract 1D spectrum\n\n\
     interactive default=False; perform all reductions interactively\n\n\
-    plotspec   default=False; plot spectra\n\n\
+    plotspec   default=False; plot the 1D and 2D products of the standard and science\n\
+               stages in the background, see quicklook/index.html\n\n\
+    index      default=gmosls_index.db; persistent header index of the input files\n\n\
+    jobs       default=1; run ready stages concurrently on N worker processes,\n\
+               flats and arcs are reduced one file per job\n\n\
+    manifest   default=gmosls_manifest.json; stages whose inputs, uparms and\n\
+               DRAGONS version are unchanged since the last run are skipped\n\n\
+    force      default=False; rerun every selected stage even if up to date\n\n\
+    targets    default=all; reduce only the science targets with these object names\n\n\
+    watch      default=False; after the selected stages, poll the data directory and\n\
+               reduce every new frame as it lands (quick-look), Ctrl-C to stop\n\n\
+    poll       default=2; seconds between polls in watch mode\n\n\
+    settle     default=60; seconds without a new bias before the master bias is rebuilt\n\n\
+    listcals   default=False; list the content of the calibration database\n\n\
+    mem-budget default=None; memory the worker pool may use, e.g. 64G or auto (80% of RAM).\n\
+               Jobs are started only while their estimated peak memory fits\n\n\
+    plan       default=None; only plan the run: resolve the calibrations of every job,\n\
+               estimate runtime and memory, write the plan to FILE\n\
+               (gmosls_plan.json) and stop\n\n\
+    resume     default=False; continue an interrupted run: jobs that finished are not\n\
+               run again and files left by unfinished jobs are moved to\n\
+               reduce_work/partial.  Use the same stage flags as the interrupted run\n\n\
+    scratch    default=None; local directory to stage input frames in.  The inputs\n\
+               of the running and the next stage are copied (and decompressed)\n\
+               there in the background and reused by later runs\n\n\
+    scratch-size default=20G; space the staged frames may use, least recently\n\
+               used copies are evicted first\n\n\
+    no-associate default=False; let every Reduce look up its own calibrations\n\
+               instead of resolving them once per configuration and night\n\n\
+    daemon     default=None; send every Reduce job to a warm worker daemon started\n\
+               with python warmpool.py, listening on SOCKET (default in /tmp)\n\n\
+    calcache   default=None; reuse master biases, processed arcs and sensitivity\n\
+               functions with the same configuration from the cache in DIR\n\
+               (~/.gmosls_calcache) and add new ones to it\n\n\
+    calcache-max-age default=30 days for biases, 180 for arcs, 365 for standards;\n\
+               largest difference in observing date of a reused product\n\n\
+    calcache-size default=10G; least recently used products are evicted beyond this\n\n\
+    hybrid     default=False; with interactive, run everything up to the interactive\n\
+               fit of each file on the worker pool and queue the fits, so the\n\
+               other files are processed while you fit\n\n\
+    queue      default=None; publish the Reduce jobs to the shared work queue\n\
+               QUEUE (a .db file or a directory on a filesystem every host\n\
+               sees) for python workqueue.py worker QUEUE on other hosts\n\n\
+    telemetry  default=None; write the progress of the run as JSON events to\n\
+               this file, or to the socket unix:PATH, and follow it with\n\
+               python telemetry.py TARGET\n\n\
+    export     default=None; collect the extracted 1D spectra of the standard and\n\
+               science stages, with their metadata, into .npy columns in DIR\n\
+               (spectra/) that load in one call with spectrastore.load()\n\n\
+    bias-chunk default=0 (off); stack the biases in chunks of this many frames\n\
+               on the worker pool and combine the sub-stacks, so the memory\n\
+               needed no longer grows with the number of biases\n\n\
     INPUT\n\n\
     You need to specify the path \'dataroot\' that locates the input data.\n\n\
     EXAMPLE USAGE\n\n\
@@ -285,10 +506,6 @@ if __name__ == "__main__":
     Reduced data will be deposited in execution directory'
 
 
-    # This needs to be set to the root for the data. 
-    dataroot = '/Users/grudnick/Code/Dragons/Tutorials/gmosls_tutorial'
-    all_files = glob.glob(dataroot + '/playdata/example1/*.fits')
-
     #print out help output
     parser = argparse.ArgumentParser(
     description=helpstr,
@@ -303,13 +520,48 @@ if __name__ == "__main__":
     parser.add_argument("--makestd", action="store_true", default=False, help="default=False; reduce standard and make sensitivity correction")
     parser.add_argument("--makesci", action="store_true", default=False, help="default=False; reduce science frames and extract 1D spectrum")
     parser.add_argument("--interactive", action="store_true", default=False, help="default=False; perform all reductions interactively")
-    parser.add_argument("--plotspec", action="store_true", default=False, help="default=False; plot spectra")
+    parser.add_argument("--plotspec", action="store_true", default=False, help="default=False; plot the standard and science products to quicklook/index.html")
+    parser.add_argument("--index", default="gmosls_index.db", help="default=gmosls_index.db; persistent header index used for file selection")
+    parser.add_argument("--manifest", default="gmosls_manifest.json", help="default=gmosls_manifest.json; record of finished stages used to skip unchanged ones")
+    parser.add_argument("--force", action="store_true", default=False, help="default=False; rerun every selected stage even if it is up to date")
+    parser.add_argument("--targets", nargs="+", default=None, help="default=all; object names of the science targets to reduce")
+    parser.add_argument("--watch", action="store_true", default=False, help="default=False; keep reducing new frames as they land in the data directory")
+    parser.add_argument("--poll", type=float, default=2.0, help="default=2; seconds between polls of the data directory in watch mode")
+    parser.add_argument("--settle", type=float, default=60.0, help="default=60; seconds without a new bias before the master bias is rebuilt in watch mode")
+    parser.add_argument("--listcals", action="store_true", default=False, help="default=False; list the content of the calibration database")
+    parser.add_argument("--mem-budget", default=None, help="default=None; memory available to the worker pool, e.g. 64G, 500M or auto")
+    parser.add_argument("--plan", nargs="?", const="gmosls_plan.json", default=None, help="default=None; write the reduction plan (default gmosls_plan.json) and stop without reducing")
+    parser.add_argument("--resume", action="store_true", default=False, help="default=False; skip the jobs that finished before an interrupted run stopped")
+    parser.add_argument("--scratch", default=None, help="default=None; fast local directory to stage the input frames in")
+    parser.add_argument("--scratch-size", default="20G", help="default=20G; space the staged input frames may use in the scratch directory")
+    parser.add_argument("--no-associate", action="store_true", default=False, help="default=False; do not pre-resolve calibrations, let each Reduce look them up")
+    parser.add_argument("--daemon", nargs="?", const="", default=None, help="default=None; run the Reduce jobs on the warm worker daemon listening on this socket")
+    parser.add_argument("--calcache", nargs="?", const="", default=None, help="default=None; reuse processed calibrations from this cross-night cache directory")
+    parser.add_argument("--calcache-max-age", type=float, default=None, help="default=30/180/365 days for bias/arc/standard; largest observing date difference of a reused calibration")
+    parser.add_argument("--calcache-size", default="10G", help="default=10G; size limit of the calibration cache")
+    parser.add_argument("--hybrid", action="store_true", default=False, help="default=False; with --interactive, only the interactive fits wait for the user while the rest runs on the pool")
+    parser.add_argument("--queue", default=None, help="default=None; publish the Reduce jobs to this shared work queue (.db file or directory) for workqueue.py workers")
+    parser.add_argument("--telemetry", default=None, help="default=None; write JSON progress events to this file or unix:PATH socket, shown by python telemetry.py")
+    parser.add_argument("--export", nargs="?", const="spectra", default=None, help="default=None; export the extracted 1D spectra to memory-mappable .npy columns in this directory (default spectra)")
+    parser.add_argument("--bias-chunk", type=chunk_size, default=0, help="default=0; stack the master biases in chunks of this many frames and combine the sub-stacks, 0 stacks all at once")
+    parser.add_argument("--jobs", type=int, default=1, help="default=1; number of worker processes for concurrent stages and per-file reductions")
+
+
+    return parser
 
 
-    args = parser.parse_args()
+if __name__ == "__main__":
+    import glob
+
+    # This needs to be set to the root for the data. 
+    dataroot = '/Users/grudnick/Code/Dragons/Tutorials/gmosls_tutorial'
+    pattern = dataroot + '/playdata/example1/*.fits'
+    all_files = glob.glob(pattern)
+
+    args = make_parser().parse_args()
 
     
-    gem_reduce(args,all_files)
+    gem_reduce(args,all_files,pattern)
 
 
     
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+#Persistent header index used by gem_reduce to select files.
+#
+#Every call to dataselect.select_data reopens and parses every FITS
+#header.  Instead we scan each file once, store its astrodata tags and the
+#descriptors the reduction uses in a small SQLite database keyed by path,
+#size and mtime, and answer all later selections from that table.  Files
+#that have not changed since the last run are never reopened.
+
+import json
+import os
+import re
+import sqlite3
+
+import fitsheader
+
+
+#descriptors stored for every file.  If this list changes the index is
+#rebuilt on the next run.
+DESCRIPTORS = (
+    'detector_roi_setting',
+    'object',
+    'observation_class',
+    'observation_type',
+    'ut_datetime',
+    'exposure_time',
+    'airmass',
+    'disperser',
+    'central_wavelength',
+    'detector_x_bin',
+    'detector_y_bin',
+    'detector_name',
+    'data_label',
+    'gain_setting',
+    'read_speed_setting',
+    'amp_read_area',
+)
+
+SCHEMA_VERSION = 1
+
+DEFAULT_INDEX = 'gmosls_index.db'
+
+#descriptors that define an instrument configuration: frames that differ
+#in any of these are never reduced together
+CONFIGURATION = ('disperser', 'central_wavelength', 'detector_roi_setting',
+                 'detector_x_bin', 'detector_y_bin')
+
+#the science frames of a target are dithered in central wavelength to fill
+#the chip gaps and the dithers are combined by one Reduce, so science is
+#grouped without it
+SCIENCE_GROUPING = ('object', 'disperser', 'detector_roi_setting',
+                    'detector_x_bin', 'detector_y_bin')
+
+
+def _jsonable(value):
+    #descriptors return numpy scalars, datetimes and lists of those
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+def group_label(values):
+    """File-name safe label for a group key, e.g. J2145+0031_B600_Full-Frame_2_2."""
+    parts = []
+    for value in values:
+        if isinstance(value, float) and value < 1e-5:
+            #central wavelength is in metres
+            value = f'{value * 1e9:.0f}nm'
+        parts.append(re.sub(r'[^A-Za-z0-9+.-]+', '-', str(value)).strip('-'))
+    return '_'.join(parts)
+
+
+def group_labels(groups):
+    """Map the group_label of every key of groups to its files.  Keys that
+    sanitise to the same label get a numbered suffix, so no group is lost.
+    """
+    labels = {}
+    for key, files in groups.items():
+        label = base = group_label(key)
+        n = 1
+        while label in labels:
+            n += 1
+            label = f'{base}-{n}'
+        if label != base:
+            print(f'WARNING group {key} has the label of another group, using {label}')
+        labels[label] = files
+    return labels
+
+
+#compressed streams cannot be seeked, so only the primary and first
+#extension headers are decompressed and the extension count comes from
+#the NEXTEND keyword
+STREAMED = ('.bz2', '.gz')
+
+
+def descriptor_values(ad, names=DESCRIPTORS):
+    """JSON-friendly values of the descriptors of an astrodata object,
+    None for those that fail."""
+    descriptors = {}
+    for name in names:
+        try:
+            descriptors[name] = _jsonable(getattr(ad, name)())
+        except Exception:
+            descriptors[name] = None
+    return descriptors
+
+
+def read_metadata(path):
+    """Classify one file and return (tags, descriptors, number of extensions).
+
+    Only the headers are read: astrodata is given header-only HDUs, so no
+    pixel array is ever loaded.  Files the header-only path cannot handle
+    are opened normally.
+    """
+    import astrodata
+    import gemini_instruments
+
+    nextn = None
+    try:
+        streamed = path.endswith(STREAMED)
+        hdulist = fitsheader.header_hdulist(path, 2 if streamed else None)
+        if streamed:
+            nextn = hdulist[0].header.get('NEXTEND')
+        ad = astrodata.open(hdulist)
+        ad.filename = path
+    except Exception:
+        ad = astrodata.open(path)
+        nextn = None
+    return sorted(ad.tags), descriptor_values(ad), nextn or len(ad)
+
+
+class FileIndex:
+    """SQLite index of tags and descriptors keyed by path, size and mtime.
+
+    index = FileIndex('gmosls_index.db')
+    index.update(all_files)
+    biasstd = index.select(['BIAS'], [], 'detector_roi_setting=="Central Spectrum"')
+    """
+
+    def __init__(self, dbfile=DEFAULT_INDEX):
+        self.dbfile = dbfile
+        self.files = []
+        self._records = {}
+        self._conn = sqlite3.connect(dbfile)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+            'tags TEXT, descriptors TEXT, nextn INTEGER)')
+
+        #throw away the cached rows if the stored descriptors changed
+        signature = json.dumps([SCHEMA_VERSION, list(DESCRIPTORS)])
+        row = self._conn.execute(
+            "SELECT value FROM info WHERE key='signature'").fetchone()
+        if row is None or row[0] != signature:
+            self._conn.execute('DELETE FROM files')
+            self._conn.execute(
+                "INSERT OR REPLACE INTO info VALUES ('signature', ?)",
+                (signature,))
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+    def _load(self, path, row, reader):
+        """Record of a file from its cached row (size, mtime_ns, tags,
+        descriptors, nextn), or from reader if the file changed.  Returns
+        (record, scanned).
+        """
+        st = os.stat(path)
+        scanned = row is None or row[0] != st.st_size or row[1] != st.st_mtime_ns
+        if scanned:
+            tags, descriptors, nextn = reader(path)
+            self._conn.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                (path, st.st_size, st.st_mtime_ns, json.dumps(tags),
+                 json.dumps(descriptors), nextn))
+        else:
+            tags, descriptors, nextn = json.loads(row[2]), json.loads(row[3]), row[4]
+        record = {
+            'path': path,
+            'tags': set(tags),
+            'descriptors': descriptors,
+            'nextn': nextn,
+        }
+        return record, scanned
+
+    def update(self, files, reader=read_metadata):
+        """Scan new or modified files and load every record into memory.
+
+        Returns the number of files that had to be opened.
+        """
+        self.files = list(files)
+        cached = {}
+        for path, size, mtime_ns, tags, descriptors, nextn in self._conn.execute(
+                'SELECT path, size, mtime_ns, tags, descriptors, nextn FROM files'):
+            cached[path] = (size, mtime_ns, tags, descriptors, nextn)
+
+        nscanned = 0
+        self._records = {}
+        for path in self.files:
+            self._records[path], scanned = self._load(path, cached.get(path), reader)
+            nscanned += scanned
+        self._conn.commit()
+        return nscanned
+
+    def add(self, files, reader=read_metadata):
+        """Add files that landed after update() without reloading the
+        rest of the index.  Returns the records of the added files.
+        """
+        records = []
+        for path in files:
+            row = self._conn.execute(
+                'SELECT size, mtime_ns, tags, descriptors, nextn FROM files '
+                'WHERE path=?', (path,)).fetchone()
+            if path not in self._records:
+                self.files.append(path)
+            self._records[path], scanned = self._load(path, row, reader)
+            records.append(self._records[path])
+        self._conn.commit()
+        return records
+
+    def record(self, path):
+        return self._records[path]
+
+    def descriptor(self, path, name):
+        return self._records[path]['descriptors'].get(name)
+
+    def group(self, files, names=('object',) + CONFIGURATION):
+        """Split files into groups sharing the values of the descriptors
+        in names, keeping the order of the files.  Returns a dict of tuple
+        of descriptor values to list of files.
+        """
+        groups = {}
+        for path in files:
+            descriptors = self._records[path]['descriptors']
+            key = tuple(descriptors.get(name) for name in names)
+            groups.setdefault(key, []).append(path)
+        return groups
+
+    def select(self, tags=[], xtags=[], expression='True'):
+        """Same semantics as dataselect.select_data, answered from the index.
+
+        The expression is written in terms of descriptor names, e.g.
+        'detector_roi_setting=="Full Frame"' or 'object=="J2145+0031"'.
+        """
+        code = compile(expression, '<select>', 'eval')
+        selected = []
+        for path in self.files:
+            rec = self._records[path]
+            if not set(tags).issubset(rec['tags']):
+                continue
+            if rec['tags'].intersection(xtags):
+                continue
+            if eval(code, {'__builtins__': {}}, dict(rec['descriptors'])):
+                selected.append(path)
+        return selected
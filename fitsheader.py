@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+#Header-only reading of FITS files for classification.
+#
+#Classifying a frame needs its tags and a few descriptors, all of which
+#come from the headers.  read_headers() returns the raw header text of the
+#primary and extension HDUs and skips the data units without reading
+#them: plain files are seeked over, compressed streams (.bz2, .gz) are
+#read only as far as the last header that is needed, and the tile
+#compressed images of .fz files are described by their uncompressed
+#image headers.  Pixel arrays are never materialized.
+
+import bz2
+import gzip
+
+
+BLOCK = 2880
+CARD = 80
+
+#binary table and compression keywords of .fz extensions, by prefix
+TABLE_KEYWORDS = ('TTYPE', 'TFORM', 'TUNIT', 'TNULL', 'TSCAL', 'TZERO',
+                  'TDIM', 'ZNAME', 'ZVAL', 'ZTILE')
+
+
+def _open(path):
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb'), False
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb'), False
+    return open(path, 'rb'), True
+
+
+def _value(card):
+    """Python value of a header card, or None for commentary cards."""
+    if card[8:10] != '= ':
+        return None
+    text = card[10:].strip()
+    if text.startswith("'"):
+        #strings end at the first quote not followed by another quote
+        i, out = 1, []
+        while i < len(text):
+            if text[i] == "'":
+                if text[i + 1:i + 2] == "'":
+                    out.append("'")
+                    i += 2
+                    continue
+                break
+            out.append(text[i])
+            i += 1
+        return ''.join(out).rstrip()
+    text = text.split('/')[0].strip()
+    if text in ('T', 'F'):
+        return text == 'T'
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text.replace('D', 'E'))
+    except ValueError:
+        return text
+
+
+def parse(header):
+    """Dictionary of keyword to value of a raw header string."""
+    values = {}
+    for i in range(0, len(header), CARD):
+        card = header[i:i + CARD]
+        key = card[:8].strip()
+        if key == 'END':
+            break
+        value = _value(card)
+        if value is not None and key not in values:
+            values[key] = value
+    return values
+
+
+def _data_size(values):
+    naxis = values.get('NAXIS', 0)
+    if not naxis:
+        return 0
+    n = 1
+    for i in range(1, naxis + 1):
+        n *= values.get(f'NAXIS{i}', 0)
+    n = abs(values.get('BITPIX', 8)) // 8 * values.get('GCOUNT', 1) * (
+        values.get('PCOUNT', 0) + n)
+    return n + (-n % BLOCK)
+
+
+def _read_header(fh):
+    """Raw text of the next header, or None at the end of the file."""
+    blocks = []
+    while True:
+        block = fh.read(BLOCK)
+        if len(block) < BLOCK:
+            return None
+        text = block.decode('ascii', errors='replace')
+        blocks.append(text)
+        for i in range(0, BLOCK, CARD):
+            if text[i:i + 8] == 'END     ':
+                return ''.join(blocks)
+
+
+def _skip(fh, nbytes, seekable):
+    if seekable:
+        fh.seek(nbytes, 1)
+        return
+    while nbytes > 0:
+        chunk = fh.read(min(nbytes, 1 << 20))
+        if not chunk:
+            return
+        nbytes -= len(chunk)
+
+
+def uncompressed_header(header, values=None):
+    """Header of the image stored in a tile-compressed (.fz) extension.
+
+    The Z keywords carry the original image keywords; the binary table
+    keywords are dropped.  Other headers are returned unchanged.
+    """
+    values = parse(header) if values is None else values
+    if not values.get('ZIMAGE'):
+        return header
+    rename = {'ZBITPIX': 'BITPIX', 'ZNAXIS': 'NAXIS', 'ZPCOUNT': 'PCOUNT',
+              'ZGCOUNT': 'GCOUNT', 'ZEXTEND': 'EXTEND'}
+    for i in range(1, values.get('ZNAXIS', 0) + 1):
+        rename[f'ZNAXIS{i}'] = f'NAXIS{i}'
+    #the result is always an image extension, so the original XTENSION or
+    #SIMPLE card (ZTENSION, ZSIMPLE) is dropped rather than restored
+    drop = {'XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'PCOUNT',
+            'GCOUNT', 'TFIELDS', 'ZIMAGE', 'ZCMPTYPE', 'ZQUANTIZ', 'ZDITHER0',
+            'ZHECKSUM', 'ZDATASUM', 'THEAP', 'ZTENSION', 'ZSIMPLE'}
+    cards = ["XTENSION= 'IMAGE   '".ljust(CARD)]
+    for i in range(0, len(header), CARD):
+        card = header[i:i + CARD]
+        key = card[:8].strip()
+        if key == 'END':
+            break
+        if key in rename:
+            card = rename[key].ljust(8) + card[8:]
+        elif key in drop or key.startswith(TABLE_KEYWORDS):
+            continue
+        cards.append(card)
+    cards.append('END'.ljust(CARD))
+    text = ''.join(cards)
+    return text + ' ' * (-len(text) % BLOCK)
+
+
+def read_headers(path, max_headers=None):
+    """Raw header strings of the primary and extension HDUs of a file.
+
+    Reading stops after max_headers headers; for compressed streams this
+    avoids decompressing the rest of the file.  Tile-compressed image
+    extensions are returned as the headers of the images they hold.
+    """
+    headers = []
+    fh, seekable = _open(path)
+    with fh:
+        while max_headers is None or len(headers) < max_headers:
+            header = _read_header(fh)
+            if header is None:
+                break
+            values = parse(header)
+            headers.append(uncompressed_header(header, values))
+            if len(headers) == max_headers:
+                #the data of the last header is not needed
+                break
+            _skip(fh, _data_size(values), seekable)
+    return headers
+
+
+def header_hdulist(path, max_headers=None):
+    """astropy HDUList of header-only HDUs, for astrodata.open."""
+    from astropy.io import fits
+
+    hdus = []
+    for i, header in enumerate(read_headers(path, max_headers)):
+        hdr = fits.Header.fromstring(header)
+        if i == 0:
+            hdus.append(fits.PrimaryHDU(header=hdr))
+        else:
+            hdus.append(fits.ImageHDU(header=hdr, name=hdr.get('EXTNAME')))
+    return fits.HDUList(hdus)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+#Split a Reduce job at the primitive that needs a human.
+#
+#With --interactive every primitive of a stage waits for the user, so the
+#flats, arcs, standard and science stages block on a person file after
+#file.  Only one primitive of each recipe actually asks for input:
+#
+#    flats      normalizeFlat
+#    arcs       determineWavelengthSolution
+#    standard   calculateSensitivity
+#    science    findApertures
+#
+#A job is run in two parts.  The batch part runs the default recipe up to
+#that primitive without interaction and writes what it has, and can run
+#on the worker pool for every file at once.  The fit part is given those
+#files, skips the primitives the batch part already ran, and runs the
+#interactive primitive and the rest of the recipe.  The fits are queued
+#and run in the main process as their batch parts finish, so the user
+#fits one file while the others are being processed.
+#
+#The recipe functions below wrap whatever recipe the recipe mapper picks
+#for the inputs; the batch and fit recipes are given to Reduce by path.
+
+import os
+
+
+#the primitive of each stage that needs a human
+INTERACTIVE_PRIMITIVES = ('normalizeFlat', 'determineWavelengthSolution',
+                          'calculateSensitivity', 'findApertures')
+
+
+class _Stop(Exception):
+    pass
+
+
+class _Split:
+    """The primitive set as seen by the wrapped recipe.
+
+    In the batch part the recipe is stopped when it reaches the primitive;
+    in the fit part every primitive before it is skipped.
+    """
+
+    def __init__(self, p, primitive, fit):
+        self._p = p
+        self._primitive = primitive
+        self._fit = fit
+        self._reached = False
+
+    def __getattr__(self, name):
+        attr = getattr(self._p, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            if name == self._primitive:
+                if not self._fit:
+                    raise _Stop
+                self._reached = True
+            elif self._fit and not self._reached:
+                #already run by the batch part
+                return None
+            return attr(*args, **kwargs)
+        return call
+
+
+def _run(p, primitive, fit):
+    from recipe_system.mappers.recipeMapper import RecipeMapper
+
+    recipe = RecipeMapper(p.streams['main'], mode=p.mode).get_applicable_recipe()
+    split = _Split(p, primitive, fit)
+    try:
+        recipe(split)
+    except _Stop:
+        #the fit part starts from here
+        p.writeOutputs()
+        return
+    if fit and not split._reached:
+        raise RuntimeError(f'recipe {recipe.__name__} never calls {primitive}')
+
+
+def run_until(p, primitive):
+    """Run the default recipe of the inputs up to primitive and write them."""
+    _run(p, primitive, False)
+
+
+def _recipe(primitive, fit):
+    def recipe(p):
+        _run(p, primitive, fit)
+    recipe.__name__ = ('fit_' if fit else 'batch_') + primitive
+    return recipe
+
+
+batch_normalizeFlat = _recipe('normalizeFlat', False)
+fit_normalizeFlat = _recipe('normalizeFlat', True)
+batch_determineWavelengthSolution = _recipe('determineWavelengthSolution', False)
+fit_determineWavelengthSolution = _recipe('determineWavelengthSolution', True)
+batch_calculateSensitivity = _recipe('calculateSensitivity', False)
+fit_calculateSensitivity = _recipe('calculateSensitivity', True)
+batch_findApertures = _recipe('findApertures', False)
+fit_findApertures = _recipe('findApertures', True)
+
+
+def recipe_name(part, primitive):
+    """Recipe for Reduce.recipename, given by path to this module."""
+    module = os.path.splitext(os.path.abspath(__file__))[0]
+    return f'{module}.{part}_{primitive}'
+
+
+def batch_uparms(uparms):
+    """uparms without the interactive switches."""
+    return {k: v for k, v in uparms.items()
+            if k != 'interactive' and not k.endswith(':interactive')}
+
+
+def batch_job(job, primitive):
+    """The part of a job that runs without the user."""
+    return dict(job, name=job['name'] + '_batch',
+                uparms=batch_uparms(job.get('uparms') or {}),
+                recipename=recipe_name('batch', primitive))
+
+
+def fit_job(job, primitive, files):
+    """The interactive rest of a job, on the files its batch part wrote."""
+    #the inputs were counted with the batch part
+    return dict(job, name=job['name'] + '_fit', files=list(files),
+                recipename=recipe_name('fit', primitive), nfiles=0)
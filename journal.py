@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+#Per-job checkpoints so an interrupted run can resume where it stopped.
+#
+#The manifest only learns about a stage once all of its jobs have
+#finished, so a run killed halfway through the arcs or the science
+#targets used to redo every file of that stage.  The journal records when
+#each Reduce job of a stage starts and, once it has finished, the outputs
+#it wrote with their size, mtime and checksum.  Lines are appended and
+#flushed to disk one at a time, so a crash loses at most the line being
+#written.
+#
+#With --resume, a stage whose fingerprint is unchanged skips the jobs whose
+#outputs are still on disk untouched.  Files written by a job that started
+#but never finished are incomplete and are moved aside (and removed from
+#the calibration database) before the job runs again.
+
+import glob
+import json
+import os
+import shutil
+import threading
+import time
+
+from manifest import DEFAULT_MANIFEST, file_checksum
+
+
+def journal_path(manifest_file=DEFAULT_MANIFEST):
+    """Journal kept next to a manifest."""
+    return os.path.splitext(manifest_file)[0] + '_journal.jsonl'
+
+
+def _stat(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns, file_checksum(path)]
+
+
+def _unchanged(path, stat):
+    if not os.path.exists(path):
+        return False
+    st = os.stat(path)
+    if st.st_size == stat[0] and st.st_mtime_ns == stat[1]:
+        return True
+    return st.st_size == stat[0] and file_checksum(path) == stat[2]
+
+
+class Journal:
+    """Append-only record of the jobs started and finished in each stage.
+
+    stages maps a stage name to {'fingerprint': ..., 'jobs': {name: entry}}
+    where entry holds the 'start' time and, once finished, the 'outputs'.
+    """
+
+    def __init__(self, filename=None, partialdir='reduce_work/partial'):
+        self.filename = filename = filename or journal_path()
+        self.partialdir = partialdir
+        self.stages = {}
+        self._lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename) as fh:
+                for line in fh:
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        #the last line of a killed run may be cut short
+                        break
+        #rewrite it compacted, so the file does not grow run after run
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as fh:
+            for name, stage in self.stages.items():
+                fh.write(json.dumps({'event': 'begin', 'stage': name,
+                                     'fingerprint': stage['fingerprint']}) + '\n')
+                for job, entry in stage['jobs'].items():
+                    fh.write(json.dumps(dict(entry, event='job', stage=name,
+                                             job=job)) + '\n')
+        os.replace(tmp, filename)
+
+    def _apply(self, event):
+        kind, name = event['event'], event['stage']
+        if kind == 'begin':
+            self.stages[name] = {'fingerprint': event['fingerprint'], 'jobs': {}}
+        elif kind == 'finish':
+            self.stages.pop(name, None)
+        elif name in self.stages:
+            entry = {k: v for k, v in event.items() if k not in ('event', 'stage', 'job')}
+            self.stages[name]['jobs'].setdefault(event['job'], {}).update(entry)
+
+    def _append(self, event):
+        with self._lock:
+            self._apply(event)
+            with open(self.filename, 'a') as fh:
+                fh.write(json.dumps(event) + '\n')
+                fh.flush()
+                os.fsync(fh.fileno())
+
+    def begin(self, stage, fingerprint):
+        """Start a stage from scratch, forgetting earlier checkpoints."""
+        self._append({'event': 'begin', 'stage': stage, 'fingerprint': fingerprint})
+
+    def start(self, job):
+        self._append({'event': 'job', 'stage': job['stage'], 'job': job['name'],
+                      'start': time.time()})
+
+    def done(self, job, outputs, calibrations=()):
+        """Checkpoint a finished job with the files it wrote."""
+        self._append({'event': 'job', 'stage': job['stage'], 'job': job['name'],
+                      'outputs': {os.path.abspath(f): _stat(f) for f in outputs},
+                      'calibrations': {os.path.abspath(f): _stat(f)
+                                       for f in calibrations}})
+
+    def finish(self, stage):
+        """The stage is complete and recorded in the manifest."""
+        self._append({'event': 'finish', 'stage': stage})
+
+    def _owned(self):
+        #names of the files recorded by finished jobs.  Calibrations are
+        #copies of an output under calibrations/ with the same name.
+        owned = set()
+        for stage in self.stages.values():
+            for entry in stage['jobs'].values():
+                owned.update(os.path.basename(f) for f in entry.get('outputs', {}))
+                owned.update(os.path.basename(f) for f in entry.get('calibrations', {}))
+        return owned
+
+    def discard_partial(self, stage, job, caldb=None, owned=(), destdir='.'):
+        """Move aside the FITS files an unfinished job left in destdir.
+
+        Anything written since the job started that neither a finished job
+        nor owned (the outputs of finished stages) claims is taken to be
+        incomplete.  Returns the moved files.
+        """
+        entry = self.stages[stage]['jobs'][job]
+        candidates = (glob.glob(os.path.join(destdir, '*.fits'))
+                      + glob.glob(os.path.join(destdir, 'calibrations', '*', '*.fits')))
+        owned = self._owned() | {os.path.basename(f) for f in owned}
+        moved = []
+        for path in candidates:
+            path = os.path.abspath(path)
+            if os.path.basename(path) in owned or os.stat(path).st_mtime < entry['start']:
+                continue
+            if caldb is not None and os.sep + 'calibrations' + os.sep in path:
+                try:
+                    caldb.remove_cal(path)
+                except Exception:
+                    pass
+            dest = os.path.join(self.partialdir, job)
+            os.makedirs(dest, exist_ok=True)
+            shutil.move(path, os.path.join(dest, os.path.basename(path)))
+            moved.append(path)
+        return moved
+
+    def resume(self, stage, fingerprint, jobs, caldb=None, owned=()):
+        """Outputs of the jobs of a stage that need not run again.
+
+        Checkpoints are only trusted if the stage fingerprint is the one
+        they were written under and every output is still unchanged on
+        disk.  Jobs that started but did not finish have their partial
+        products discarded; files in owned, the outputs of finished stages,
+        are kept.  Returns a dict of job name to outputs.
+        """
+        rec = self.stages.get(stage)
+        if rec is None or rec['fingerprint'] != fingerprint:
+            self.begin(stage, fingerprint)
+            return {}
+        finished = {}
+        for job in jobs:
+            entry = rec['jobs'].get(job['name'])
+            if entry is None:
+                continue
+            files = dict(entry.get('outputs', {}), **entry.get('calibrations', {}))
+            if 'outputs' in entry and all(_unchanged(f, s) for f, s in files.items()):
+                finished[job['name']] = list(entry['outputs'])
+                continue
+            if 'outputs' in entry:
+                print(f"{job['name']}: outputs changed since it finished, rerunning")
+                entry.pop('outputs')
+                entry.pop('calibrations', None)
+            if 'start' in entry:
+                for path in self.discard_partial(stage, job['name'], caldb, owned):
+                    print(f"{job['name']} did not finish, moved {path} to {self.partialdir}")
+        return finished
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+#Make-style bookkeeping so reruns only redo stages whose inputs changed.
+#
+#For every stage that finishes the manifest records a fingerprint built
+#from the input file list, the checksum of every input, the uparms, the
+#recipe, the DRAGONS version and the fingerprints of the stages that
+#produced the calibrations it used, together with checksums of the
+#outputs.  On the next run a stage is skipped when its fingerprint is
+#unchanged and its outputs are still on disk untouched.  A stage that has
+#to run invalidates everything downstream of it.
+
+import hashlib
+import json
+import os
+import time
+
+
+DEFAULT_MANIFEST = 'gmosls_manifest.json'
+
+
+def dragons_version():
+    try:
+        import astrodata
+        return str(astrodata.__version__)
+    except (ImportError, AttributeError):
+        return 'unknown'
+
+
+def file_checksum(path, blocksize=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Manifest:
+    """Stage fingerprints and output checksums stored as JSON."""
+
+    def __init__(self, filename=DEFAULT_MANIFEST):
+        self.filename = filename
+        self._version = None
+        self.stages = {}
+        self._checksums = {}
+        if os.path.exists(filename):
+            with open(filename) as fh:
+                content = json.load(fh)
+            self.stages = content.get('stages', {})
+            self._checksums = content.get('checksums', {})
+
+    @property
+    def version(self):
+        #importing astrodata is slow, only do it once a stage is fingerprinted
+        if self._version is None:
+            self._version = dragons_version()
+        return self._version
+
+    def save(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump({'stages': self.stages, 'checksums': self._checksums},
+                      fh, indent=1, sort_keys=True)
+        os.replace(tmp, self.filename)
+
+    def checksum(self, path):
+        """Checksum of a file, only recomputed when its size or mtime change."""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        cached = self._checksums.get(path)
+        if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached[2]
+        value = file_checksum(path)
+        self._checksums[path] = [st.st_size, st.st_mtime_ns, value]
+        return value
+
+    def fingerprint(self, stage, upstream=()):
+        """Hash of everything that determines the products of a stage."""
+        inputs = sorted(os.path.abspath(f) for f in stage.files)
+        content = {
+            'files': inputs,
+            'checksums': [self.checksum(f) for f in inputs],
+            'uparms': sorted((str(k), str(v)) for k, v in stage.uparms.items()),
+            'recipename': stage.recipename,
+            'dragons': self.version,
+            'upstream': sorted(upstream),
+        }
+        return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def providers(self, caltype):
+        """Recorded stages that produced a calibration type."""
+        return [name for name, rec in self.stages.items()
+                if caltype in rec.get('provides', [])]
+
+    def is_current(self, name, fingerprint):
+        """True if the stage last finished with this fingerprint and all of
+        its outputs are still on disk with the recorded checksums.
+        """
+        rec = self.stages.get(name)
+        if rec is None or rec['fingerprint'] != fingerprint:
+            return False
+        for path, value in rec['outputs'].items():
+            if not os.path.exists(path) or self.checksum(path) != value:
+                return False
+        return True
+
+    def outputs(self, name):
+        return list(self.stages[name]['outputs'])
+
+    def record(self, stage, fingerprint, outputs):
+        self.stages[stage.name] = {
+            'fingerprint': fingerprint,
+            'files': sorted(os.path.abspath(f) for f in stage.files),
+            'uparms': {str(k): str(v) for k, v in stage.uparms.items()},
+            'provides': list(stage.provides),
+            'dragons': self.version,
+            'outputs': {os.path.abspath(f): self.checksum(f) for f in outputs},
+            'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        self.save()
+
+    def invalidate(self, name):
+        if self.stages.pop(name, None) is not None:
+            self.save()
+
+
+def plan_stale(stages, graph, manifest):
+    """Decide which stages have to run.
+
+    Returns (fingerprints, stale) where fingerprints maps stage name to its
+    current fingerprint and stale is the set of stages that must run:
+    those whose fingerprint or outputs changed and everything downstream.
+    The stages must be given in topological order.
+    """
+    fingerprints = {}
+    stale = set()
+    scheduled = {s.name for s in stages}
+    for stage in stages:
+        #scheduled stages contribute their new fingerprint, stages that are
+        #not part of this run the one recorded when they last finished
+        upstream = {fingerprints[name] for name in graph[stage.name]}
+        for caltype in stage.needs:
+            for name in manifest.providers(caltype):
+                if name not in scheduled and name != stage.name:
+                    upstream.add(manifest.stages[name]['fingerprint'])
+        fp = manifest.fingerprint(stage, upstream)
+        fingerprints[stage.name] = fp
+        if graph[stage.name] & stale or not manifest.is_current(stage.name, fp):
+            stale.add(stage.name)
+    return fingerprints, stale
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+#Memory-aware admission of Reduce jobs on the worker pool.
+#
+#Full Frame and Central Spectrum frames, and stacked and single-frame
+#jobs, need very different amounts of memory once Reduce has loaded them.
+#The peak of a job is estimated from the frame geometry in the header
+#index (ROI, binning, number of extensions) and the number of frames it
+#stacks, and the pool only starts a job while the estimates of the
+#running jobs plus the new one fit in the budget.
+
+import os
+import re
+import threading
+
+
+#unbinned pixels read out for the GMOS ROIs, including overscan
+#(Hamamatsu: 3 CCDs x 4 amplifiers of 512+overscan columns).  The Central
+#Stamp is 300x300 pixels in the middle of CCD2, read by the two amplifiers
+#it straddles.
+ROI_PIXELS = {
+    'Full Frame': 6336 * 4224,
+    'Central Spectrum': 6336 * 1024,
+    'Central Stamp': (300 + 2 * 16) * 300,
+}
+
+#SCI and VAR as float32 plus DQ as uint16
+BYTES_PER_PIXEL = 4 + 4 + 2
+
+#full-size copies held at once while a single frame is processed, and
+#overhead of a Reduce process with DRAGONS imported
+WORK_COPIES = 3
+BASE_BYTES = 600 * 1024 ** 2
+EXTENSION_BYTES = 2 * 1024 ** 2
+
+GB = 1024.0 ** 3
+
+
+def parse_size(text):
+    """'64G', '500M', '2.5' (GB) or 'auto' (80% of physical memory) to bytes."""
+    if text is None:
+        return None
+    text = str(text).strip()
+    if text.lower() == 'auto':
+        return int(0.8 * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'))
+    match = re.fullmatch(r'([0-9.]+)\s*([KMGT]?)B?', text, re.IGNORECASE)
+    if match is None:
+        raise ValueError(f'cannot parse memory size {text!r}')
+    scale = {'': GB, 'K': 1024, 'M': 1024 ** 2, 'G': GB, 'T': 1024 * GB}
+    return int(float(match.group(1)) * scale[match.group(2).upper()])
+
+
+def frame_bytes(descriptors, nextn):
+    """Memory of one frame once loaded with VAR and DQ planes."""
+    pixels = ROI_PIXELS.get(descriptors.get('detector_roi_setting'),
+                            ROI_PIXELS['Full Frame'])
+    xbin = descriptors.get('detector_x_bin') or 1
+    ybin = descriptors.get('detector_y_bin') or 1
+    return pixels // (xbin * ybin) * BYTES_PER_PIXEL + (nextn or 1) * EXTENSION_BYTES
+
+
+class MemoryEstimator:
+    """Peak memory estimate of a job from the header index.
+
+    A job with several inputs stacks them, so all of its frames are held
+    at once; a single-frame job needs a few working copies of its frame.
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    def __call__(self, job):
+        sizes = []
+        for path in job['files']:
+            try:
+                rec = self.index.record(path)
+            except KeyError:
+                #an intermediate product, e.g. a bias sub-stack, is not in
+                #the index; its planes are already float, so twice its size
+                sizes.append(2 * os.path.getsize(path) if os.path.exists(path) else 0)
+                continue
+            sizes.append(frame_bytes(rec['descriptors'], rec['nextn']))
+        if not sizes:
+            return BASE_BYTES
+        return BASE_BYTES + sum(sizes) + (WORK_COPIES - 1) * max(sizes)
+
+
+class MemoryGate:
+    """Admit jobs while the sum of their estimates fits in the budget.
+
+    A job larger than the whole budget is admitted only when nothing else
+    is running, so it can never wait forever.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        self.running = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes):
+        with self._cond:
+            if nbytes > self.budget:
+                print(f'job needs ~{nbytes / GB:.1f} GB, more than the '
+                      f'{self.budget / GB:.1f} GB budget; running it alone')
+            while self.running and self.used + nbytes > self.budget:
+                self._cond.wait()
+            self.used += nbytes
+            self.running += 1
+
+    def release(self, nbytes):
+        with self._cond:
+            self.used -= nbytes
+            self.running -= 1
+            self._cond.notify_all()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+#Run independent Reduce jobs on a process pool.
+#
+#Flats and arcs are reduced one file at a time and never interact with
+#each other, so they can be split into one Reduce per file.  Each worker
+#runs in its own working directory with its own log and reads, but never
+#writes, the local calibration database.  When the pool is done the
+#products are moved back to the execution directory and registered in the
+#calibration database from the parent process, so there is only ever one
+#writer.
+
+import functools
+import glob
+import os
+import shutil
+import socket
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from membudget import GB, MemoryGate
+from profiling import measure
+from telemetry import nfiles, traced
+from warmpool import DaemonExecutor, pool_context
+from workqueue import QueueExecutor
+
+
+WORKROOT = 'reduce_work'
+
+#products from concurrent stages are merged one at a time
+_merge_lock = threading.Lock()
+
+
+def database_path(caldb):
+    """Location on disk of the local calibration database."""
+    return os.path.abspath(os.path.expanduser(caldb.dbfile))
+
+
+def make_jobs(stage, files, uparms=None, recipename=None):
+    """One job per input file for stages that do not stack their inputs."""
+    jobs = []
+    for i, f in enumerate(files):
+        name = f'{stage}_{i:04d}_' + os.path.basename(f).split('.')[0]
+        jobs.append({
+            'name': name,
+            'stage': stage,
+            'files': [f],
+            'uparms': dict(uparms or {}),
+            'recipename': recipename,
+        })
+    return jobs
+
+
+def run_inline(job):
+    """Run a job with Reduce in this process and the current directory."""
+    from recipe_system.reduction.coreReduce import Reduce
+
+    reduce_job = Reduce()
+    reduce_job.files.extend(job['files'])
+    if job.get('uparms'):
+        reduce_job.uparms = dict(job['uparms'])
+    if job.get('ucals'):
+        reduce_job.ucals = dict(job['ucals'])
+    if job.get('recipename'):
+        reduce_job.recipename = job['recipename']
+    reduce_job.runr()
+    return list(reduce_job.output_filenames)
+
+
+def _write_config(workdir, dbfile):
+    #read-only view of the shared calibration database for this worker
+    config = os.path.join(workdir, 'dragonsrc')
+    with open(config, 'w') as fh:
+        fh.write('[calibs]\n')
+        fh.write(f'databases = {dbfile} get\n')
+    return config
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def attempt_workdir(workroot, name):
+    """Working directory of this attempt at job name, <name>.<host>.<pid>.
+
+    A job requeued from a worker that stopped responding may still be
+    running in the directory of its earlier attempt, so every worker
+    process has its own.  Those left on this host by processes that are
+    gone are removed.
+    """
+    host = socket.gethostname()
+    prefix = glob.escape(os.path.join(workroot, f'{name}.{host}.'))
+    for old in glob.glob(prefix + '*'):
+        pid = old.rsplit('.', 1)[-1]
+        if pid.isdigit() and int(pid) != os.getpid() and not _alive(int(pid)):
+            shutil.rmtree(old, ignore_errors=True)
+    return os.path.abspath(os.path.join(workroot, f'{name}.{host}.{os.getpid()}'))
+
+
+def run_job(job, dbfile, workroot=WORKROOT):
+    """Run a single Reduce in a private working directory.
+
+    This is executed in the worker process.  Nothing is raised back to the
+    parent; failures are reported in the returned dictionary.
+    """
+    workdir = attempt_workdir(workroot, job['name'])
+    if os.path.isdir(workdir):
+        shutil.rmtree(workdir)
+    os.makedirs(workdir)
+    os.chdir(workdir)
+
+    result = {'name': job['name'], 'stage': job['stage'], 'files': job['files'],
+              'workdir': workdir, 'log': os.path.join(workdir, job['name'] + '.log'),
+              'outputs': [], 'calibrations': [], 'ok': False, 'error': None}
+    with measure(job['stage'], job['name'], job['files']) as m:
+        try:
+            from recipe_system.reduction.coreReduce import Reduce
+            from gempy.utils import logutils
+
+            logutils.config(file_name=result['log'])
+
+            reduce_job = Reduce()
+            reduce_job.config_file = _write_config(workdir, dbfile)
+            reduce_job.files.extend(job['files'])
+            if job.get('uparms'):
+                reduce_job.uparms = dict(job['uparms'])
+            if job.get('ucals'):
+                reduce_job.ucals = dict(job['ucals'])
+            if job.get('recipename'):
+                reduce_job.recipename = job['recipename']
+            reduce_job.runr()
+
+            result['outputs'] = [os.path.abspath(f) for f in reduce_job.output_filenames]
+            result['calibrations'] = sorted(
+                glob.glob(os.path.join(workdir, 'calibrations', '*', '*.fits')))
+            result['ok'] = True
+        except Exception:
+            result['error'] = traceback.format_exc()
+    m.record['ok'] = result['ok']
+    result['metrics'] = m.record
+    return result
+
+
+def merge_result(result, caldb, destdir='.'):
+    """Move a worker's products into destdir and register its calibrations."""
+    with _merge_lock:
+        outputs = []
+        for f in result['outputs']:
+            dest = os.path.join(destdir, os.path.basename(f))
+            shutil.move(f, dest)
+            outputs.append(dest)
+
+        calibrations = []
+        for f in result['calibrations']:
+            subdir = os.path.join(destdir, 'calibrations',
+                                  os.path.basename(os.path.dirname(f)))
+            os.makedirs(subdir, exist_ok=True)
+            dest = os.path.join(subdir, os.path.basename(f))
+            shutil.move(f, dest)
+            calibrations.append(dest)
+        if caldb is not None:
+            #the database takes one filename per call
+            for f in calibrations:
+                caldb.add_cal(f)
+
+    result['outputs'] = outputs
+    result['calibrations'] = calibrations
+    return result
+
+
+class JobPool:
+    """A process pool shared by every stage of a run.
+
+    run() may be called from several threads at once; the pool size is the
+    limit on the number of Reduce jobs running at the same time.  With a
+    memory budget (bytes) and an estimator (job -> bytes) a job is only
+    started while the estimates of the running jobs plus its own fit.  With
+    a stager the workers read local scratch copies of their inputs.
+
+    The workers are forked from a server that has imported DRAGONS, and
+    with daemon (a socket address) the jobs are sent to a running
+    warmpool.py daemon instead.  With queue (see workqueue.py) they are
+    published to a shared work queue for workers on other hosts.
+
+    With telemetry (see telemetry.py) every job is reported as it is
+    queued, starts in its worker and finishes, with the jobs in flight.
+    """
+
+    def __init__(self, caldb, njobs, workroot=WORKROOT, profiler=None,
+                 worker=None, mem_budget=None, estimator=None, stager=None,
+                 daemon=None, queue=None, telemetry=None):
+        self.caldb = caldb
+        self.telemetry = telemetry
+        self._inflight = 0
+        self._lock = threading.Lock()
+        self.njobs = njobs
+        self.profiler = profiler
+        self.worker = worker or run_job
+        self.estimator = estimator
+        self.stager = stager
+        self.gate = MemoryGate(mem_budget) if mem_budget and estimator else None
+        self.dbfile = database_path(caldb) if caldb is not None else None
+        self.workroot = os.path.abspath(workroot)
+        if queue is not None:
+            self._executor = QueueExecutor(queue)
+        elif daemon is not None:
+            self._executor = DaemonExecutor(daemon, njobs)
+        else:
+            self._executor = ProcessPoolExecutor(max_workers=njobs,
+                                                 mp_context=pool_context())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+    def _emit_queue(self, change):
+        #jobs submitted by every stage and not finished yet
+        with self._lock:
+            self._inflight += change
+            inflight = self._inflight
+        self.telemetry.emit('queue', inflight=inflight, workers=self.njobs)
+
+    def run(self, jobs, journal=None, on_done=None):
+        """Run jobs, merge their products and return the output filenames
+        in the order of the jobs.  Raises RuntimeError listing the failed
+        jobs and their logs if any failed.  A journal, if given, checkpoints
+        every job as it starts and once its products are merged, and
+        on_done(job, outputs) is called for every job that succeeded.
+        """
+        results = {}
+        futures = {}
+        byname = {job['name']: job for job in jobs}
+        worker = self.worker
+        if self.telemetry is not None:
+            #the worker announces the job when it actually starts
+            worker = functools.partial(traced, self.telemetry.target,
+                                       self.telemetry.run, self.worker)
+        for job in jobs:
+            nbytes = 0
+            if self.gate is not None:
+                nbytes = self.estimator(job)
+                self.gate.acquire(nbytes)
+                print(f"starting {job['name']}, estimated {nbytes / GB:.1f} GB, "
+                      f"{self.gate.used / GB:.1f} of {self.gate.budget / GB:.1f} GB in use")
+            if journal is not None:
+                journal.start(job)
+            staged = job
+            if self.stager is not None:
+                staged = dict(job, files=self.stager.acquire(job['files']))
+            future = self._executor.submit(worker, staged, self.dbfile, self.workroot)
+            if self.gate is not None:
+                future.add_done_callback(lambda f, n=nbytes: self.gate.release(n))
+            if self.stager is not None:
+                future.add_done_callback(
+                    lambda f, files=job['files']: self.stager.release(files))
+            futures[future] = job['name']
+            if self.telemetry is not None:
+                self.telemetry.emit('job_queued', stage=job['stage'], job=job['name'],
+                                    nfiles=nfiles(job))
+                self._emit_queue(1)
+        for future in as_completed(futures):
+            result = future.result()
+            if self.telemetry is not None:
+                metrics = result.get('metrics') or {}
+                self.telemetry.emit('job_done', stage=result['stage'], job=result['name'],
+                                    nfiles=nfiles(byname[result['name']]), ok=result['ok'],
+                                    wall_s=metrics.get('wall_s'))
+                self._emit_queue(-1)
+            if self.profiler is not None:
+                self.profiler.add(result['metrics'])
+            if result['ok']:
+                merge_result(result, self.caldb)
+                if journal is not None:
+                    journal.done(byname[result['name']], result['outputs'],
+                                 result['calibrations'])
+                if on_done is not None:
+                    on_done(byname[result['name']], result['outputs'])
+                print(f"finished {result['name']}: {result['outputs']}")
+            else:
+                print(f"FAILED {result['name']}, see {result['log']}")
+            results[result['name']] = result
+
+        failed = [r for r in results.values() if not r['ok']]
+        if failed:
+            msg = '\n'.join(f"{r['name']} ({r['log']}):\n{r['error']}" for r in failed)
+            raise RuntimeError(f'{len(failed)} of {len(jobs)} Reduce jobs failed\n' + msg)
+
+        outputs = []
+        for job in jobs:
+            outputs.extend(results[job['name']]['outputs'])
+        return outputs
+
+
+def run_parallel(jobs, caldb, njobs, workroot=WORKROOT):
+    """Run jobs on a pool of njobs processes and merge their products."""
+    with JobPool(caldb, njobs, workroot) as pool:
+        return pool.run(jobs)
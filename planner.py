@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+#Dry-run plan of a gem_reduce run.
+#
+#Without running Reduce, the planner lists the stages that would run (from
+#the manifest) and the Reduce jobs of each.  For every job it resolves the
+#calibrations the job will use: produced by a stage of this run, found in
+#the local calibration database, or missing.  It estimates the runtime of
+#each job from the timings of earlier runs (<log>_profile.json) and its
+#memory from the frame geometry, and simulates the worker pool to
+#estimate the wall time of the whole run.  Missing calibrations show up
+#in seconds instead of hours into the reduction.
+
+import json
+import os
+
+import fitsheader
+from fileindex import CONFIGURATION
+from manifest import plan_stale
+from membudget import GB
+from scheduler import build_graph, topological_order
+
+
+#descriptors that must agree between a frame and the calibration it uses.
+#These approximate the association rules of the calibration manager and
+#are only used to decide which stage of this run will provide a match.
+MATCH = {
+    'processed_bias': ('detector_roi_setting', 'detector_x_bin', 'detector_y_bin',
+                       'gain_setting', 'read_speed_setting', 'amp_read_area'),
+    'processed_flat': CONFIGURATION,
+    'processed_arc': CONFIGURATION,
+    'processed_standard': ('disperser', 'detector_x_bin'),
+}
+
+
+def load_history(profile):
+    """Mean wall seconds per input file of each stage in an earlier run."""
+    if not profile or not os.path.exists(profile):
+        return {}
+    with open(profile) as fh:
+        records = json.load(fh)
+    totals = {}
+    for rec in records:
+        if rec['level'] != 'job' or not rec['ok'] or not rec['nfiles']:
+            continue
+        seconds, nfiles = totals.get(rec['stage'], (0.0, 0))
+        totals[rec['stage']] = (seconds + rec['wall_s'], nfiles + rec['nfiles'])
+    return {stage: seconds / nfiles for stage, (seconds, nfiles) in totals.items()}
+
+
+def simulate(order, graph, durations, njobs):
+    """Wall time of running the stages on njobs workers.
+
+    durations maps a stage name to the runtimes of its jobs.  Jobs are
+    placed longest first on the worker that frees up first, and a stage
+    starts once the stages it depends on have finished.
+    """
+    slots = [0.0] * max(1, njobs)
+    finish = {}
+    for name in order:
+        ready = max([finish[d] for d in graph[name]] or [0.0])
+        end = ready
+        for duration in sorted(durations.get(name, []), reverse=True):
+            i = slots.index(min(slots))
+            slots[i] = max(slots[i], ready) + duration
+            end = max(end, slots[i])
+        finish[name] = end
+    return max(finish.values() or [0.0])
+
+
+class Planner:
+    """Build the plan of a run from its stages without running Reduce."""
+
+    def __init__(self, stages, index, caldb=None, manifest=None, history=None,
+                 njobs=1, estimator=None, force=False):
+        self.stages = [s for s in stages if s.files]
+        self.index = index
+        self.caldb = caldb
+        self.manifest = manifest
+        self.history = history or {}
+        self.njobs = njobs
+        self.estimator = estimator
+        self.force = force
+        self.graph = build_graph(self.stages)
+        self._lookups = {}
+
+    def _provider(self, stage, caltype, path):
+        #a stage of this run whose inputs match the frame for this caltype
+        keys = MATCH.get(caltype, ())
+        want = [self.index.descriptor(path, k) for k in keys]
+        for name in sorted(self.graph[stage.name]):
+            other = next(s for s in self.stages if s.name == name)
+            if caltype not in other.provides:
+                continue
+            for f in other.files:
+                if [self.index.descriptor(f, k) for k in keys] == want:
+                    return name
+        return None
+
+    def _lookup(self, caltype, path):
+        #best match in the calibration database, as the primitives would get it
+        if self.caldb is None:
+            return None, 'no calibration database'
+        key = (caltype, path)
+        if key not in self._lookups:
+            try:
+                import astrodata
+                import gemini_instruments
+
+                ad = astrodata.open(fitsheader.header_hdulist(path))
+                ad.filename = path
+                cals = self.caldb.get_calibrations([ad], caltype=caltype)
+                files = [f for f in cals.files if f]
+                self._lookups[key] = (files[0] if files else None, None)
+            except Exception as err:
+                self._lookups[key] = (None, f'lookup failed: {err}')
+        return self._lookups[key]
+
+    def resolve(self, stage, job):
+        """Where each calibration of a job comes from."""
+        path = job['files'][0]
+        calibrations = {}
+        for caltype in stage.needs:
+            provider = self._provider(stage, caltype, path)
+            if provider is not None:
+                calibrations[caltype] = {'source': 'stage', 'stage': provider}
+                continue
+            found, error = self._lookup(caltype, path)
+            if found:
+                calibrations[caltype] = {'source': 'caldb', 'file': found}
+            else:
+                calibrations[caltype] = {'source': 'missing', 'error': error}
+        return calibrations
+
+    def plan(self):
+        order = topological_order(self.stages, self.graph)
+        stale = {s.name for s in order}
+        if self.manifest is not None and not self.force:
+            fingerprints, stale = plan_stale(order, self.graph, self.manifest)
+
+        plan = {'njobs': self.njobs, 'stages': [], 'missing': []}
+        durations = {}
+        for stage in order:
+            entry = {
+                'name': stage.name,
+                'status': 'run' if stage.name in stale else 'up to date',
+                'needs': stage.needs,
+                'provides': stage.provides,
+                'depends_on': sorted(self.graph[stage.name]),
+                'jobs': [],
+            }
+            per_file = self.history.get(stage.name)
+            for job in stage.jobs():
+                item = {
+                    'name': job['name'],
+                    'files': job['files'],
+                    'est_seconds': per_file * len(job['files']) if per_file else None,
+                    'est_mem_gb': (round(self.estimator(job) / GB, 2)
+                                   if self.estimator else None),
+                    'calibrations': self.resolve(stage, job),
+                }
+                for caltype, cal in item['calibrations'].items():
+                    if cal['source'] == 'missing':
+                        plan['missing'].append(
+                            {'job': job['name'], 'caltype': caltype,
+                             'file': job['files'][0]})
+                entry['jobs'].append(item)
+            if entry['status'] == 'run':
+                durations[stage.name] = [j['est_seconds'] or 0.0 for j in entry['jobs']]
+            known = [j['est_seconds'] for j in entry['jobs'] if j['est_seconds'] is not None]
+            entry['est_seconds'] = sum(known) if known else None
+            plan['stages'].append(entry)
+
+        plan['est_serial_seconds'] = sum(sum(d) for d in durations.values())
+        plan['est_wall_seconds'] = simulate([s.name for s in order], self.graph,
+                                            durations, self.njobs)
+        return plan
+
+
+def plan_text(plan):
+    """Human readable summary of a plan."""
+    lines = []
+    for stage in plan['stages']:
+        est = stage['est_seconds']
+        est = f'{est / 60:.1f} min' if est is not None else 'no timing history'
+        mem = [j['est_mem_gb'] for j in stage['jobs'] if j['est_mem_gb'] is not None]
+        mem = f', up to {max(mem):.1f} GB per job' if mem else ''
+        lines.append(f"{stage['name']:<10} {stage['status']:<10} "
+                     f"{len(stage['jobs'])} jobs, {est}{mem}")
+        if stage['depends_on']:
+            lines.append(f"           after {', '.join(stage['depends_on'])}")
+        for job in stage['jobs']:
+            for caltype, cal in job['calibrations'].items():
+                if cal['source'] == 'stage':
+                    where = f"from stage {cal['stage']}"
+                elif cal['source'] == 'caldb':
+                    where = os.path.basename(cal['file'])
+                else:
+                    where = 'MISSING' + (f" ({cal['error']})" if cal['error'] else '')
+                lines.append(f"           {job['name']}: {caltype} {where}")
+    lines.append(f"estimated time: {plan['est_serial_seconds'] / 60:.1f} min serial, "
+                 f"{plan['est_wall_seconds'] / 60:.1f} min on {plan['njobs']} workers")
+    if plan['missing']:
+        lines.append(f"{len(plan['missing'])} MISSING calibrations:")
+        for m in plan['missing']:
+            lines.append(f"    {m['job']} needs {m['caltype']} for "
+                         f"{os.path.basename(m['file'])}")
+    else:
+        lines.append('all calibrations resolved')
+    return '\n'.join(lines)
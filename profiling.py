@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+#Wall time, CPU time, peak memory and I/O of every stage and Reduce job.
+#
+#Each Reduce job is measured in the process that runs it, so the numbers
+#for jobs on the worker pool are those of the worker.  A stage record
+#holds the wall time seen by gem_reduce and the sum (CPU, I/O) or maximum
+#(peak RSS) over its jobs.  The records are written as JSON and CSV next
+#to the log and summarized in a table at the end of the run.
+
+import csv
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+
+FIELDS = ['level', 'stage', 'job', 'nfiles', 'files', 'ok', 'start',
+          'wall_s', 'cpu_s', 'peak_rss_mb', 'read_mb', 'written_mb']
+
+MB = 1024.0 * 1024.0
+
+
+def _cpu_seconds():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def _io_bytes():
+    #logical bytes read and written by this process; Linux only
+    try:
+        with open('/proc/self/io') as fh:
+            fields = dict(line.split(':') for line in fh)
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_inblock * 512, usage.ru_oublock * 512
+
+
+def _reset_peak_rss():
+    #writing 5 to clear_refs resets VmHWM so each job gets its own peak
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss_bytes():
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def report_base(logfile):
+    """Path of the profile reports of a log, without extension."""
+    return os.path.splitext(logfile)[0] + '_profile'
+
+
+class measure:
+    """Context manager measuring the enclosed block.
+
+    with measure('flats', 'flats_0001_S2017', files) as m:
+        ...
+    m.record   dictionary with the FIELDS above
+    """
+
+    def __init__(self, stage, job=None, files=(), level='job'):
+        self.record = {
+            'level': level,
+            'stage': stage,
+            'job': job,
+            'nfiles': len(files),
+            'files': ' '.join(os.path.basename(f) for f in files),
+            'ok': False,
+        }
+
+    def __enter__(self):
+        if self.record['level'] == 'job':
+            _reset_peak_rss()
+        self.record['start'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self._wall = time.perf_counter()
+        self._cpu = _cpu_seconds()
+        self._io = _io_bytes()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        read, written = _io_bytes()
+        self.record.update({
+            'ok': exc_type is None,
+            'wall_s': round(time.perf_counter() - self._wall, 3),
+            'cpu_s': round(_cpu_seconds() - self._cpu, 3),
+            'peak_rss_mb': round(_peak_rss_bytes() / MB, 1),
+            'read_mb': round((read - self._io[0]) / MB, 2),
+            'written_mb': round((written - self._io[1]) / MB, 2),
+        })
+        return False
+
+
+class Profiler:
+    """Collects measurement records from every stage of a run."""
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(dict(record))
+
+    def add_stage(self, stage, wall_s, jobs, ok=True, start=None):
+        """Stage record aggregated from the records of its jobs."""
+        self.add({
+            'level': 'stage',
+            'stage': stage,
+            'job': None,
+            'nfiles': sum(j['nfiles'] for j in jobs),
+            'files': '',
+            'ok': ok and all(j['ok'] for j in jobs),
+            'start': start,
+            'wall_s': round(wall_s, 3),
+            'cpu_s': round(sum(j.get('cpu_s', 0) for j in jobs), 3),
+            'peak_rss_mb': max([j.get('peak_rss_mb', 0) for j in jobs] or [0]),
+            'read_mb': round(sum(j.get('read_mb', 0) for j in jobs), 2),
+            'written_mb': round(sum(j.get('written_mb', 0) for j in jobs), 2),
+        })
+
+    def jobs(self, stage):
+        return [r for r in self.records if r['level'] == 'job' and r['stage'] == stage]
+
+    def write(self, logfile):
+        """Write <log>_profile.json and <log>_profile.csv next to the log."""
+        base = report_base(logfile)
+        with open(base + '.json', 'w') as fh:
+            json.dump(self.records, fh, indent=1)
+        with open(base + '.csv', 'w', newline='') as fh:
+            writer = csv.DictWriter(fh, fieldnames=FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(self.records)
+        return base + '.json', base + '.csv'
+
+    def summary(self):
+        """Table of the stage records and the slowest job of each stage."""
+        lines = ['%-10s %6s %10s %10s %9s %9s %9s  %s' % (
+            'stage', 'files', 'wall [s]', 'cpu [s]', 'rss [MB]',
+            'read [MB]', 'wrt [MB]', 'slowest job')]
+        for rec in self.records:
+            if rec['level'] != 'stage':
+                continue
+            jobs = self.jobs(rec['stage'])
+            slowest = max(jobs, key=lambda j: j['wall_s'], default=None)
+            slow = f"{slowest['job']} ({slowest['wall_s']:.1f} s)" if slowest else ''
+            lines.append('%-10s %6d %10.1f %10.1f %9.1f %9.1f %9.1f  %s' % (
+                rec['stage'], rec['nfiles'], rec['wall_s'], rec['cpu_s'],
+                rec['peak_rss_mb'], rec['read_mb'], rec['written_mb'], slow))
+        return '\n'.join(lines)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+#Off-screen quick-look plots of the reduced standard and science frames.
+#
+#The products of a stage are handed to a background process pool as soon
+#as the stage finishes.  Every extension with a 1D spectrum is plotted
+#against wavelength and every 2D extension is drawn as an image, with the
+#Agg backend so no window is ever opened and the pipeline never waits for
+#a plot.  At the end of the run an index.html with all the PNGs is
+#written next to them.
+
+import html
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from spectrastore import wavelength
+from warmpool import pool_context
+
+
+QUICKLOOK_DIR = 'quicklook'
+
+
+def render(path, outdir=QUICKLOOK_DIR):
+    """Plot every 1D and 2D extension of a file to PNG.
+
+    Runs in a worker process.  Returns (path, list of PNGs, error).
+    """
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        import numpy as np
+        import astrodata
+        import gemini_instruments
+
+        os.makedirs(outdir, exist_ok=True)
+        base = os.path.splitext(os.path.basename(path))[0]
+        pngs = []
+        ad = astrodata.open(path)
+        for i, ext in enumerate(ad):
+            data = ext.data
+            if data is None or data.ndim not in (1, 2):
+                continue
+            fig, ax = plt.subplots(figsize=(10, 4) if data.ndim == 1 else (10, 6))
+            if data.ndim == 1:
+                x, unit = wavelength(ext, data.size)
+                ax.plot(x, data, lw=0.7, color='k')
+                ax.set_xlabel('pixel' if unit == 'pixel' else f'wavelength [{unit}]')
+                ax.set_ylabel(ext.hdr.get('BUNIT', 'flux'))
+                good = data[np.isfinite(data)]
+                if good.size:
+                    lo, hi = np.percentile(good, [0.5, 99.5])
+                    ax.set_ylim(lo - 0.1 * (hi - lo), hi + 0.1 * (hi - lo))
+            else:
+                good = data[np.isfinite(data)]
+                lo, hi = np.percentile(good, [1, 99.5]) if good.size else (0, 1)
+                ax.imshow(data, origin='lower', aspect='auto', cmap='gray',
+                          vmin=lo, vmax=hi, interpolation='nearest')
+                ax.set_xlabel('column')
+                ax.set_ylabel('row')
+            ax.set_title(f'{os.path.basename(path)} [{i + 1}] {ad.object()}')
+            png = os.path.join(outdir, f'{base}_{i + 1}.png')
+            fig.savefig(png, dpi=100, bbox_inches='tight')
+            plt.close(fig)
+            pngs.append(png)
+        return path, pngs, None
+    except Exception as err:
+        return path, [], f'{type(err).__name__}: {err}'
+
+
+class QuickLook:
+    """Render the products of stages in the background."""
+
+    def __init__(self, outdir=QUICKLOOK_DIR, njobs=2, stages=('std', 'sci')):
+        self.outdir = os.path.abspath(outdir)
+        self.stages = set(stages)
+        self._executor = ProcessPoolExecutor(max_workers=njobs, mp_context=pool_context())
+        self._futures = []
+
+    def submit(self, stage, files):
+        """Queue the FITS products of a stage, returning at once."""
+        if stage not in self.stages:
+            return
+        for f in files:
+            if f.endswith('.fits'):
+                future = self._executor.submit(render, os.path.abspath(f), self.outdir)
+                self._futures.append((stage, future))
+
+    def close(self):
+        """Wait for the plots and write index.html.  Returns its path."""
+        results = []
+        for stage, future in self._futures:
+            path, pngs, error = future.result()
+            if error:
+                print(f'quick-look of {path} failed: {error}')
+            results.append((stage, path, pngs, error))
+        self._executor.shutdown()
+        if not results:
+            return None
+        os.makedirs(self.outdir, exist_ok=True)
+        index = os.path.join(self.outdir, 'index.html')
+        with open(index, 'w') as fh:
+            fh.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+                     '<title>gem_reduce quick-look</title></head><body>\n')
+            fh.write(f"<h1>gem_reduce quick-look</h1><p>{time.strftime('%Y-%m-%d %H:%M:%S')}</p>\n")
+            for name in sorted({r[0] for r in results}):
+                fh.write(f'<h2>{html.escape(name)}</h2>\n')
+                for stage, path, pngs, error in results:
+                    if stage != name:
+                        continue
+                    fh.write(f'<h3>{html.escape(os.path.basename(path))}</h3>\n')
+                    if error:
+                        fh.write(f'<p>failed: {html.escape(error)}</p>\n')
+                    for png in pngs:
+                        rel = html.escape(os.path.relpath(png, self.outdir))
+                        fh.write(f'<a href="{rel}"><img src="{rel}" width="800"></a><br>\n')
+            fh.write('</body></html>\n')
+        return index
@@ -0,0 +1,546 @@
+#!/usr/bin/env python
+
+#Dependency-aware scheduling of the gem_reduce stages.
+#
+#Each stage declares the calibration types it needs from the local
+#calibration database and the types it produces.  A stage depends on every
+#other scheduled stage that provides something it needs; stages that are
+#not scheduled are assumed to have left their products in the database
+#already.  Ready stages run concurrently and their Reduce jobs share one
+#process pool, so the pool size is the limit on concurrent work.
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import biasstack
+import hybrid
+import parallel
+from manifest import plan_stale
+from profiling import measure
+from telemetry import nfiles
+
+
+class Stage:
+    """One step of the reduction.
+
+    name:       unique name, e.g. 'biassci'
+    files:      input files
+    needs:      calibration types used, e.g. ['processed_bias']
+    provides:   calibration types produced, e.g. ['processed_flat']
+    per_file:   the inputs never interact, so each file is its own Reduce
+                job
+    groups:     dict of label to files; each group is its own Reduce job and
+                files is the union of the groups
+    uparms:     user parameters passed to Reduce
+    recipename: recipe to use instead of the default
+    title:      banner printed when the stage starts
+    interactive: the primitive of the recipe that needs a human; with
+                hybrid scheduling everything before it runs on the pool
+    chunk:      stack at most this many files in one Reduce and combine the
+                sub-stacks (see biasstack.py); only for bias stages
+    """
+
+    def __init__(self, name, files=(), needs=(), provides=(), per_file=False,
+                 uparms=None, recipename=None, title=None, groups=None,
+                 interactive=None, chunk=None):
+        self.name = name
+        self.groups = dict(groups) if groups else None
+        if self.groups:
+            files = [f for group in self.groups.values() for f in group]
+        self.files = list(files)
+        self.needs = list(needs)
+        self.provides = list(provides)
+        self.per_file = per_file
+        self.uparms = dict(uparms or {})
+        self.recipename = recipename
+        self.title = title or name
+        self.interactive = interactive
+        self.chunk = chunk
+
+    def __repr__(self):
+        return f'Stage({self.name!r}, {len(self.files)} files)'
+
+    def jobs(self):
+        """Reduce jobs for this stage: one per group, one per file if the
+        inputs never interact, and a single job with all the files otherwise.
+        """
+        if self.groups:
+            return [{
+                'name': f'{self.name}_{label}',
+                'stage': self.name,
+                'files': list(files),
+                'uparms': dict(self.uparms),
+                'recipename': self.recipename,
+            } for label, files in self.groups.items()]
+        if self.per_file:
+            return parallel.make_jobs(self.name, self.files, self.uparms,
+                                      self.recipename)
+        return [{
+            'name': self.name,
+            'stage': self.name,
+            'files': list(self.files),
+            'uparms': dict(self.uparms),
+            'recipename': self.recipename,
+        }]
+
+
+def build_graph(stages):
+    """Map each stage name to the set of stage names it depends on."""
+    names = [s.name for s in stages]
+    if len(set(names)) != len(names):
+        raise ValueError(f'duplicate stage names in {names}')
+
+    providers = {}
+    for stage in stages:
+        for caltype in stage.provides:
+            providers.setdefault(caltype, []).append(stage.name)
+
+    graph = {}
+    for stage in stages:
+        deps = set()
+        for caltype in stage.needs:
+            deps.update(providers.get(caltype, []))
+        deps.discard(stage.name)
+        graph[stage.name] = deps
+    return graph
+
+
+def topological_order(stages, graph=None):
+    """Stages sorted so that every stage comes after its dependencies.
+
+    Ties keep the order in which the stages were declared.
+    """
+    if graph is None:
+        graph = build_graph(stages)
+    done = set()
+    order = []
+    remaining = list(stages)
+    while remaining:
+        ready = [s for s in remaining if graph[s.name] <= done]
+        if not ready:
+            raise ValueError('dependency cycle between stages '
+                             + ', '.join(s.name for s in remaining))
+        for stage in ready:
+            order.append(stage)
+            done.add(stage.name)
+            remaining.remove(stage)
+    return order
+
+
+def _banner(text):
+    print('#############################################')
+    print(text)
+    print('#############################################')
+
+
+class Scheduler:
+    """Run stages in dependency order.
+
+    With njobs <= 1 the stages run one after another with Reduce in this
+    process, exactly as the script always has (interactive fitting works).
+    Otherwise every stage whose dependencies have finished is started at
+    once and its jobs are submitted to a shared pool of njobs processes.
+
+    If a manifest is given, stages whose fingerprint and outputs are
+    unchanged since they last finished are skipped (unless force is set)
+    and every stage that runs is recorded.
+
+    If a profiler is given, every job and stage is measured.
+
+    mem_budget and estimator are passed to the worker pool to hold jobs
+    back while they would not fit in memory.
+
+    If a journal is given, every job is checkpointed as it finishes.  With
+    resume, the jobs of a stale stage that finished in an interrupted run
+    with the same fingerprint are not run again.
+
+    If a stager is given, the inputs of each stage and of the stage after
+    it are copied to local scratch in the background as the stage starts,
+    and the jobs read the local copies.
+
+    If an associator is given, the calibrations of a stage's jobs that do
+    not depend on the time of the frame are resolved in one batch when the
+    stage starts and passed as ucals.
+
+    With daemon, the address of a warmpool.py daemon, every job runs in the
+    daemon's warm workers, also when njobs is 1.
+
+    If a calcache is given, calibration jobs whose configuration has a
+    product in the cache reuse it instead of running, and the products of
+    the others are added to the cache.
+
+    With hybrid, the jobs of stages that declare an interactive primitive
+    are split there (see hybrid.py): the batch parts run on the pool, even
+    with njobs 1, and
+    the fits are queued and run one at a time in the thread that called
+    run(), while the other jobs and stages carry on.
+
+    If a quicklook is given, the outputs of every stage are handed to it
+    for plotting in the background as soon as the stage is done.
+
+    With workqueue, a work queue spec (see workqueue.py), the jobs are
+    published to workers on other hosts, also when njobs is 1.  A stage's
+    jobs are only published once the stages it needs have finished.
+
+    If a telemetry is given, the run, its stages and jobs, the depth of the
+    pool and the calibrations given to every job are reported to it as
+    events (see telemetry.py).
+
+    runner and worker are the functions that execute a job in this process
+    and on the pool; the benchmarks replace them to time the orchestration
+    on its own.
+    """
+
+    runner = staticmethod(parallel.run_inline)
+    worker = staticmethod(parallel.run_job)
+
+    def __init__(self, stages, caldb, njobs=1, manifest=None, force=False,
+                 profiler=None, mem_budget=None, estimator=None, journal=None,
+                 resume=False, stager=None, associator=None, daemon=None,
+                 calcache=None, hybrid=False, quicklook=None, workqueue=None,
+                 telemetry=None):
+        self.stages = [s for s in stages if s.files]
+        for stage in stages:
+            if not stage.files:
+                print(f'stage {stage.name} has no input files, skipping')
+        self.caldb = caldb
+        self.njobs = njobs
+        self.graph = build_graph(self.stages)
+        self.manifest = manifest
+        self.force = force
+        self.profiler = profiler
+        self.mem_budget = mem_budget
+        self.estimator = estimator
+        self.journal = journal
+        self.resume = resume
+        self.stager = stager
+        self.associator = associator
+        self.daemon = daemon
+        self.calcache = calcache
+        self.hybrid = hybrid
+        self.quicklook = quicklook
+        self.workqueue = workqueue
+        self.telemetry = telemetry
+        self._fits = queue.Queue()
+        self.order = []
+        self.fingerprints = {}
+        self.stale = {s.name for s in self.stages}
+        self.outputs = {}
+        self._lock = threading.Lock()
+
+    def run_inline(self, stage, job, staged=None):
+        """Run a job with Reduce in this process.
+
+        staged is the job given to Reduce if it is not job itself (a fit);
+        the journal and the calibration cache always see job.
+        """
+        pinned = staged is None and self.stager is not None
+        if staged is None:
+            staged = dict(job, files=self.stager.acquire(job['files'])) if pinned else job
+        m = measure(stage.name, staged['name'], job['files'])
+        if self.journal is not None:
+            self.journal.start(job)
+        self._emit('job_start', stage=stage.name, job=staged['name'],
+                   nfiles=nfiles(staged))
+        try:
+            with m:
+                produced = self.runner(staged)
+        finally:
+            if pinned:
+                self.stager.release(job['files'])
+            if self.profiler is not None:
+                self.profiler.add(m.record)
+            self._emit('job_done', stage=stage.name, job=staged['name'],
+                       nfiles=nfiles(staged), ok=m.record['ok'],
+                       wall_s=m.record.get('wall_s'))
+        if self.journal is not None:
+            self.journal.done(job, produced)
+        if self.calcache is not None:
+            self.calcache.store(stage, job, produced)
+        return produced
+
+    def run_chunked(self, stage, job, pool):
+        """Stack a job's files chunk by chunk and combine the sub-stacks."""
+        def run(jobs, raw=False):
+            #the parts are neither journalled nor cached, only the whole job
+            if pool is not None:
+                return pool.run(jobs)
+            produced = []
+            for part in jobs:
+                #only the raw frames are staged, the sub-stacks are local
+                pinned = raw and self.stager is not None
+                staged = dict(part, files=self.stager.acquire(part['files'])) if pinned else part
+                m = measure(stage.name, part['name'], part['files'])
+                self._emit('job_start', stage=stage.name, job=part['name'],
+                           nfiles=nfiles(part))
+                try:
+                    with m:
+                        produced.extend(self.runner(staged))
+                finally:
+                    if pinned:
+                        self.stager.release(part['files'])
+                    if self.profiler is not None:
+                        self.profiler.add(m.record)
+                    self._emit('job_done', stage=stage.name, job=part['name'],
+                               nfiles=nfiles(part), ok=m.record['ok'],
+                               wall_s=m.record.get('wall_s'))
+            return produced
+
+        if stage.chunk < 2:
+            raise ValueError(f'{stage.name}: chunks of {stage.chunk} files never '
+                             'reduce the number of sub-stacks')
+        if self.journal is not None:
+            self.journal.start(job)
+        level, files, intermediate = 0, job['files'], []
+        while True:
+            jobs = biasstack.chunk_jobs(job, stage.chunk, level, None if level == 0 else files)
+            print(f'{stage.name}: {len(files)} files in {len(jobs)} '
+                  + ('chunks' if level == 0 else 'groups of sub-stacks'))
+            before, files = len(files), run(jobs, level == 0)
+            intermediate.extend(files)
+            level += 1
+            if len(files) >= before:
+                raise RuntimeError(f'{stage.name}: level {level} gave {len(files)} '
+                                   f'sub-stacks of {before} files, not fewer')
+            if len(files) <= stage.chunk:
+                break
+        outputs = run([biasstack.final_job(job, files)])
+        for f in intermediate:
+            if os.path.exists(f) and os.path.abspath(f) not in map(os.path.abspath, outputs):
+                os.remove(f)
+        if self.journal is not None:
+            self.journal.done(job, outputs)
+        if self.calcache is not None:
+            self.calcache.store(stage, job, outputs)
+        return outputs
+
+    def run_hybrid(self, stage, jobs, pool):
+        """Batch parts of the jobs on the pool, their fits queued for run()."""
+        byname, batches, fits = {}, [], []
+        for job in jobs:
+            batch = hybrid.batch_job(job, stage.interactive)
+            byname[batch['name']] = job
+            batches.append(batch)
+
+        def queue_fit(batch, produced):
+            job = byname[batch['name']]
+            fits.append({'stage': stage, 'job': job, 'outputs': [], 'error': None,
+                         'fit': hybrid.fit_job(job, stage.interactive, produced),
+                         'done': threading.Event()})
+            self._fits.put(fits[-1])
+            self._emit('queue', fits_waiting=self._fits.qsize())
+            print(f"{job['name']} is ready for {stage.interactive}, "
+                  f'{self._fits.qsize()} fits waiting')
+
+        try:
+            pool.run(batches, on_done=queue_fit)
+        finally:
+            #the fits already queued are not thrown away
+            for item in list(fits):
+                item['done'].wait()
+        failed = [item for item in fits if item['error'] is not None]
+        if failed:
+            raise RuntimeError(f'{len(failed)} of {len(jobs)} fits failed: '
+                               + '; '.join(f"{i['fit']['name']}: {i['error']}" for i in failed))
+        order = {job['name']: i for i, job in enumerate(jobs)}
+        fits.sort(key=lambda item: order[item['job']['name']])
+        return [f for item in fits for f in item['outputs']]
+
+    def run_fits(self):
+        """Run the queued interactive fits.  Called from the main thread,
+        which is where the interactive tools have to run.
+        """
+        while True:
+            try:
+                item = self._fits.get_nowait()
+            except queue.Empty:
+                return
+            self._emit('queue', fits_waiting=self._fits.qsize())
+            _banner(f"{item['stage'].interactive}: {item['fit']['name']}")
+            try:
+                item['outputs'] = self.run_inline(item['stage'], item['job'], item['fit'])
+            except Exception as err:
+                item['error'] = err
+            finally:
+                item['done'].set()
+
+    def cancel_fits(self):
+        while True:
+            try:
+                item = self._fits.get_nowait()
+            except queue.Empty:
+                return
+            item['error'] = 'cancelled'
+            item['done'].set()
+
+    def run_stage(self, stage, pool=None):
+        if stage.name not in self.stale:
+            _banner(f'{stage.title}: up to date, skipping')
+            self._emit('stage_skipped', stage=stage.name)
+            self.outputs[stage.name] = self.manifest.outputs(stage.name)
+            if self.quicklook is not None:
+                self.quicklook.submit(stage.name, self.outputs[stage.name])
+            return self.outputs[stage.name]
+
+        _banner(stage.title)
+        if self.manifest is not None:
+            with self._lock:
+                self.manifest.invalidate(stage.name)
+
+        if self.stager is not None:
+            #this stage first, then read ahead for the one after it
+            self.stager.prefetch(stage.files)
+            later = [s for s in self.order[self.order.index(stage) + 1:]
+                     if s.name in self.stale] if stage in self.order else []
+            if later:
+                self.stager.prefetch(later[0].files)
+
+        jobs = stage.jobs()
+        finished = {}
+        if self.journal is not None:
+            fingerprint = self.fingerprints.get(stage.name)
+            if self.resume:
+                with self._lock:
+                    owned = [f for rec in (self.manifest.stages.values()
+                                           if self.manifest is not None else [])
+                             for f in rec['outputs']]
+                finished = self.journal.resume(stage.name, fingerprint, jobs,
+                                               self.caldb, owned)
+                if finished:
+                    print(f'resuming {stage.name}: {len(finished)} of {len(jobs)} '
+                          'jobs finished in an earlier run')
+            else:
+                self.journal.begin(stage.name, fingerprint)
+        if self.calcache is not None:
+            todo = [job for job in jobs if job['name'] not in finished]
+            finished.update(self.calcache.fetch(stage, todo, self.caldb))
+        outputs = [f for job in jobs for f in finished.get(job['name'], [])]
+        jobs = [job for job in jobs if job['name'] not in finished]
+        if self.associator is not None and stage.needs and jobs:
+            self.associator.assign(stage, jobs)
+        if stage.needs:
+            for job in jobs:
+                ucals = job.get('ucals') or {}
+                for caltype in stage.needs:
+                    #the types left to Reduce are looked up by it, not reported
+                    if caltype in ucals or (self.associator is not None
+                                            and caltype in self.associator.caltypes):
+                        self._emit('calibration', stage=stage.name, job=job['name'],
+                                   caltype=caltype, file=ucals.get(caltype))
+        self._emit('stage_start', stage=stage.name, jobs=len(jobs) + len(finished),
+                   files=len(stage.files), reused=len(finished))
+
+        start = time.strftime('%Y-%m-%dT%H:%M:%S')
+        wall = time.perf_counter()
+        ok = False
+        try:
+            if stage.chunk and len(jobs) == 1 and len(stage.files) > stage.chunk:
+                outputs.extend(self.run_chunked(stage, jobs[0], pool))
+            elif pool is None:
+                for job in jobs:
+                    outputs.extend(self.run_inline(stage, job))
+            elif jobs and self.hybrid and stage.interactive and not stage.recipename:
+                outputs.extend(self.run_hybrid(stage, jobs, pool))
+            elif jobs:
+                store = None
+                if self.calcache is not None:
+                    store = lambda job, produced: self.calcache.store(stage, job, produced)
+                outputs.extend(pool.run(jobs, self.journal, store))
+            ok = True
+        finally:
+            self._emit('stage_done', stage=stage.name, ok=ok,
+                       wall_s=round(time.perf_counter() - wall, 3))
+            if self.profiler is not None:
+                self.profiler.add_stage(stage.name, time.perf_counter() - wall,
+                                        self.profiler.jobs(stage.name),
+                                        start=start)
+        self.outputs[stage.name] = outputs
+        if self.manifest is not None:
+            with self._lock:
+                self.manifest.record(stage, self.fingerprints[stage.name], outputs)
+        if self.journal is not None:
+            self.journal.finish(stage.name)
+        if self.associator is not None:
+            self.associator.invalidate(stage.provides)
+        if self.quicklook is not None:
+            self.quicklook.submit(stage.name, outputs)
+        return outputs
+
+    def run(self):
+        """Run every stage and return a dict of stage name to outputs."""
+        order = self.order = topological_order(self.stages, self.graph)
+        if self.manifest is not None:
+            self.fingerprints, stale = plan_stale(order, self.graph, self.manifest)
+            if not self.force:
+                self.stale = stale
+        self._emit('run_start', njobs=self.njobs,
+                   stages={s.name: {'jobs': len(s.jobs()), 'files': len(s.files)}
+                           for s in order if s.name in self.stale})
+        wall = time.perf_counter()
+        ok = False
+        try:
+            outputs = self._run_stages(order)
+            ok = True
+            return outputs
+        finally:
+            self._emit('run_done', ok=ok, wall_s=round(time.perf_counter() - wall, 3))
+
+    def _emit(self, event, **fields):
+        if self.telemetry is not None:
+            self.telemetry.emit(event, **fields)
+
+    def _run_stages(self, order):
+        if (self.njobs <= 1 and self.daemon is None and self.workqueue is None
+                and not self.hybrid):
+            for stage in order:
+                self.run_stage(stage)
+            return self.outputs
+
+        done, failed, running = set(), {}, {}
+        pending = list(order)
+        with parallel.JobPool(self.caldb, self.njobs, profiler=self.profiler,
+                              worker=self.worker, mem_budget=self.mem_budget,
+                              estimator=self.estimator, stager=self.stager,
+                              daemon=self.daemon, queue=self.workqueue,
+                              telemetry=self.telemetry) as pool, \
+                ThreadPoolExecutor(max_workers=max(1, len(order))) as threads:
+            try:
+                while pending or running:
+                    for stage in list(pending):
+                        deps = self.graph[stage.name]
+                        if deps & set(failed):
+                            print(f'skipping {stage.name}: depends on failed '
+                                  + ', '.join(sorted(deps & set(failed))))
+                            failed[stage.name] = None
+                            pending.remove(stage)
+                        elif deps <= done:
+                            future = threads.submit(self.run_stage, stage, pool)
+                            running[future] = stage
+                            pending.remove(stage)
+                    if not running:
+                        break
+                    finished = set()
+                    while not finished:
+                        self.run_fits()
+                        finished, _ = wait(running, timeout=0.5, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        stage = running.pop(future)
+                        if future.exception() is None:
+                            done.add(stage.name)
+                        else:
+                            failed[stage.name] = future.exception()
+                            print(f'stage {stage.name} failed: {future.exception()}')
+            except BaseException:
+                #nobody is left to run the queued fits
+                self.cancel_fits()
+                raise
+
+        errors = {k: v for k, v in failed.items() if v is not None}
+        if failed:
+            raise RuntimeError('stages failed: ' + ', '.join(sorted(errors))
+                               + '; not run: '
+                               + ', '.join(sorted(set(failed) - set(errors))))
+        return self.outputs
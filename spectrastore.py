@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+#Columnar export of the extracted 1D spectra of a run.
+#
+#Every extracted spectrum of the standard and science stages is its own
+#FITS extension, and analysis that wants a night's spectra has to open
+#thousands of files one at a time.  The export collects every 1D extension
+#of a stage's products into one directory per stage:
+#
+#    <dir>/<stage>/wavelength.npy   float64, all spectra end to end
+#                  flux.npy         float32
+#                  variance.npy     float32, NaN where there is none
+#                  mask.npy         uint16 DQ bits
+#                  meta.json        one record per spectrum: file, extension,
+#                                   aperture, offset and length in the
+#                                   columns, and the header metadata
+#
+#The columns are plain .npy files, so they are memory-mapped when read and
+#a spectrum is a view into them: load() opens a whole night in one call
+#without reading any pixels until they are used.
+#
+#    import spectrastore
+#    sci = spectrastore.load('spectra')['sci']
+#    for spec in sci.select(object='J2145+0031'):
+#        plt.plot(spec['wavelength'], spec['flux'])
+
+import argparse
+import json
+import os
+import shutil
+
+from fileindex import descriptor_values
+
+
+EXPORT_DIR = 'spectra'
+
+#name and dtype of the columns
+COLUMNS = (('wavelength', 'float64'), ('flux', 'float32'),
+           ('variance', 'float32'), ('mask', 'uint16'))
+
+#descriptors stored with every spectrum
+METADATA = ('object', 'data_label', 'ut_datetime', 'exposure_time', 'airmass',
+            'ra', 'dec', 'disperser', 'central_wavelength', 'detector_name',
+            'detector_roi_setting', 'detector_x_bin', 'detector_y_bin')
+
+FORMAT_VERSION = 1
+
+
+def wavelength(ext, n):
+    """Wavelength of the n pixels of a 1D extension and its unit, or the
+    pixel number if the extension has no usable WCS."""
+    import numpy as np
+
+    pixels = np.arange(n)
+    try:
+        return ext.wcs(pixels), 'nm'
+    except Exception:
+        return pixels, 'pixel'
+
+
+def spectra_of(path):
+    """Records and column arrays of the 1D extensions of a file."""
+    import numpy as np
+    import astrodata
+    import gemini_instruments
+
+    ad = astrodata.open(path)
+    meta = descriptor_values(ad, METADATA)
+    records, arrays = [], []
+    for i, ext in enumerate(ad):
+        data = ext.data
+        if data is None or data.ndim != 1:
+            continue
+        n = data.size
+        wave, unit = wavelength(ext, n)
+        arrays.append({
+            'wavelength': np.asarray(wave, dtype='float64'),
+            'flux': np.asarray(data, dtype='float32'),
+            'variance': (np.full(n, np.nan, dtype='float32') if ext.variance is None
+                         else np.asarray(ext.variance, dtype='float32')),
+            'mask': (np.zeros(n, dtype='uint16') if ext.mask is None
+                     else np.asarray(ext.mask, dtype='uint16')),
+        })
+        records.append(dict(meta, file=os.path.basename(path), extension=i + 1,
+                            aperture=ext.hdr.get('APERTURE', len(records) + 1),
+                            wavelength_unit=unit, flux_unit=ext.hdr.get('BUNIT'),
+                            length=n))
+    return records, arrays
+
+
+def export_stage(files, directory):
+    """Write the 1D spectra of files to directory, replacing what is there.
+
+    Returns the number of spectra written; nothing is written if there
+    are none.
+    """
+    import numpy as np
+
+    records, arrays = [], []
+    for path in files:
+        if not path.endswith('.fits'):
+            continue
+        try:
+            recs, arrs = spectra_of(path)
+        except Exception as err:
+            print(f'could not export {path}: {type(err).__name__}: {err}')
+            continue
+        records.extend(recs)
+        arrays.extend(arrs)
+    if not records:
+        return 0
+
+    offset = 0
+    for rec in records:
+        rec['offset'] = offset
+        offset += rec['length']
+
+    #written next to the old export and swapped in when complete
+    tmp = directory + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for name, dtype in COLUMNS:
+        np.save(os.path.join(tmp, name + '.npy'),
+                np.concatenate([a[name] for a in arrays]).astype(dtype, copy=False))
+    with open(os.path.join(tmp, 'meta.json'), 'w') as fh:
+        json.dump({'version': FORMAT_VERSION, 'columns': dict(COLUMNS),
+                   'spectra': records}, fh, indent=1)
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.replace(tmp, directory)
+    return len(records)
+
+
+def export(outputs, directory=EXPORT_DIR, stages=('std', 'sci')):
+    """Export the spectra of the stages of a run.
+
+    outputs maps a stage name to its products, as returned by
+    Scheduler.run().  Returns the directories written.
+    """
+    written = []
+    for stage in stages:
+        if not outputs.get(stage):
+            continue
+        path = os.path.join(directory, stage)
+        n = export_stage(outputs[stage], path)
+        if n:
+            print(f'exported {n} spectra of {stage} to {path}')
+            written.append(path)
+        else:
+            print(f'{stage}: no 1D spectra to export')
+    return written
+
+
+class Spectra:
+    """The exported spectra of one stage, memory-mapped.
+
+    spectra[i] is the record of the i-th spectrum with its wavelength,
+    flux, variance and mask as views into the columns.
+    """
+
+    def __init__(self, directory):
+        import numpy as np
+
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as fh:
+            meta = json.load(fh)
+        if meta.get('version') != FORMAT_VERSION:
+            raise ValueError(f"{directory}: export format {meta.get('version')}, "
+                             f'expected {FORMAT_VERSION}')
+        self.records = meta['spectra']
+        self.columns = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+                        for name in meta['columns']}
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        rec = self.records[i]
+        window = slice(rec['offset'], rec['offset'] + rec['length'])
+        return dict(rec, **{name: col[window] for name, col in self.columns.items()})
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def select(self, **values):
+        """The spectra whose metadata has all the given values."""
+        return [self[i] for i, rec in enumerate(self.records)
+                if all(rec.get(k) == v for k, v in values.items())]
+
+
+def load(directory=EXPORT_DIR):
+    """Every exported stage in directory, as a dict of stage name to Spectra."""
+    return {name: Spectra(os.path.join(directory, name))
+            for name in sorted(os.listdir(directory))
+            if os.path.exists(os.path.join(directory, name, 'meta.json'))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List the spectra exported by gem_reduce --export')
+    parser.add_argument('directory', nargs='?', default=EXPORT_DIR,
+                        help=f'default={EXPORT_DIR}; directory of the export')
+    args = parser.parse_args()
+
+    for name, spectra in load(args.directory).items():
+        print(f'{name}: {len(spectra)} spectra')
+        for rec in spectra.records:
+            print(f"  {rec['file']}[{rec['extension']}] aperture {rec['aperture']} "
+                  f"{rec['object']} {rec['exposure_time']}s airmass {rec['airmass']} "
+                  f"{rec['length']} pixels")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
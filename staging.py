@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+#Stage input frames on fast local scratch ahead of the Reduce jobs.
+#
+#The raw data usually sit on a slow shared filesystem and Reduce reads its
+#inputs synchronously, so every job starts by waiting for I/O.  The
+#stager copies (and decompresses .bz2/.gz) the inputs of the running stage
+#and of the next one to a local scratch directory in background threads
+#while Reduce computes, and jobs are handed the local copies.
+#
+#The scratch space is bounded.  Copies are evicted least recently used
+#first, but never while a job is reading them or while they are still
+#being written.  If a file cannot be staged (no room, copy failed) the job
+#simply reads the original.  Copies keep their basename, because DRAGONS
+#names its products after the input files, and are reused by later runs
+#as long as the original has the same size and mtime.
+
+import bz2
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from membudget import GB
+
+
+#room reserved for a compressed file until its decompressed size is known
+INFLATION = 4
+
+
+def _copy(src, dest):
+    tmp = dest + '.tmp'
+    if src.endswith('.bz2'):
+        fin = bz2.open(src, 'rb')
+    elif src.endswith('.gz'):
+        fin = gzip.open(src, 'rb')
+    else:
+        fin = None
+    if fin is None:
+        shutil.copyfile(src, tmp)
+    else:
+        with fin, open(tmp, 'wb') as fout:
+            shutil.copyfileobj(fin, fout, 1 << 22)
+    os.replace(tmp, dest)
+    return os.path.getsize(dest)
+
+
+class Stager:
+    """LRU cache of input frames in a local scratch directory.
+
+    prefetch(files)   start copying files in the background
+    acquire(files)    local paths of the files, waiting for their copies;
+                      they are not evicted until release(files)
+    """
+
+    def __init__(self, scratch, capacity, nthreads=2):
+        self.scratch = os.path.abspath(scratch)
+        self.capacity = capacity
+        self.indexfile = os.path.join(self.scratch, 'staged.json')
+        self.stats = {'hits': 0, 'staged': 0, 'prefetched': 0, 'evicted': 0,
+                      'unstaged': 0, 'bytes': 0}
+        #source path -> {'local', 'key', 'size', 'pins', 'used', 'future'}
+        self._entries = OrderedDict()
+        self._used = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=nthreads,
+                                            thread_name_prefix='stager')
+        os.makedirs(self.scratch, exist_ok=True)
+        if os.path.exists(self.indexfile):
+            with open(self.indexfile) as fh:
+                for src, local, key, size in json.load(fh):
+                    if os.path.exists(local):
+                        self._entries[src] = {'local': local, 'key': key, 'size': size,
+                                              'pins': 0, 'used': True, 'future': None}
+                        self._used += size
+
+    def _local_name(self, src):
+        #one directory per source directory keeps equal basenames apart
+        subdir = hashlib.sha1(os.path.dirname(src).encode()).hexdigest()[:12]
+        name = os.path.basename(src)
+        for suffix in ('.bz2', '.gz'):
+            if name.endswith(suffix):
+                name = name[:-len(suffix)]
+        return os.path.join(self.scratch, subdir, name)
+
+    def _key(self, src):
+        st = os.stat(src)
+        return [st.st_size, st.st_mtime_ns]
+
+    def _drop(self, src):
+        entry = self._entries.pop(src)
+        self._used -= entry['size']
+        try:
+            os.remove(entry['local'])
+        except OSError:
+            pass
+
+    def _make_room(self, nbytes, keep_unused=False):
+        #evict idle copies, oldest first, until nbytes fit.  Read-ahead
+        #must not evict copies that were prefetched and not read yet.
+        for src in list(self._entries):
+            if self._used + nbytes <= self.capacity:
+                break
+            entry = self._entries[src]
+            if entry['pins'] or (entry['future'] is not None and not entry['future'].done()):
+                continue
+            if keep_unused and not entry['used']:
+                continue
+            self._drop(src)
+            self.stats['evicted'] += 1
+        return self._used + nbytes <= self.capacity
+
+    def _stage(self, src, entry):
+        try:
+            size = _copy(src, entry['local'])
+        except Exception:
+            with self._lock:
+                if self._entries.get(src) is entry:
+                    del self._entries[src]
+                    self._used -= entry['size']
+            raise
+        with self._lock:
+            self._used += size - entry['size']
+            entry['size'] = size
+            self.stats['bytes'] += size
+            #the reservation of a compressed file was a guess
+            if not self._make_room(0, keep_unused=True):
+                self._make_room(0)
+        return entry['local']
+
+    def _request(self, src, prefetch):
+        #caller holds the lock; returns the entry or None if there is no room
+        key = self._key(src)
+        entry = self._entries.get(src)
+        if entry is not None and entry['key'] != key and not entry['pins']:
+            self._drop(src)
+            entry = None
+        if entry is not None:
+            self._entries.move_to_end(src)
+            return entry
+        reserve = key[0] * (INFLATION if src.endswith(('.bz2', '.gz')) else 1)
+        if not self._make_room(reserve, keep_unused=prefetch):
+            return None
+        local = self._local_name(src)
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        entry = {'local': local, 'key': key, 'size': reserve, 'pins': 0,
+                 'used': not prefetch}
+        self._entries[src] = entry
+        self._used += reserve
+        entry['future'] = self._executor.submit(self._stage, src, entry)
+        self.stats['prefetched' if prefetch else 'staged'] += 1
+        return entry
+
+    def prefetch(self, files):
+        """Start copying files that are not staged yet, if there is room."""
+        with self._lock:
+            for src in files:
+                self._request(os.path.abspath(src), True)
+
+    def acquire(self, files):
+        """Local paths of files, in order.  Waits until they are copied."""
+        entries = []
+        with self._lock:
+            for src in files:
+                src = os.path.abspath(src)
+                entry = self._request(src, False)
+                if entry is not None:
+                    entry['pins'] += 1
+                    entry['used'] = True
+                    if entry['future'] is None or entry['future'].done():
+                        self.stats['hits'] += 1
+                entries.append((src, entry))
+        paths = []
+        for src, entry in entries:
+            if entry is None:
+                self.stats['unstaged'] += 1
+                paths.append(src)
+                continue
+            try:
+                if entry['future'] is not None:
+                    entry['future'].result()
+                paths.append(entry['local'])
+            except Exception as err:
+                print(f'could not stage {src}, reading it in place: {err}')
+                self.stats['unstaged'] += 1
+                paths.append(src)
+        return paths
+
+    def release(self, files):
+        """Allow the copies of files to be evicted again."""
+        with self._lock:
+            for src in files:
+                entry = self._entries.get(os.path.abspath(src))
+                if entry is not None and entry['pins']:
+                    entry['pins'] -= 1
+
+    def close(self):
+        """Wait for the copies in flight and save the cache index."""
+        self._executor.shutdown()
+        with self._lock:
+            index = [[src, e['local'], e['key'], e['size']]
+                     for src, e in self._entries.items()]
+        with open(self.indexfile + '.tmp', 'w') as fh:
+            json.dump(index, fh)
+        os.replace(self.indexfile + '.tmp', self.indexfile)
+
+    def summary(self):
+        s = self.stats
+        return (f"scratch {self.scratch}: {s['hits']} hits, {s['prefetched']} prefetched, "
+                f"{s['staged']} staged on demand, {s['unstaged']} read in place, "
+                f"{s['evicted']} evicted, {s['bytes'] / GB:.2f} GB copied, "
+                f"{self._used / GB:.2f} of {self.capacity / GB:.2f} GB in use")
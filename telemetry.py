@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+
+#Live progress of a gem_reduce run as a stream of JSON events.
+#
+#With --telemetry, gem_reduce writes one JSON object per line for every
+#step of the run, to a file or to a local socket:
+#
+#    run_start      the stages that will run, with their jobs and files
+#    stage_start    stage_done    stage_skipped
+#    job_queued     a job was handed to the worker pool
+#    job_start      a job started, in this process or in a worker
+#    job_done       wall time, files, ok
+#    queue          jobs in flight on the pool and fits waiting
+#    calibration    the calibration resolved for a job, or none
+#    run_done
+#
+#Every event has the time t, the event name and the run id.  The
+#dashboard follows the stream and shows throughput, time remaining, the
+#running jobs and the files that are much slower than the rest of their
+#stage:
+#
+#    python dragons_gem2025A.py --makeflats --jobs 8 --telemetry gmosls_events.jsonl
+#    python telemetry.py gmosls_events.jsonl
+#
+#    python telemetry.py unix:/tmp/gmosls.sock &    listen on a socket
+#    python dragons_gem2025A.py --makeflats --telemetry unix:/tmp/gmosls.sock
+#
+#Events sent to a socket nobody listens on are dropped, so the run never
+#waits for the dashboard.
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+import uuid
+
+
+#a running job this many times slower than the median of its stage is
+#shown as stalled
+SLOW_FACTOR = 3.0
+
+#throughput is measured over this many seconds
+WINDOW = 600.0
+
+
+class Telemetry:
+    """Write events to target: a file, or unix:PATH for a datagram socket."""
+
+    def __init__(self, target, run=None):
+        self.target = target
+        self.run = run or uuid.uuid4().hex[:12]
+        self._lock = threading.Lock()
+        self._fh = self._sock = None
+        #workers run in their own directories, so they are given the
+        #absolute path
+        if target.startswith('unix:'):
+            self._address = os.path.abspath(target[len('unix:'):])
+            self.target = 'unix:' + self._address
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sock.setblocking(False)
+        else:
+            self.target = os.path.abspath(target)
+            self._fh = open(self.target, 'a', buffering=1)
+
+    def emit(self, event, **fields):
+        line = json.dumps(dict(t=round(time.time(), 3), event=event, run=self.run,
+                               **fields), default=str)
+        with self._lock:
+            if self._fh is not None:
+                self._fh.write(line + '\n')
+            else:
+                try:
+                    self._sock.sendto(line.encode(), self._address)
+                except OSError:
+                    #nobody listening, or the dashboard is behind
+                    pass
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+        if self._sock is not None:
+            self._sock.close()
+
+
+def nfiles(job):
+    """Number of the input files of its stage that a job accounts for.
+    The jobs that work on the products of other jobs of the stage (the
+    combine of a chunked stack, the fit of a hybrid job) set nfiles to 0,
+    so every input file is counted once."""
+    return job.get('nfiles', len(job['files']))
+
+
+#one emitter per target in each worker process
+_emitters = {}
+
+
+def traced(target, run, worker, job, *args):
+    """Call worker(job, *args) in a worker process, announcing the job."""
+    if (target, run) not in _emitters:
+        #a daemon's workers outlive the runs, so earlier ones are closed
+        for key in list(_emitters):
+            _emitters.pop(key).close()
+        _emitters[target, run] = Telemetry(target, run)
+    _emitters[target, run].emit('job_start', stage=job['stage'], job=job['name'],
+                                nfiles=nfiles(job),
+                                host=socket.gethostname(), pid=os.getpid())
+    return worker(job, *args)
+
+
+def follow(target):
+    """Yield the lists of events that arrived since the last call."""
+    if target.startswith('unix:'):
+        address = target[len('unix:'):]
+        if os.path.exists(address):
+            os.remove(address)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(address)
+        sock.setblocking(False)
+        try:
+            while True:
+                events = []
+                while True:
+                    try:
+                        events.append(json.loads(sock.recv(1 << 20)))
+                    except BlockingIOError:
+                        break
+                yield events
+        finally:
+            sock.close()
+            os.remove(address)
+    else:
+        while not os.path.exists(target):
+            yield []
+        with open(target) as fh:
+            partial = ''
+            while True:
+                events = []
+                for line in fh.readlines():
+                    line = partial + line
+                    if not line.endswith('\n'):
+                        #the writer is half way through this line
+                        partial = line
+                        continue
+                    partial = ''
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        pass
+                yield events
+
+
+class Progress:
+    """State of a run rebuilt from its events."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self, event=None):
+        self.run = event['run'] if event else None
+        self.started = event['t'] if event else None
+        self.planned = dict(event['stages']) if event else {}
+        self.stages = {}
+        self.running = {}
+        self.finished = []
+        self.queue = {}
+        self.calibrations = {}
+        self.unresolved = []
+        self.done = None
+
+    def add(self, e):
+        kind = e['event']
+        if kind == 'run_start':
+            self.reset(e)
+        elif self.run is not None and e.get('run') != self.run:
+            #a worker event of an earlier run
+            return
+        if kind == 'stage_start':
+            self.stages[e['stage']] = {'state': 'running', 'start': e['t'],
+                                       'jobs': e['jobs'], 'files': e['files'],
+                                       'done': 0, 'failed': 0, 'reused': e.get('reused', 0)}
+        elif kind == 'stage_done':
+            self.stages.setdefault(e['stage'], {}).update(
+                state='done' if e['ok'] else 'FAILED', wall_s=e['wall_s'])
+        elif kind == 'stage_skipped':
+            self.stages[e['stage']] = {'state': 'up to date'}
+        elif kind == 'job_start':
+            self.running[e['job']] = {'stage': e['stage'], 'start': e['t'],
+                                      'nfiles': e['nfiles'],
+                                      'where': e.get('host', 'main')}
+        elif kind == 'job_done':
+            started = self.running.pop(e['job'], None)
+            if e.get('wall_s') is None:
+                #not measured by the worker, timed from its job_start
+                e = dict(e, wall_s=e['t'] - started['start'] if started else 0.0)
+            self.finished.append(e)
+            stage = self.stages.get(e['stage'])
+            if stage is not None and 'done' in stage:
+                stage['done' if e['ok'] else 'failed'] += 1
+        elif kind == 'queue':
+            self.queue.update((k, v) for k, v in e.items() if k not in ('t', 'event', 'run'))
+        elif kind == 'calibration':
+            counts = self.calibrations.setdefault(e['stage'], {'matched': 0, 'unresolved': 0})
+            if e.get('file'):
+                counts['matched'] += 1
+            else:
+                counts['unresolved'] += 1
+                self.unresolved.append(e)
+        elif kind == 'run_done':
+            self.done = e
+
+    def throughput(self, now, window=WINDOW):
+        """Files per minute over the last window seconds."""
+        recent = [e for e in self.finished if e['t'] >= now - window]
+        if not recent or self.started is None:
+            return 0.0
+        span = min(window, now - self.started)
+        return sum(e['nfiles'] for e in recent) / max(span, 1.0) * 60.0
+
+    def medians(self):
+        walls = {}
+        for e in self.finished:
+            if e['ok']:
+                walls.setdefault(e['stage'], []).append(e['wall_s'])
+        return {stage: statistics.median(w) for stage, w in walls.items()}
+
+    def outliers(self, factor=SLOW_FACTOR, count=5):
+        """The finished jobs slowest relative to the median of their stage."""
+        medians = self.medians()
+        slow = [(e['wall_s'] / medians[e['stage']], e) for e in self.finished
+                if e['ok'] and medians.get(e['stage']) and e['wall_s'] > factor * medians[e['stage']]]
+        return [e for ratio, e in sorted(slow, key=lambda s: -s[0])[:count]]
+
+    def render(self, now=None):
+        now = now or time.time()
+        if self.started is None:
+            return 'waiting for a run to start'
+        medians = self.medians()
+        files_total = sum(s['files'] for s in self.planned.values())
+        files_done = sum(e['nfiles'] for e in self.finished)
+        rate = self.throughput(now)
+        lines = [f'run {self.run}  elapsed {_duration(now - self.started)}  '
+                 f'{files_done}/{files_total} files  {rate:.1f} files/min']
+        if self.done is not None:
+            lines[0] += '  FINISHED' if self.done['ok'] else '  FAILED'
+        elif rate > 0:
+            lines[0] += f'  ETA {_duration((files_total - files_done) / rate * 60.0)}'
+        if self.queue:
+            lines.append('queue: ' + ', '.join(f'{k} {v}' for k, v in sorted(self.queue.items())))
+
+        lines.append('')
+        lines.append('%-10s %-11s %9s %7s %9s  %s' % ('stage', 'state', 'jobs', 'failed',
+                                                    'median', 'calibrations'))
+        for name in list(self.planned) + [s for s in self.stages if s not in self.planned]:
+            s = self.stages.get(name, {'state': 'waiting'})
+            jobs = (f"{s.get('done', 0) + s.get('reused', 0)}/{s['jobs']}" if 'jobs' in s
+                    else f"0/{self.planned.get(name, {}).get('jobs', '?')}")
+            median = f'{medians[name]:.1f}s' if name in medians else ''
+            cals = self.calibrations.get(name)
+            cals = f"{cals['matched']} matched, {cals['unresolved']} unresolved" if cals else ''
+            lines.append('%-10s %-11s %9s %7s %9s  %s' % (name, s['state'], jobs,
+                                                        s.get('failed', ''), median, cals))
+
+        if self.running:
+            lines.append('')
+            lines.append('running')
+            for job, r in sorted(self.running.items(), key=lambda kv: kv[1]['start']):
+                elapsed = now - r['start']
+                median = medians.get(r['stage'])
+                flag = '  STALLED?' if median and elapsed > SLOW_FACTOR * median else ''
+                lines.append(f"  {job:40s} {_duration(elapsed):>9s}  {r['where']}{flag}")
+        slow = self.outliers()
+        if slow:
+            lines.append('')
+            lines.append(f'slowest files (more than {SLOW_FACTOR:g}x the stage median)')
+            for e in slow:
+                lines.append(f"  {e['job']:40s} {e['wall_s']:8.1f}s  "
+                             f"{e['wall_s'] / medians[e['stage']]:.1f}x")
+        if self.unresolved:
+            lines.append('')
+            lines.append('calibrations not resolved up front, left to Reduce')
+            for e in self.unresolved[-5:]:
+                lines.append(f"  {e['job']:40s} {e['caltype']}")
+        return '\n'.join(lines)
+
+
+def _duration(seconds):
+    seconds = int(max(seconds, 0))
+    return f'{seconds // 3600:d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Dashboard of a gem_reduce --telemetry stream')
+    parser.add_argument('target', help='event file, or unix:PATH to listen on a socket')
+    parser.add_argument('--interval', type=float, default=2.0,
+                        help='default=2; seconds between refreshes')
+    parser.add_argument('--once', action='store_true',
+                        help='print the state of the file once and exit')
+    args = parser.parse_args()
+
+    progress = Progress()
+    stream = follow(args.target)
+    if args.once:
+        for e in next(stream):
+            progress.add(e)
+        print(progress.render())
+        return 0
+    try:
+        while True:
+            for e in next(stream):
+                progress.add(e)
+            #clear the screen and redraw
+            sys.stdout.write('\033[H\033[2J' + progress.render() + '\n')
+            sys.stdout.flush()
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,57 @@
+#Stub Reduce runners for scheduler tests: they write placeholder products
+#instead of running DRAGONS, and fail on request.
+
+import os
+
+from scheduler import Stage
+
+
+def product(path):
+    return os.path.basename(path).replace('.fits', '_flat.fits')
+
+
+def fake_worker(job, dbfile, workroot):
+    """Stands in for parallel.run_job: one product per input in a private
+    directory, and a failed Reduce for inputs named bad*."""
+    workdir = os.path.join(workroot, job['name'])
+    os.makedirs(workdir, exist_ok=True)
+    result = {'name': job['name'], 'stage': job['stage'], 'files': job['files'],
+              'workdir': workdir, 'log': os.path.join(workdir, job['name'] + '.log'),
+              'outputs': [], 'calibrations': [], 'ok': False, 'error': None,
+              'metrics': {}}
+    if any(os.path.basename(f).startswith('bad') for f in job['files']):
+        result['error'] = 'Reduce failed'
+        return result
+    for f in job['files']:
+        out = os.path.join(workdir, product(f))
+        with open(out, 'w') as fh:
+            fh.write(job['name'])
+        result['outputs'].append(out)
+    result['ok'] = True
+    return result
+
+
+class FakeRunner:
+    """Stands in for parallel.run_inline, writing one product per input in
+    the current directory.  Jobs of an input in fail write part of their
+    product and raise."""
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.calls = []
+
+    def __call__(self, job):
+        self.calls.append(job['name'])
+        outputs = []
+        for f in job['files']:
+            with open(product(f), 'w') as fh:
+                fh.write(job['name'])
+            if f in self.fail:
+                raise RuntimeError(f'Reduce failed on {f}')
+            outputs.append(product(f))
+        return outputs
+
+
+def stages(flats):
+    return [Stage('flats', flats, provides=['processed_flat'], per_file=True),
+            Stage('arcs', ['arc.fits'], needs=['processed_flat'], per_file=True)]
@@ -0,0 +1,41 @@
+#The keys under which calibrations are resolved once and forced on every
+#frame that shares them.
+
+from associations import Associator
+
+
+class FakeIndex:
+    def __init__(self, descriptors):
+        self.descriptors = descriptors
+
+    def descriptor(self, path, name):
+        return self.descriptors[path].get(name)
+
+
+BASE = {'detector_roi_setting': 'Full Frame', 'detector_x_bin': 2, 'detector_y_bin': 2,
+        'gain_setting': 'low', 'read_speed_setting': 'slow',
+        'amp_read_area': ["'BI5-36-4-1':[1:512,1:4224]", "'BI5-36-4-2':[513:1024,1:4224]"],
+        'disperser': 'B600+_G5323', 'central_wavelength': 5.2e-07,
+        'ut_datetime': '2017-10-22T03:00:00'}
+
+
+def associator(**frames):
+    return Associator(None, FakeIndex({name: dict(BASE, **values)
+                                       for name, values in frames.items()}))
+
+
+def test_bias_key_separates_readout_modes():
+    a = associator(slow={}, fast={'read_speed_setting': 'fast'}, high={'gain_setting': 'high'},
+                   later={'ut_datetime': '2017-10-22T09:00:00'})
+    keys = {name: a.key('processed_bias', name) for name in ('slow', 'fast', 'high', 'later')}
+    assert len({keys['slow'], keys['fast'], keys['high']}) == 3
+    #same night and readout mode, same bias
+    assert keys['slow'] == keys['later']
+    hash(keys['slow'])
+
+
+def test_standard_key_separates_science_setups():
+    a = associator(blue={}, red={'central_wavelength': 5.3e-07},
+                   stamp={'detector_roi_setting': 'Central Spectrum'})
+    keys = {a.key('processed_standard', name) for name in ('blue', 'red', 'stamp')}
+    assert len(keys) == 3
@@ -0,0 +1,156 @@
+#Chunked bias stacking: how the frames are split and when the levels of
+#sub-stacks stop.
+
+import pytest
+
+from biasstack import chunks, combine_planes
+from scheduler import Scheduler, Stage
+
+
+def test_chunks_are_even():
+    sizes = [len(c) for c in chunks(list(range(17)), 8)]
+    assert sizes == [6, 5, 6]
+    assert chunks(list(range(3)), 8) == [[0, 1, 2]]
+
+
+class StackRunner:
+    """Stands in for Reduce: one sub-stack per job, or with keep one
+    product per input, as a stack that never combines would."""
+
+    def __init__(self, keep=False):
+        self.keep = keep
+        self.calls = []
+
+    def __call__(self, job):
+        self.calls.append(job['name'])
+        if self.keep:
+            return [f"{job['name']}_{i}.fits" for i in range(len(job['files']))]
+        return [job['name'] + '.fits']
+
+
+def bias_stage(nfiles, chunk):
+    return Stage('biassci', [f'bias{i}.fits' for i in range(nfiles)],
+                 provides=['processed_bias'], chunk=chunk)
+
+
+def test_chunked_stack_levels(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    runner = StackRunner()
+    sched = Scheduler([bias_stage(20, 3)], None)
+    sched.runner = runner
+    outputs = sched.run()
+    #7 chunks, 3 groups of sub-stacks, then the combine
+    assert len([c for c in runner.calls if '_L0_' in c]) == 7
+    assert len([c for c in runner.calls if '_L1_' in c]) == 3
+    assert outputs['biassci'] == ['biassci_combine.fits']
+
+
+@pytest.mark.parametrize('chunk', [1, -2])
+def test_chunk_below_two_is_refused(tmp_path, monkeypatch, chunk):
+    monkeypatch.chdir(tmp_path)
+    sched = Scheduler([bias_stage(3, chunk)], None)
+    sched.runner = StackRunner()
+    with pytest.raises(ValueError, match='never reduce'):
+        sched.run()
+
+
+def test_level_that_does_not_combine_stops(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    runner = StackRunner(keep=True)
+    sched = Scheduler([bias_stage(6, 2)], None)
+    sched.runner = runner
+    with pytest.raises(RuntimeError, match='not fewer'):
+        sched.run()
+    assert len(runner.calls) == 3
+
+
+#combine_planes against a stack of all frames at once.  The reference is
+#the inverse-variance weighted mean that the chunks are assumed to make,
+#not DRAGONS' stackBiases (an unweighted mean with its own rejection), so
+#these tests show that combining sub-stacks loses nothing against stacking
+#the same way in one pass; they do not show that a chunked master bias
+#equals the one Reduce makes from all frames.  Nor do they reject outliers:
+#with rejection inside each chunk the results differ by the noise of the
+#rejected pixels, and more where a chunk holds too few frames to reject
+#two cosmic rays on the same pixel.
+
+READ_NOISE = 3.5
+#DQ bits used by DRAGONS: bad pixel, saturated, cosmic ray
+DQ_BITS = (1, 4, 8)
+
+
+def make_frames(nframes, shape, seed):
+    """Data, variance and DQ planes of synthetic biases, with pixels flagged
+    with different bits in different frames, some of them in every frame."""
+    np = pytest.importorskip('numpy')
+    rng = np.random.default_rng(seed)
+    pattern = 1000.0 + 5.0 * np.sin(np.arange(shape[1]) / 40.0)[None, :]
+    datas, variances, masks = [], [], []
+    for i in range(nframes):
+        datas.append((pattern + rng.normal(0.0, READ_NOISE, shape)).astype(np.float32))
+        variances.append(np.full(shape, READ_NOISE ** 2, dtype=np.float32))
+        mask = np.where(rng.random(shape) < 0.05, rng.choice(DQ_BITS, shape), 0)
+        #flagged in every frame, with a bit that changes from frame to frame
+        mask[:, 0] = DQ_BITS[i % len(DQ_BITS)]
+        masks.append(mask.astype(np.uint16))
+    return datas, variances, masks
+
+
+def stack(datas, variances, masks):
+    """Inverse-variance weighted mean of the pixels not flagged in DQ;
+    pixels flagged in every frame keep the mean and all their flags."""
+    import numpy as np
+
+    data = np.asarray(datas, dtype=np.float64)
+    var = np.asarray(variances, dtype=np.float64)
+    mask = np.asarray(masks)
+    weight = np.where(mask == 0, 1.0 / var, 0.0)
+    wsum = weight.sum(axis=0)
+    covered = wsum > 0
+    out = np.where(covered, (weight * data).sum(axis=0) / np.where(covered, wsum, 1.0),
+                   data.mean(axis=0))
+    outvar = np.where(covered, 1.0 / np.where(covered, wsum, 1.0), var.mean(axis=0) / len(var))
+    outmask = np.where(covered, 0, np.bitwise_or.reduce(mask, axis=0)).astype(mask.dtype)
+    return out.astype(np.float32), outvar.astype(np.float32), outmask
+
+
+def chunked_stack(datas, variances, masks, size):
+    """Stack in chunks of size and combine the sub-stacks in groups of size,
+    level by level, as run_chunked does."""
+    planes, counts = [], []
+    for part in chunks(list(range(len(datas))), size):
+        planes.append(stack([datas[i] for i in part], [variances[i] for i in part],
+                            [masks[i] for i in part]))
+        counts.append(len(part))
+    while True:
+        groups = chunks(list(range(len(planes))), size)
+        planes, counts = ([combine_planes([planes[i][0] for i in g], [planes[i][1] for i in g],
+                                          [planes[i][2] for i in g], [counts[i] for i in g])
+                           for g in groups],
+                          [sum(counts[i] for i in g) for g in groups])
+        if len(planes) == 1:
+            return planes[0]
+
+
+def test_combine_planes_keeps_every_flag_of_uncovered_pixels():
+    np = pytest.importorskip('numpy')
+    datas = [np.array([[10.0, 20.0]], dtype=np.float32), np.array([[30.0, 40.0]], dtype=np.float32)]
+    variances = [np.array([[1.0, 1.0]]), np.array([[3.0, 1.0]])]
+    masks = [np.array([[0, 1]], dtype=np.uint16), np.array([[0, 8]], dtype=np.uint16)]
+    data, variance, mask = combine_planes(datas, variances, masks)
+    assert mask.tolist() == [[0, 9]]
+    assert data[0, 0] == pytest.approx((10.0 / 1.0 + 30.0 / 3.0) / (1.0 + 1.0 / 3.0))
+    assert variance[0, 0] == pytest.approx(1.0 / (1.0 + 1.0 / 3.0))
+
+
+@pytest.mark.parametrize('nframes,size', [(150, 8), (40, 3), (5, 8)])
+def test_chunked_stack_matches_single_pass(nframes, size):
+    np = pytest.importorskip('numpy')
+    datas, variances, masks = make_frames(nframes, (32, 64), seed=nframes)
+    data1, var1, mask1 = stack(datas, variances, masks)
+    data2, var2, mask2 = chunked_stack(datas, variances, masks, size)
+    assert np.array_equal(mask1, mask2)
+    assert (mask1[:, 0] == np.bitwise_or.reduce(DQ_BITS)).all()
+    good = mask1 == 0
+    assert np.allclose(data2[good], data1[good], rtol=0, atol=1e-3 * READ_NOISE)
+    assert np.allclose(var2[good], var1[good], rtol=1e-5)
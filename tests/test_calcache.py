@@ -0,0 +1,69 @@
+#Lookup and least recently used eviction of the calibration cache.
+
+from calcache import CalCache
+from scheduler import Stage
+
+
+SLOW_LOW = {'gain_setting': 'low', 'read_speed_setting': 'slow',
+            'amp_read_area': ["'BI5-36-4k-2, 1':[1:512,1:4224]"]}
+
+
+def write(path, text, size=100):
+    with open(path, 'w') as fh:
+        fh.write(text.ljust(size))
+    return str(path)
+
+
+class FakeIndex:
+    """Descriptors of the raw biases, as the header index returns them."""
+
+    def __init__(self, descriptors):
+        self.descriptors = descriptors
+
+    def descriptor(self, path, name):
+        return self.descriptors[path].get(name)
+
+
+def test_calcache_evicts_least_recently_used(tmp_path):
+    raws = {}
+    for i, roi in enumerate(['Full Frame', 'Central Spectrum', 'Central Stamp']):
+        raws[str(tmp_path / f'bias{i}.fits')] = {
+            'detector_name': 'Hamamatsu', 'detector_roi_setting': roi,
+            'detector_x_bin': 2, 'detector_y_bin': 2, **SLOW_LOW,
+            'ut_datetime': '2025-10-24T06:00:00'}
+    stage = Stage('bias', list(raws), provides=['processed_bias'])
+    jobs = [{'name': f'bias{i}', 'stage': 'bias', 'files': [raw]}
+            for i, raw in enumerate(raws)]
+    cache = CalCache(str(tmp_path / 'cache'), FakeIndex(raws), capacity=250)
+    outdir = tmp_path / 'out'
+    outdir.mkdir()
+
+    cache.store(stage, jobs[0], [write(tmp_path / 'bias0_bias.fits', 'bias0')])
+    cache.store(stage, jobs[1], [write(tmp_path / 'bias1_bias.fits', 'bias1')])
+    #reusing the first makes the second the least recently used
+    assert cache.fetch(stage, jobs[:1], destdir=str(outdir))
+    cache.store(stage, jobs[2], [write(tmp_path / 'bias2_bias.fits', 'bias2')])
+
+    assert cache.stats['evicted'] == 1
+    restored = cache.fetch(stage, jobs, destdir=str(outdir))
+    assert sorted(restored) == ['bias0', 'bias2']
+
+
+def test_calcache_bias_needs_the_same_readout_mode(tmp_path):
+    slow = str(tmp_path / 'slow.fits')
+    fast = str(tmp_path / 'fast.fits')
+    common = {'detector_name': 'Hamamatsu', 'detector_roi_setting': 'Full Frame',
+              'detector_x_bin': 2, 'detector_y_bin': 2, 'ut_datetime': '2025-10-24T06:00:00'}
+    raws = {slow: dict(common, **SLOW_LOW),
+            fast: dict(common, **SLOW_LOW) | {'gain_setting': 'high', 'read_speed_setting': 'fast'}}
+    stage = Stage('bias', list(raws), provides=['processed_bias'])
+    cache = CalCache(str(tmp_path / 'cache'), FakeIndex(raws))
+    assert cache.key('processed_bias', [slow]) != cache.key('processed_bias', [fast])
+    assert cache.key('processed_bias', [slow, fast]) is None
+
+    outdir = tmp_path / 'out'
+    outdir.mkdir()
+    cache.store(stage, {'name': 'slow', 'stage': 'bias', 'files': [slow]},
+                [write(tmp_path / 'slow_bias.fits', 'slow')])
+    job = {'name': 'fast', 'stage': 'bias', 'files': [fast]}
+    assert not cache.fetch(stage, [job], destdir=str(outdir))
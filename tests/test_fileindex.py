@@ -0,0 +1,95 @@
+#Selection and caching of the header index, with a stub metadata reader.
+
+import pytest
+
+from fileindex import FileIndex
+
+
+FRAMES = {
+    'bias_ff.fits': (['BIAS', 'CAL', 'GMOS'], {'detector_roi_setting': 'Full Frame'}),
+    'bias_cs.fits': (['BIAS', 'CAL', 'GMOS'], {'detector_roi_setting': 'Central Spectrum'}),
+    'flat.fits': (['CAL', 'FLAT', 'GMOS', 'SPECT'], {'detector_roi_setting': 'Full Frame'}),
+    'std.fits': (['CAL', 'GMOS', 'SPECT', 'STANDARD'],
+                 {'detector_roi_setting': 'Central Spectrum', 'object': 'LTT1020'}),
+    'sci.fits': (['GMOS', 'SPECT'], {'detector_roi_setting': 'Full Frame',
+                                     'object': 'J2145+0031', 'exposure_time': 900.0}),
+}
+
+KEYS = ('detector_roi_setting', 'object', 'exposure_time')
+
+
+class Reader:
+    """Metadata of FRAMES by file name, counting the files it opens."""
+
+    def __init__(self):
+        self.opened = []
+
+    def __call__(self, path):
+        self.opened.append(path)
+        tags, descriptors = FRAMES[path.rsplit('/', 1)[-1]]
+        #like read_metadata, every descriptor is there, None if it failed
+        return tags, dict.fromkeys(KEYS) | descriptors, 12
+
+
+@pytest.fixture
+def frames(tmp_path):
+    paths = {}
+    for name in FRAMES:
+        (tmp_path / name).write_text(name)
+        paths[name] = str(tmp_path / name)
+    return paths
+
+
+@pytest.fixture
+def index(tmp_path, frames):
+    index = FileIndex(str(tmp_path / 'index.db'))
+    index.update(list(frames.values()), reader=Reader())
+    yield index
+    index.close()
+
+
+def names(paths):
+    return [p.rsplit('/', 1)[-1] for p in paths]
+
+
+def test_select_by_tags(index):
+    assert names(index.select(['BIAS'])) == ['bias_ff.fits', 'bias_cs.fits']
+    assert names(index.select(['CAL'], ['BIAS', 'STANDARD'])) == ['flat.fits']
+    assert names(index.select(['SPECT'], ['CAL'])) == ['sci.fits']
+
+
+def test_select_by_expression(index):
+    assert names(index.select(['BIAS'], [], 'detector_roi_setting=="Central Spectrum"')) \
+        == ['bias_cs.fits']
+    assert names(index.select([], [], 'object=="J2145+0031" and exposure_time > 600')) \
+        == ['sci.fits']
+
+
+def test_select_cannot_reach_builtins(index):
+    with pytest.raises(NameError):
+        index.select([], [], '__import__("os")')
+
+
+def test_only_new_or_modified_files_are_opened(tmp_path, frames):
+    dbfile = str(tmp_path / 'index.db')
+    reader = Reader()
+    index = FileIndex(dbfile)
+    assert index.update(list(frames.values()), reader=reader) == len(FRAMES)
+    index.close()
+
+    with open(frames['flat.fits'], 'a') as fh:
+        fh.write('modified')
+    index = FileIndex(dbfile)
+    assert index.update(list(frames.values()), reader=reader) == 1
+    assert names(reader.opened[len(FRAMES):]) == ['flat.fits']
+    assert index.record(frames['flat.fits'])['nextn'] == 12
+    index.close()
+
+
+def test_add_extends_the_selection(tmp_path, frames):
+    index = FileIndex(str(tmp_path / 'index.db'))
+    index.update([frames['bias_ff.fits']], reader=Reader())
+    records = index.add([frames['bias_cs.fits'], frames['bias_ff.fits']], reader=Reader())
+    assert [r['tags'] for r in records] == [{'BIAS', 'CAL', 'GMOS'}] * 2
+    assert names(index.select(['BIAS'])) == ['bias_ff.fits', 'bias_cs.fits']
+    index.close()
@@ -0,0 +1,121 @@
+#Header-only reading of plain, bzip2 and tile-compressed FITS files.
+
+import bz2
+
+import pytest
+
+import fitsheader
+from fitsheader import BLOCK, CARD, parse, read_headers, uncompressed_header
+
+
+def card(key, value=None, comment=''):
+    if value is None:
+        return key.ljust(CARD)
+    if isinstance(value, bool):
+        text = 'T' if value else 'F'
+    elif isinstance(value, str):
+        text = "'" + value.replace("'", "''").ljust(8) + "'"
+    else:
+        text = str(value)
+    text = f'{key:<8}= {text:>20}' + (f' / {comment}' if comment else '')
+    return text.ljust(CARD)
+
+
+def header(*cards):
+    text = ''.join(card(*c) for c in cards) + card('END')
+    return text + ' ' * (-len(text) % BLOCK)
+
+
+def data_unit(nbytes, fill=b'\x01'):
+    return fill * nbytes + b'\0' * (-nbytes % BLOCK)
+
+
+def image_file():
+    """Primary without data, a 100x30 int16 image and a 10x10 float32 image."""
+    primary = header(('SIMPLE', True), ('BITPIX', 8), ('NAXIS', 0), ('EXTEND', True),
+                     ('OBJECT', "O'Brien's star", 'target'), ('EXPTIME', 1.5e2))
+    sci1 = header(('XTENSION', 'IMAGE'), ('BITPIX', 16), ('NAXIS', 2),
+                  ('NAXIS1', 100), ('NAXIS2', 30), ('PCOUNT', 0), ('GCOUNT', 1),
+                  ('EXTNAME', 'SCI'), ('EXTVER', 1))
+    sci2 = header(('XTENSION', 'IMAGE'), ('BITPIX', -32), ('NAXIS', 2),
+                  ('NAXIS1', 10), ('NAXIS2', 10), ('PCOUNT', 0), ('GCOUNT', 1),
+                  ('EXTNAME', 'SCI'), ('EXTVER', 2))
+    return (primary.encode() + sci1.encode() + data_unit(100 * 30 * 2)
+            + sci2.encode() + data_unit(10 * 10 * 4))
+
+
+def test_card_values():
+    values = parse(header(('SIMPLE', True), ('NAXIS', 0), ('EXPTIME', 1.5e2),
+                          ('AIRMASS', '1.2D0'), ('OBJECT', "O'Brien's star", 'target'),
+                          ('COMMENT',)))
+    assert values == {'SIMPLE': True, 'NAXIS': 0, 'EXPTIME': 150.0,
+                      'AIRMASS': '1.2D0', 'OBJECT': "O'Brien's star"}
+    #Fortran exponents
+    assert parse('ELEVATIO=              7.25D1'.ljust(CARD))['ELEVATIO'] == 72.5
+
+
+@pytest.mark.parametrize('values,size', [
+    ({'NAXIS': 0}, 0),
+    ({'BITPIX': 16, 'NAXIS': 2, 'NAXIS1': 100, 'NAXIS2': 30}, 3 * BLOCK),
+    ({'BITPIX': -32, 'NAXIS': 2, 'NAXIS1': 720, 'NAXIS2': 1}, BLOCK),
+    #binary table with a heap
+    ({'BITPIX': 8, 'NAXIS': 2, 'NAXIS1': 8, 'NAXIS2': 10, 'PCOUNT': 3000}, 2 * BLOCK),
+])
+def test_data_size_is_padded_to_blocks(values, size):
+    assert fitsheader._data_size(values) == size
+
+
+@pytest.mark.parametrize('suffix', ['.fits', '.fits.bz2'])
+def test_read_headers_skips_data_units(tmp_path, suffix):
+    path = tmp_path / ('frame' + suffix)
+    raw = image_file()
+    path.write_bytes(bz2.compress(raw) if suffix.endswith('.bz2') else raw)
+    headers = read_headers(str(path))
+    assert [parse(h).get('EXTVER') for h in headers] == [None, 1, 2]
+    assert parse(headers[0])['OBJECT'] == "O'Brien's star"
+    assert parse(headers[2])['BITPIX'] == -32
+    assert all(len(h) % BLOCK == 0 for h in headers)
+    assert len(read_headers(str(path), max_headers=2)) == 2
+
+
+def fz_header():
+    #header of a 100x30 int16 image tile-compressed by fpack
+    return header(('XTENSION', 'BINTABLE'), ('BITPIX', 8), ('NAXIS', 2),
+                  ('NAXIS1', 8), ('NAXIS2', 30), ('PCOUNT', 1234), ('GCOUNT', 1),
+                  ('TFIELDS', 1), ('TTYPE1', 'COMPRESSED_DATA'), ('TFORM1', '1PB(94)'),
+                  ('ZIMAGE', True), ('ZTILE1', 100), ('ZTILE2', 1),
+                  ('ZCMPTYPE', 'RICE_1'), ('ZNAME1', 'BLOCKSIZE'), ('ZVAL1', 32),
+                  ('ZTENSION', 'IMAGE'), ('ZBITPIX', 16), ('ZNAXIS', 2),
+                  ('ZNAXIS1', 100), ('ZNAXIS2', 30), ('ZPCOUNT', 0), ('ZGCOUNT', 1),
+                  ('EXTNAME', 'SCI'), ('EXTVER', 1), ('GAIN', 1.6))
+
+
+def test_fz_header_is_rewritten_as_the_image():
+    text = uncompressed_header(fz_header())
+    keys = [text[i:i + 8].strip() for i in range(0, len(text), CARD)]
+    keys = keys[:keys.index('END')]
+    assert keys == ['XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'PCOUNT',
+                    'GCOUNT', 'EXTNAME', 'EXTVER', 'GAIN']
+    assert parse(text) == {'XTENSION': 'IMAGE', 'BITPIX': 16, 'NAXIS': 2,
+                           'NAXIS1': 100, 'NAXIS2': 30, 'PCOUNT': 0, 'GCOUNT': 1,
+                           'EXTNAME': 'SCI', 'EXTVER': 1, 'GAIN': 1.6}
+    assert len(text) % BLOCK == 0
+
+
+def test_plain_header_is_unchanged():
+    text = header(('XTENSION', 'IMAGE'), ('BITPIX', 16), ('NAXIS', 0))
+    assert uncompressed_header(text) is text
+
+
+def test_read_headers_of_fz_file(tmp_path):
+    primary = header(('SIMPLE', True), ('BITPIX', 8), ('NAXIS', 0), ('EXTEND', True))
+    #table of 30 rows of 8 bytes followed by the heap
+    raw = primary.encode() + fz_header().encode() + data_unit(8 * 30 + 1234)
+    raw += header(('XTENSION', 'IMAGE'), ('BITPIX', 8), ('NAXIS', 0),
+                  ('EXTNAME', 'MDF')).encode()
+    path = tmp_path / 'frame.fits.fz'
+    path.write_bytes(raw)
+    headers = read_headers(str(path))
+    assert len(headers) == 3
+    assert parse(headers[1])['NAXIS1'] == 100
+    assert parse(headers[2])['EXTNAME'] == 'MDF'
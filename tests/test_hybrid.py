@@ -0,0 +1,73 @@
+#Splitting a recipe at its interactive primitive, with a stub primitive set.
+
+import pytest
+
+import hybrid
+from hybrid import _Split, _Stop, batch_job, fit_job
+
+
+class Primitives:
+    """Records the primitives it is asked to run."""
+
+    mode = 'sq'
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def primitive(**params):
+            self.calls.append(name)
+        return primitive
+
+
+def makeProcessedFlat(p):
+    p.prepare()
+    p.biasCorrect()
+    p.normalizeFlat()
+    p.thresholdFlatfield()
+    p.storeProcessedFlat()
+
+
+def test_batch_part_stops_at_the_primitive():
+    p = Primitives()
+    with pytest.raises(_Stop):
+        makeProcessedFlat(_Split(p, 'normalizeFlat', fit=False))
+    assert p.calls == ['prepare', 'biasCorrect']
+
+
+def test_fit_part_skips_what_the_batch_part_ran():
+    p = Primitives()
+    split = _Split(p, 'normalizeFlat', fit=True)
+    makeProcessedFlat(split)
+    assert p.calls == ['normalizeFlat', 'thresholdFlatfield', 'storeProcessedFlat']
+    assert split._reached
+
+
+def test_fit_part_of_a_recipe_without_the_primitive_runs_nothing():
+    p = Primitives()
+    split = _Split(p, 'findApertures', fit=True)
+    makeProcessedFlat(split)
+    assert p.calls == []
+    assert not split._reached
+
+
+def test_attributes_pass_through():
+    assert _Split(Primitives(), 'normalizeFlat', fit=False).mode == 'sq'
+
+
+def test_batch_and_fit_jobs():
+    job = {'name': 'flats_0000_a', 'stage': 'flats', 'files': ['a.fits'],
+           'uparms': {'interactive': True, 'normalizeFlat:interactive': True,
+                      'normalizeFlat:order': 20}}
+    batch = batch_job(job, 'normalizeFlat')
+    assert batch['name'] == 'flats_0000_a_batch'
+    assert batch['uparms'] == {'normalizeFlat:order': 20}
+    assert batch['recipename'].endswith('hybrid.batch_normalizeFlat')
+    assert callable(getattr(hybrid, batch['recipename'].rsplit('.', 1)[1]))
+
+    fit = fit_job(job, 'normalizeFlat', ['a_flat.fits'])
+    assert (fit['name'], fit['files'], fit['nfiles']) == ('flats_0000_a_fit', ['a_flat.fits'], 0)
+    assert fit['uparms'] == job['uparms']
@@ -0,0 +1,66 @@
+#Checkpoints of finished jobs and resuming an interrupted run.
+
+import os
+
+import pytest
+
+from journal import Journal
+from scheduler import Scheduler
+from stubs import FakeRunner, product, stages
+
+
+def test_resume_runs_only_unfinished_jobs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    flats = ['a.fits', 'b.fits', 'c.fits', 'd.fits']
+    journal = str(tmp_path / 'journal.jsonl')
+    partial = str(tmp_path / 'partial')
+
+    first = FakeRunner(fail=['c.fits'])
+    sched = Scheduler(stages(flats)[:1], None, journal=Journal(journal, partial))
+    sched.runner = first
+    with pytest.raises(RuntimeError):
+        sched.run()
+    assert first.calls == ['flats_0000_a', 'flats_0001_b', 'flats_0002_c']
+
+    second = FakeRunner()
+    sched = Scheduler(stages(flats)[:1], None, journal=Journal(journal, partial),
+                      resume=True)
+    sched.runner = second
+    outputs = sched.run()
+    assert second.calls == ['flats_0002_c', 'flats_0003_d']
+    assert [os.path.basename(f) for f in outputs['flats']] == [product(f) for f in flats]
+    #the product the interrupted job left behind was moved aside
+    assert os.path.exists(os.path.join(partial, 'flats_0002_c', 'c_flat.fits'))
+
+
+def test_truncated_last_line_is_ignored(tmp_path):
+    filename = str(tmp_path / 'journal.jsonl')
+    journal = Journal(filename)
+    journal.begin('flats', 'abc')
+    journal.start({'stage': 'flats', 'name': 'flats_0000_a'})
+    with open(filename, 'a') as fh:
+        fh.write('{"event": "job", "stage": "fl')
+
+    journal = Journal(filename)
+    assert list(journal.stages['flats']['jobs']) == ['flats_0000_a']
+    #and the file is rewritten without it
+    with open(filename) as fh:
+        assert len(fh.readlines()) == 2
+
+
+def test_changed_output_is_run_again(tmp_path):
+    out = tmp_path / 'a_flat.fits'
+    out.write_text('first')
+    job = {'stage': 'flats', 'name': 'flats_0000_a', 'files': ['a.fits']}
+    journal = Journal(str(tmp_path / 'journal.jsonl'), str(tmp_path / 'partial'))
+    journal.begin('flats', 'abc')
+    journal.start(job)
+    journal.done(job, [str(out)])
+
+    journal = Journal(journal.filename, journal.partialdir)
+    assert journal.resume('flats', 'abc', [job]) == {job['name']: [str(out)]}
+    out.write_text('second')
+    assert journal.resume('flats', 'abc', [job]) == {}
+    #a new fingerprint forgets every checkpoint of the stage
+    assert journal.resume('flats', 'xyz', [job]) == {}
+    assert journal.stages['flats']['jobs'] == {}
@@ -0,0 +1,70 @@
+#Which stages a rerun has to redo.
+
+import os
+
+import pytest
+
+from manifest import Manifest, plan_stale
+from scheduler import Stage, build_graph
+
+
+@pytest.fixture
+def night(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name in ('bias.fits', 'flat.fits', 'arc.fits', 'sci.fits'):
+        (tmp_path / name).write_text(name)
+    return [Stage('biases', ['bias.fits'], provides=['processed_bias']),
+            Stage('flats', ['flat.fits'], needs=['processed_bias'],
+                  provides=['processed_flat']),
+            Stage('arcs', ['arc.fits'], needs=['processed_bias', 'processed_flat'],
+                  provides=['processed_arc']),
+            Stage('science', ['sci.fits'], needs=['processed_flat', 'processed_arc'])]
+
+
+def finish(manifest, stages):
+    """Record every stage as finished, with one output each."""
+    fingerprints, _ = plan_stale(stages, build_graph(stages), manifest)
+    for stage in stages:
+        out = stage.name + '_out.fits'
+        with open(out, 'w') as fh:
+            fh.write(fingerprints[stage.name])
+        manifest.record(stage, fingerprints[stage.name], [out])
+
+
+def stale(stages, manifest):
+    return plan_stale(stages, build_graph(stages), manifest)[1]
+
+
+def test_first_run_runs_everything(night):
+    assert stale(night, Manifest()) == {'biases', 'flats', 'arcs', 'science'}
+
+
+def test_changed_input_runs_everything_downstream(night):
+    manifest = Manifest()
+    finish(manifest, night)
+    assert stale(night, Manifest()) == set()
+
+    with open('flat.fits', 'a') as fh:
+        fh.write('new')
+    assert stale(night, Manifest()) == {'flats', 'arcs', 'science'}
+
+
+def test_changed_uparms_or_output_runs_the_stage(night):
+    manifest = Manifest()
+    finish(manifest, night)
+    night[3].uparms = {'skyCorrectFromSlit:order': 2}
+    assert stale(night, Manifest()) == {'science'}
+
+    night[3].uparms = {}
+    os.remove('arcs_out.fits')
+    assert stale(night, Manifest()) == {'arcs', 'science'}
+
+
+def test_recorded_stages_outside_the_run_count_upstream(night):
+    manifest = Manifest()
+    finish(manifest, night)
+    #only the science is scheduled; its flats were since redone differently
+    manifest.stages['flats']['fingerprint'] = 'redone'
+    assert stale(night[3:], manifest) == {'science'}
+    manifest = Manifest()
+    assert stale(night[3:], manifest) == set()
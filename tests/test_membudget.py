@@ -0,0 +1,83 @@
+#Memory estimates of jobs and their admission on the worker pool.
+
+import threading
+
+import pytest
+
+from membudget import (BASE_BYTES, BYTES_PER_PIXEL, EXTENSION_BYTES, GB, ROI_PIXELS,
+                       WORK_COPIES, MemoryEstimator, MemoryGate, frame_bytes, parse_size)
+
+
+class FakeIndex:
+    def __init__(self, records):
+        self.records = records
+
+    def record(self, path):
+        return self.records[path]
+
+
+def frame(roi, binning=2, nextn=12):
+    return {'descriptors': {'detector_roi_setting': roi, 'detector_x_bin': binning,
+                            'detector_y_bin': binning}, 'nextn': nextn}
+
+
+@pytest.mark.parametrize('text,nbytes', [('64G', 64 * GB), ('500M', 500 * 1024 ** 2),
+                                         ('2.5', 2.5 * GB), ('1TB', 1024 * GB)])
+def test_parse_size(text, nbytes):
+    assert parse_size(text) == int(nbytes)
+
+
+def test_parse_size_refuses_nonsense():
+    with pytest.raises(ValueError):
+        parse_size('lots')
+
+
+def test_frame_bytes_scales_with_roi_and_binning():
+    full = frame_bytes(frame('Full Frame', 1)['descriptors'], 12)
+    assert full == ROI_PIXELS['Full Frame'] * BYTES_PER_PIXEL + 12 * EXTENSION_BYTES
+    binned = frame_bytes(frame('Full Frame', 2)['descriptors'], 12)
+    assert binned - 12 * EXTENSION_BYTES == (full - 12 * EXTENSION_BYTES) // 4
+    stamp = frame_bytes(frame('Central Stamp', 1)['descriptors'], 2)
+    assert stamp < frame_bytes(frame('Central Spectrum', 1)['descriptors'], 2) < full
+
+
+def test_stacking_job_holds_every_frame(tmp_path):
+    substack = tmp_path / 'bias_sub.fits'
+    substack.write_bytes(bytes(1000))
+    index = FakeIndex({'a.fits': frame('Full Frame'), 'b.fits': frame('Central Spectrum')})
+    estimate = MemoryEstimator(index)
+    a = frame_bytes(index.records['a.fits']['descriptors'], 12)
+    b = frame_bytes(index.records['b.fits']['descriptors'], 12)
+
+    assert estimate({'files': ['a.fits']}) == BASE_BYTES + WORK_COPIES * a
+    assert estimate({'files': ['a.fits', 'b.fits']}) == \
+        BASE_BYTES + a + b + (WORK_COPIES - 1) * a
+    #sub-stacks are not in the index
+    assert estimate({'files': [str(substack)]}) == BASE_BYTES + WORK_COPIES * 2000
+
+
+def test_gate_waits_for_room():
+    gate = MemoryGate(10)
+    gate.acquire(6)
+    started = threading.Event()
+
+    def second():
+        gate.acquire(6)
+        started.set()
+
+    thread = threading.Thread(target=second)
+    thread.start()
+    assert not started.wait(0.1)
+    gate.release(6)
+    assert started.wait(5)
+    thread.join()
+    assert (gate.used, gate.running) == (6, 1)
+
+
+def test_gate_runs_an_oversized_job_alone(capsys):
+    gate = MemoryGate(10)
+    gate.acquire(25)
+    assert 'running it alone' in capsys.readouterr().out
+    assert (gate.used, gate.running) == (25, 1)
+    gate.release(25)
+    assert (gate.used, gate.running) == (0, 0)
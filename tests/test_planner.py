@@ -0,0 +1,40 @@
+#Wall time estimate of a plan on the worker pool.
+
+import pytest
+
+from planner import simulate
+
+
+GRAPH = {'biases': set(), 'flats': {'biases'}, 'arcs': {'biases', 'flats'},
+         'science': {'flats', 'arcs'}}
+ORDER = ['biases', 'flats', 'arcs', 'science']
+
+
+def test_one_worker_runs_everything_in_turn():
+    durations = {'biases': [10.0], 'flats': [3.0, 4.0], 'arcs': [5.0], 'science': [7.0, 1.0]}
+    assert simulate(ORDER, GRAPH, durations, 1) == pytest.approx(30.0)
+
+
+def test_stage_waits_for_its_dependencies():
+    durations = {'biases': [10.0], 'flats': [3.0, 4.0], 'arcs': [5.0], 'science': [7.0, 1.0]}
+    #flats in parallel (4), then arcs (5), then science in parallel (7)
+    assert simulate(ORDER, GRAPH, durations, 4) == pytest.approx(26.0)
+
+
+def test_longest_jobs_are_placed_first():
+    graph = {'science': set()}
+    #longest first on two workers: 6 | 5, then 4 on the second, 3 on the first
+    assert simulate(['science'], graph, {'science': [3.0, 4.0, 5.0, 6.0]}, 2) == \
+        pytest.approx(9.0)
+
+
+def test_independent_stages_share_the_pool():
+    graph = {'biases': set(), 'standard': set()}
+    durations = {'biases': [4.0], 'standard': [4.0]}
+    assert simulate(['biases', 'standard'], graph, durations, 2) == pytest.approx(4.0)
+    assert simulate(['biases', 'standard'], graph, durations, 1) == pytest.approx(8.0)
+
+
+def test_up_to_date_stages_take_no_time():
+    assert simulate(ORDER, GRAPH, {}, 3) == 0.0
+    assert simulate([], {}, {}, 0) == 0.0
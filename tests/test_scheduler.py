@@ -0,0 +1,34 @@
+#Failure paths of the scheduler with stub Reduce runners: a failed job on
+#the pool and in this process.
+
+import os
+
+import pytest
+
+from scheduler import Scheduler
+from stubs import FakeRunner, fake_worker, stages
+
+
+def test_failed_job_inline_stops_the_run(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    runner = FakeRunner(fail=['b.fits'])
+    sched = Scheduler(stages(['a.fits', 'b.fits', 'c.fits']), None)
+    sched.runner = runner
+    with pytest.raises(RuntimeError, match='b.fits'):
+        sched.run()
+    #nothing after the failed job runs, the arcs least of all
+    assert runner.calls == ['flats_0000_a', 'flats_0001_b']
+    assert 'arcs' not in sched.outputs
+
+
+def test_failed_job_on_pool_skips_dependent_stages(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sched = Scheduler(stages(['a.fits', 'bad.fits']), None, njobs=2)
+    sched.worker = fake_worker
+    with pytest.raises(RuntimeError) as err:
+        sched.run()
+    assert 'stages failed: flats' in str(err.value)
+    assert 'not run: arcs' in str(err.value)
+    #the job that succeeded is still merged
+    assert os.path.exists(tmp_path / 'a_flat.fits')
+    assert not os.path.exists(tmp_path / 'arc_flat.fits')
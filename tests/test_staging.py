@@ -0,0 +1,41 @@
+#Least recently used eviction of the scratch stager.
+
+import os
+
+from staging import Stager
+
+
+def write(path, text, size=100):
+    with open(path, 'w') as fh:
+        fh.write(text.ljust(size))
+    return str(path)
+
+
+def test_stager_evicts_least_recently_used(tmp_path):
+    a, b, c = (write(tmp_path / f'{name}.fits', name) for name in 'abc')
+    stager = Stager(tmp_path / 'scratch', capacity=250)
+    for files in ([a], [b], [a]):
+        local = stager.acquire(files)
+        stager.release(files)
+    stager.acquire([c])
+    stager.close()
+
+    #b was used least recently
+    assert stager.stats['evicted'] == 1
+    assert not os.path.exists(stager._local_name(b))
+    assert os.path.exists(local[0])
+    assert stager.stats['hits'] == 1
+
+
+def test_stager_keeps_copies_in_use(tmp_path):
+    a, b, c = (write(tmp_path / f'{name}.fits', name) for name in 'abc')
+    stager = Stager(tmp_path / 'scratch', capacity=250)
+    pinned = stager.acquire([a])
+    stager.acquire([b])
+    stager.release([b])
+    stager.acquire([c])
+    stager.close()
+
+    #a is older but still being read
+    assert os.path.exists(pinned[0])
+    assert not os.path.exists(stager._local_name(b))
@@ -0,0 +1,79 @@
+#Rebuilding the state of a run from its telemetry events.
+
+import json
+
+import pytest
+
+from telemetry import Progress, Telemetry, nfiles
+
+
+def events(run='r1'):
+    yield {'t': 0.0, 'event': 'run_start', 'run': run,
+           'stages': {'flats': {'jobs': 4, 'files': 4}, 'arcs': {'jobs': 1, 'files': 1}}}
+    yield {'t': 1.0, 'event': 'stage_start', 'run': run, 'stage': 'flats', 'jobs': 4,
+           'files': 4, 'reused': 1}
+    for i, wall in enumerate([10.0, 11.0]):
+        job = f'flats_000{i}'
+        yield {'t': 1.0, 'event': 'job_start', 'run': run, 'stage': 'flats', 'job': job,
+               'nfiles': 1, 'host': 'node1'}
+        yield {'t': 1.0 + wall, 'event': 'job_done', 'run': run, 'stage': 'flats',
+               'job': job, 'nfiles': 1, 'ok': True, 'wall_s': wall}
+    yield {'t': 12.0, 'event': 'job_start', 'run': run, 'stage': 'flats', 'job': 'flats_0002',
+           'nfiles': 1}
+    yield {'t': 52.0, 'event': 'job_done', 'run': run, 'stage': 'flats', 'job': 'flats_0002',
+           'nfiles': 1, 'ok': True}
+    yield {'t': 53.0, 'event': 'calibration', 'run': run, 'stage': 'arcs', 'job': 'arcs_0000',
+           'caltype': 'processed_flat', 'file': None}
+
+
+def progress(stream):
+    p = Progress()
+    for e in stream:
+        p.add(e)
+    return p
+
+
+def test_jobs_and_stages_are_counted():
+    p = progress(events())
+    assert p.stages['flats']['done'] == 3
+    assert p.running == {}
+    #the job timed from its job_start
+    assert p.finished[-1]['wall_s'] == 40.0
+    assert p.medians() == {'flats': 11.0}
+    assert [e['job'] for e in p.outliers()] == ['flats_0002']
+    assert p.calibrations == {'arcs': {'matched': 0, 'unresolved': 1}}
+
+
+def test_events_of_an_earlier_run_are_ignored():
+    p = progress(list(events('r1')) + list(events('r2'))[:2])
+    late = {'t': 60.0, 'event': 'job_done', 'run': 'r1', 'stage': 'flats',
+            'job': 'flats_0003', 'nfiles': 1, 'ok': True, 'wall_s': 5.0}
+    p.add(late)
+    assert p.run == 'r2'
+    assert p.finished == []
+
+
+def test_throughput_and_render():
+    p = progress(events())
+    #three files in the first 60 s of the run
+    assert p.throughput(60.0) == pytest.approx(3.0)
+    text = p.render(now=60.0)
+    assert text.startswith('run r1  elapsed 0:01:00  3/5 files  3.0 files/min  ETA 0:00:40')
+    assert '4/4' in text
+    assert 'arcs_0000' in text
+    p.add({'t': 61.0, 'event': 'run_done', 'run': 'r1', 'ok': False})
+    assert 'FAILED' in p.render(now=61.0).splitlines()[0]
+
+
+def test_nfiles_counts_each_input_once():
+    assert nfiles({'files': ['a.fits', 'b.fits']}) == 2
+    assert nfiles({'files': ['a_sub.fits', 'b_sub.fits'], 'nfiles': 0}) == 0
+
+
+def test_events_written_to_a_file(tmp_path):
+    telemetry = Telemetry(str(tmp_path / 'events.jsonl'), run='r1')
+    telemetry.emit('queue', pending=3)
+    telemetry.close()
+    with open(tmp_path / 'events.jsonl') as fh:
+        event = json.loads(fh.read())
+    assert (event['event'], event['run'], event['pending']) == ('queue', 'r1', 3)
@@ -0,0 +1,72 @@
+#Requeueing of jobs whose worker stopped responding, on both backends.
+
+import pytest
+
+from workqueue import open_queue
+
+
+@pytest.fixture(params=['sqlite', 'dir'])
+def queue(request, tmp_path):
+    return open_queue(f"{request.param}:{tmp_path / 'queue'}")
+
+
+def test_stale_job_goes_to_another_worker(queue):
+    jobid = queue.submit('run1', 'flats_0000_a', b'payload')
+    assert queue.claim('w1') == (jobid, b'payload', 1)
+    assert queue.requeue_stale(timeout=-1) == 1
+    assert queue.claim('w2') == (jobid, b'payload', 2)
+
+    #the first worker finishing late does not overwrite the second
+    assert not queue.complete(jobid, b'late', 'w1', 1)
+    assert queue.complete(jobid, b'result', 'w2', 2)
+    state, result, error = queue.results([jobid])[jobid]
+    assert (state, result) == ('done', b'result')
+    assert 'stopped responding' in error
+
+
+def test_heartbeat_keeps_a_job(queue):
+    jobid = queue.submit('run1', 'flats_0000_a', b'payload')
+    queue.claim('w1')
+    queue.heartbeat([jobid])
+    assert queue.requeue_stale(timeout=60) == 0
+    assert queue.status()[0]['running'] == 1
+
+
+def test_stale_job_fails_after_max_attempts(queue):
+    jobid = queue.submit('run1', 'flats_0000_a', b'payload')
+    for attempt in range(2):
+        assert queue.claim(f'w{attempt}') is not None
+        queue.requeue_stale(timeout=-1, max_attempts=2)
+    assert queue.claim('w2') is None
+    state, result, error = queue.results([jobid])[jobid]
+    assert state == 'failed'
+    assert 'stopped responding' in error
+
+
+def test_stale_worker_cannot_give_a_job_back(queue):
+    jobid = queue.submit('run1', 'flats_0000_a', b'payload')
+    queue.claim('w1')
+    queue.requeue_stale(timeout=-1)
+    queue.claim('w2')
+    queue.retry(jobid, 'crashed', worker='w1', attempt=1)
+    queue.release(jobid, 'w1', 1)
+    assert queue.status() == ({'pending': 0, 'running': 1, 'done': 0, 'failed': 0}, ['w2'])
+
+
+def test_released_job_keeps_its_attempts(queue):
+    jobid = queue.submit('run1', 'flats_0000_a', b'payload')
+    _, _, attempt = queue.claim('w1')
+    queue.release(jobid, 'w1', attempt)
+    assert queue.claim('w2') == (jobid, b'payload', 1)
+    queue.retry(jobid, 'Reduce crashed', max_attempts=1, worker='w2', attempt=1)
+    assert queue.results([jobid])[jobid] == ('failed', None, 'Reduce crashed')
+
+
+def test_cancel_drops_only_pending_jobs_of_the_run(queue):
+    queue.submit('run1', 'flats_0000_a', b'a')
+    pending = queue.submit('run1', 'flats_0001_b', b'b')
+    other = queue.submit('run2', 'flats_0000_a', b'c')
+    queue.claim('w1')
+    assert queue.cancel('run1') == [pending]
+    assert queue.status()[0] == {'pending': 1, 'running': 1, 'done': 0, 'failed': 0}
+    assert queue.claim('w2')[0] == other
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+#Worker processes that import DRAGONS once and then run many Reduce jobs.
+#
+#Importing astrodata, gemini_instruments, recipe_system and the GMOS
+#primitives takes seconds, which every freshly spawned worker used to pay
+#before its first job.  The pool now starts its workers from a forkserver
+#that has imported DRAGONS already, so a worker is a fork of a warm
+#process.  Workers stay alive for the whole run.
+#
+#To keep that cost out of every run, the same pool can live in a daemon
+#that listens on a Unix socket:
+#
+#    python warmpool.py --jobs 8 &          start the daemon
+#    python dragons_gem2025A.py --makeflats --daemon
+#    python warmpool.py --status            jobs done, workers
+#    python warmpool.py --stop
+#
+#gem_reduce then only sends jobs and merges their products.  The socket
+#and its key file are readable by the owner only; jobs are pickled, so
+#the daemon must never listen where other users can connect.
+
+import argparse
+import multiprocessing
+import os
+import secrets
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener
+
+
+#imported by the forkserver before any worker is forked
+PRELOAD = [
+    'astrodata',
+    'gemini_instruments',
+    'gempy.utils.logutils',
+    'recipe_system.reduction.coreReduce',
+    'recipe_system.mappers.primitiveMapper',
+    'geminidr.gmos.primitives_gmos_longslit',
+    'geminidr.gmos.recipes.sq.recipes_LS_SPECT',
+]
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), f'gmosls-reduce-{os.getuid()}.sock')
+
+
+def pool_context():
+    """Multiprocessing context whose workers start with DRAGONS imported.
+
+    Falls back to spawn where forkserver is not available.
+    """
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    ctx = multiprocessing.get_context('forkserver')
+    #modules that fail to import are skipped by the forkserver
+    ctx.set_forkserver_preload(PRELOAD)
+    return ctx
+
+
+def _key(address, create=False):
+    keyfile = address + '.key'
+    if create:
+        fd = os.open(keyfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(secrets.token_hex(32))
+    with open(keyfile) as fh:
+        return fh.read().strip().encode()
+
+
+def daemon_running(address=DEFAULT_SOCKET):
+    try:
+        return request(address, ('ping',))[0] == 'ok'
+    except (OSError, EOFError):
+        return False
+
+
+def request(address, message):
+    """Send one message to the daemon and wait for its reply."""
+    with Client(address, family='AF_UNIX', authkey=_key(address)) as conn:
+        conn.send(message)
+        return conn.recv()
+
+
+class DaemonExecutor:
+    """submit()/shutdown() like an executor, running the calls in the daemon.
+
+    An empty address means the default socket.
+    """
+
+    def __init__(self, address=DEFAULT_SOCKET, njobs=1):
+        address = address or DEFAULT_SOCKET
+        if not daemon_running(address):
+            raise RuntimeError(f'no reduction daemon listening on {address}, '
+                               'start one with python warmpool.py')
+        self.address = address
+        #one thread per job in flight, each waiting on its own connection
+        self._threads = ThreadPoolExecutor(max_workers=max(1, njobs),
+                                           thread_name_prefix='daemon')
+
+    def _call(self, fn, args):
+        status, value = request(self.address, ('run', fn, args))
+        if status != 'ok':
+            raise RuntimeError(f'reduction daemon: {value}')
+        return value
+
+    def submit(self, fn, *args):
+        return self._threads.submit(self._call, fn, args)
+
+    def shutdown(self, wait=True):
+        self._threads.shutdown(wait)
+
+
+class Daemon:
+    """Serve jobs from a warm process pool on a Unix socket."""
+
+    def __init__(self, address=DEFAULT_SOCKET, njobs=1):
+        self.address = address
+        self.njobs = njobs
+        self.started = time.time()
+        self.done = 0
+        self.failed = 0
+        self.running = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._executor = ProcessPoolExecutor(max_workers=njobs, mp_context=pool_context())
+
+    def status(self):
+        return {'pid': os.getpid(), 'njobs': self.njobs, 'running': self.running,
+                'done': self.done, 'failed': self.failed,
+                'uptime_s': round(time.time() - self.started)}
+
+    def _handle(self, conn):
+        with conn:
+            try:
+                message = conn.recv()
+                if message[0] == 'ping':
+                    conn.send(('ok', None))
+                elif message[0] == 'status':
+                    conn.send(('ok', self.status()))
+                elif message[0] == 'stop':
+                    conn.send(('ok', None))
+                    self._stop.set()
+                    #wake up the accept() in serve()
+                    request(self.address, ('ping',))
+                elif message[0] == 'run':
+                    fn, args = message[1], message[2]
+                    with self._lock:
+                        self.running += 1
+                    future = self._executor.submit(fn, *args)
+                    try:
+                        conn.send(('ok', future.result()))
+                        with self._lock:
+                            self.done += 1
+                    except Exception:
+                        conn.send(('error', traceback.format_exc()))
+                        with self._lock:
+                            self.failed += 1
+                    finally:
+                        with self._lock:
+                            self.running -= 1
+                else:
+                    conn.send(('error', f'unknown request {message[0]!r}'))
+            except (OSError, EOFError):
+                #the client went away
+                pass
+
+    def serve(self):
+        if os.path.exists(self.address):
+            if daemon_running(self.address):
+                raise RuntimeError(f'a daemon is already listening on {self.address}')
+            os.remove(self.address)
+        authkey = _key(self.address, create=True)
+        old = os.umask(0o177)
+        try:
+            listener = Listener(self.address, family='AF_UNIX', authkey=authkey)
+        finally:
+            os.umask(old)
+        #start the workers now rather than on the first job
+        for f in [self._executor.submit(os.getpid) for i in range(self.njobs)]:
+            f.result()
+        print(f'reduction daemon {os.getpid()} listening on {self.address} '
+              f'with {self.njobs} workers')
+        with listener:
+            while not self._stop.is_set():
+                try:
+                    conn = listener.accept()
+                except (OSError, EOFError, multiprocessing.AuthenticationError):
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        self._executor.shutdown()
+        for path in (self.address, self.address + '.key'):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Warm pool of Reduce workers serving gem_reduce --daemon')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET,
+                        help=f'default={DEFAULT_SOCKET}; Unix socket to listen on')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='default=number of CPUs; number of worker processes')
+    parser.add_argument('--status', action='store_true', help='print the status of the daemon')
+    parser.add_argument('--stop', action='store_true', help='stop the daemon')
+    args = parser.parse_args()
+
+    if args.status or args.stop:
+        if not daemon_running(args.socket):
+            print('no daemon listening on', args.socket)
+            return 1
+        print(request(args.socket, ('stop',) if args.stop else ('status',))[1] or 'stopped')
+        return 0
+    Daemon(args.socket, args.jobs).serve()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+#Quick-look reduction of frames as they land on disk.
+#
+#The data directory is polled (the standard library has no inotify and
+#polling works the same on NFS) and a file is taken once its size has not
+#changed between two polls.  Each new frame is classified once into the
+#header index and triggers only the work it unlocks:
+#
+#  BPM       registered in the calibration database
+#  BIAS      collected; when the bias sequence ends (another kind of frame
+#            lands or no bias arrives for --settle seconds) the master bias
+#            for that ROI is rebuilt from every bias seen so far
+#  FLAT/ARC  reduced one Reduce per frame, once any master bias still
+#            being built has finished
+#  STANDARD  reduced to update the sensitivity function, once the biases,
+#            flats and arcs still running have finished
+#  science   reduced against the best calibrations already in the
+#            database, after any calibration still running has finished
+#
+#Reductions run on the worker pool so polling continues while they run.
+
+import glob
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import parallel
+
+
+#the kinds of job whose products a job of each kind may use; a new job
+#waits for those still running
+UPSTREAM = {
+    'bias': (),
+    'flat': ('bias',),
+    'arc': ('bias',),
+    'std': ('bias', 'flat', 'arc'),
+    'sci': ('bias', 'flat', 'arc', 'std'),
+}
+
+
+def _banner(text):
+    print('#############################################')
+    print(text)
+    print('#############################################')
+
+
+class Watcher:
+    """Poll a glob pattern and reduce new frames as they land."""
+
+    def __init__(self, pattern, index, caldb, njobs=1, interval=2.0,
+                 settle=60.0, profiler=None, mem_budget=None, estimator=None,
+                 daemon=None):
+        self.pattern = pattern
+        self.index = index
+        self.caldb = caldb
+        self.njobs = max(1, njobs)
+        self.interval = interval
+        self.settle = settle
+        self.profiler = profiler
+        self.mem_budget = mem_budget
+        self.estimator = estimator
+        self.daemon = daemon
+        self.known = set(index.files)
+        self._sizes = {}
+        self._pending_bias = {}
+        self._last_bias = None
+        self._inflight = {kind: [] for kind in UPSTREAM}
+        self._futures = []
+        self._count = 0
+
+    def poll(self):
+        """Files matching the pattern that are new and no longer growing."""
+        landed = []
+        sizes = {}
+        for path in glob.glob(self.pattern):
+            if path in self.known:
+                continue
+            try:
+                sizes[path] = os.path.getsize(path)
+            except OSError:
+                continue
+            if self._sizes.get(path) == sizes[path]:
+                landed.append(path)
+        self._sizes = {p: s for p, s in sizes.items() if p not in landed}
+        return sorted(landed)
+
+    def _job(self, stage, files):
+        self._count += 1
+        return {
+            'name': f'{stage}_{self._count:05d}',
+            'stage': stage,
+            'files': list(files),
+            'uparms': {},
+            'recipename': None,
+        }
+
+    def _run(self, jobs, after=()):
+        #wait for the calibrations these jobs depend on, then reduce
+        wait(after)
+        try:
+            return self.pool.run(jobs)
+        except RuntimeError as err:
+            print(err)
+            return []
+
+    def submit(self, jobs):
+        """Reduce jobs of one kind after the upstream jobs still running."""
+        kind = jobs[0]['stage']
+        after = [f for k in UPSTREAM[kind] for f in self._inflight[k] if not f.done()]
+        future = self.threads.submit(self._run, jobs, after)
+        self._inflight[kind].append(future)
+        self._futures.append(future)
+        return future
+
+    def flush_biases(self):
+        """Rebuild the master bias of every ROI that received new biases."""
+        for roi in list(self._pending_bias):
+            files = self.index.select(['BIAS'], [], f'detector_roi_setting=={roi!r}')
+            print(f'bias sequence ended, master bias ({roi}) from {len(files)} frames')
+            self.submit([self._job('bias', files)])
+        self._pending_bias = {}
+        self._last_bias = None
+
+    def handle(self, record):
+        path, tags = record['path'], record['tags']
+        if 'BIAS' not in tags and self._pending_bias:
+            self.flush_biases()
+
+        if 'BPM' in tags:
+            print('new BPM', path)
+            self.caldb.add_cal(path)
+        elif 'BIAS' in tags:
+            roi = record['descriptors'].get('detector_roi_setting')
+            self._pending_bias.setdefault(roi, []).append(path)
+            self._last_bias = time.monotonic()
+        elif 'FLAT' in tags:
+            print('new flat', path)
+            self.submit([self._job('flat', [path])])
+        elif 'ARC' in tags:
+            print('new arc', path)
+            self.submit([self._job('arc', [path])])
+        elif 'STANDARD' in tags:
+            print('new standard', path)
+            self.submit([self._job('std', [path])])
+        elif 'CAL' not in tags:
+            print('new science frame', path, record['descriptors'].get('object'))
+            self.submit([self._job('sci', [path])])
+        else:
+            print('ignoring', path, sorted(tags))
+
+    def step(self):
+        """One poll: classify the frames that landed and trigger their work."""
+        landed = self.poll()
+        if landed:
+            for record in self.index.add(landed):
+                self.known.add(record['path'])
+                self.handle(record)
+        elif (self._last_bias is not None
+              and time.monotonic() - self._last_bias > self.settle):
+            self.flush_biases()
+        self._futures = [f for f in self._futures if not f.done()]
+        self._inflight = {k: [f for f in fs if not f.done()]
+                          for k, fs in self._inflight.items()}
+        return landed
+
+    def run(self):
+        """Poll until interrupted with Ctrl-C, then finish running jobs."""
+        _banner(f'watching {self.pattern} every {self.interval} s, Ctrl-C to stop')
+        start = time.perf_counter()
+        with parallel.JobPool(self.caldb, self.njobs, profiler=self.profiler,
+                              mem_budget=self.mem_budget,
+                              estimator=self.estimator,
+                              daemon=self.daemon) as self.pool, \
+                ThreadPoolExecutor(max_workers=4 * self.njobs) as self.threads:
+            try:
+                while True:
+                    self.step()
+                    time.sleep(self.interval)
+            except KeyboardInterrupt:
+                print('stopping, waiting for running reductions')
+            if self._pending_bias:
+                self.flush_biases()
+            wait(self._futures)
+
+        if self.profiler is not None:
+            for stage in ('bias', 'flat', 'arc', 'std', 'sci'):
+                jobs = self.profiler.jobs(stage)
+                if jobs:
+                    self.profiler.add_stage(stage, time.perf_counter() - start, jobs)
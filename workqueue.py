@@ -0,0 +1,518 @@
+#!/usr/bin/env python
+
+#Run Reduce jobs on workers on other hosts through a shared work queue.
+#
+#With --queue, gem_reduce publishes the Reduce jobs of every stage to a
+#queue on a filesystem all hosts can see, and workers on any number of
+#hosts take them from it:
+#
+#    python workqueue.py worker /shared/gmosls.db --jobs 8   on each host
+#    python dragons_gem2025A.py --makeflats --queue /shared/gmosls.db
+#    python workqueue.py status /shared/gmosls.db
+#
+#A job is only published once the stages it needs have finished and their
+#calibrations are in the database, exactly as with the local pool, so the
+#dependencies between stages are kept by gem_reduce and the queue itself
+#holds only jobs that can run.  A worker runs parallel.run_job: inputs,
+#the working directory (reduce_work/ next to the data) and the calibration
+#database must be on the shared filesystem.  The products are merged back
+#by gem_reduce, which is still the only writer of the database.
+#
+#Workers send a heartbeat for the jobs they run.  A job whose worker died
+#or lost the filesystem is given to another worker after HEARTBEAT_TIMEOUT,
+#up to MAX_ATTEMPTS times.  Every attempt runs in its own working directory,
+#and if the first worker finishes after all, its result is dropped.  A
+#Reduce that fails is not retried; its log is reported like on the local
+#pool.
+#
+#Two backends: an SQLite database (a path ending in .db, or sqlite:PATH)
+#and a directory in which jobs are claimed by renaming their file
+#(anything else, or dir:PATH) for filesystems where SQLite locking is not
+#reliable.  Jobs are pickled, so the queue must only be writable by you.
+
+import argparse
+import os
+import pickle
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from warmpool import pool_context
+
+
+HEARTBEAT = 15.0
+HEARTBEAT_TIMEOUT = 120.0
+MAX_ATTEMPTS = 3
+POLL = 1.0
+
+STATES = ('pending', 'running', 'done', 'failed')
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class SQLiteQueue:
+    """Work queue in an SQLite database on the shared filesystem."""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        old = os.umask(0o077)
+        try:
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None,
+                                         check_same_thread=False)
+        finally:
+            os.umask(old)
+        self._lock = threading.Lock()
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id TEXT PRIMARY KEY, run TEXT, name TEXT, state TEXT, '
+            'attempts INTEGER, worker TEXT, heartbeat REAL, submitted REAL, '
+            'payload BLOB, result BLOB, error TEXT)')
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    def submit(self, run, name, payload):
+        jobid = uuid.uuid4().hex
+        self._execute('INSERT INTO jobs VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+                      (jobid, run, name, 'pending', 0, None, None, time.time(),
+                       payload, None, None))
+        return jobid
+
+    def claim(self, worker):
+        """(id, payload, attempt) of the oldest pending job, now running,
+        or None.  The worker and attempt identify the claim in complete()."""
+        with self._lock:
+            #BEGIN IMMEDIATE takes the write lock, so one worker gets the job
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute(
+                    "SELECT id, payload, attempts FROM jobs WHERE state='pending' "
+                    'ORDER BY submitted LIMIT 1').fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET state='running', worker=?, heartbeat=?, "
+                        'attempts=attempts+1 WHERE id=?', (worker, time.time(), row[0]))
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        if row is None:
+            return None
+        return row[0], row[1], row[2] + 1
+
+    def heartbeat(self, ids):
+        for jobid in ids:
+            self._execute("UPDATE jobs SET heartbeat=? WHERE id=? AND state='running'",
+                          (time.time(), jobid))
+
+    def _update(self, sql, args):
+        with self._lock:
+            return self._conn.execute(sql, args).rowcount
+
+    def complete(self, jobid, result, worker, attempt):
+        """Store the result of the claim (worker, attempt) of a job.  Returns
+        False, dropping the result, if the job was taken back as stale and
+        is no longer that claim's."""
+        return self._update(
+            "UPDATE jobs SET state='done', result=? WHERE id=? AND state='running' "
+            'AND worker=? AND attempts=?', (result, jobid, worker, attempt)) > 0
+
+    def retry(self, jobid, error, max_attempts=MAX_ATTEMPTS, worker=None, attempt=None):
+        """Put a job whose worker failed back, or fail it for good.  With
+        worker and attempt, only while it is still that claim's."""
+        sql = ("UPDATE jobs SET state=CASE WHEN attempts<? THEN 'pending' ELSE 'failed' END, "
+               "worker=NULL, error=? WHERE id=? AND state='running'")
+        args = (max_attempts, error, jobid)
+        if worker is not None:
+            sql += ' AND worker=? AND attempts=?'
+            args += (worker, attempt)
+        self._update(sql, args)
+
+    def release(self, jobid, worker, attempt):
+        """Give a job back without counting the attempt."""
+        self._update("UPDATE jobs SET state='pending', worker=NULL, attempts=attempts-1 "
+                     "WHERE id=? AND state='running' AND worker=? AND attempts=?",
+                     (jobid, worker, attempt))
+
+    def requeue_stale(self, timeout=HEARTBEAT_TIMEOUT, max_attempts=MAX_ATTEMPTS):
+        rows = self._execute("SELECT id, worker FROM jobs WHERE state='running' "
+                             'AND heartbeat<?', (time.time() - timeout,))
+        for jobid, worker in rows:
+            self.retry(jobid, f'worker {worker} stopped responding', max_attempts)
+        return len(rows)
+
+    def results(self, ids):
+        """{id: (state, result, error)} of the finished jobs among ids."""
+        finished = {}
+        for jobid in ids:
+            for state, result, error in self._execute(
+                    'SELECT state, result, error FROM jobs WHERE id=?', (jobid,)):
+                if state in ('done', 'failed'):
+                    finished[jobid] = (state, result, error)
+        return finished
+
+    def remove(self, ids):
+        for jobid in ids:
+            self._execute('DELETE FROM jobs WHERE id=?', (jobid,))
+
+    def cancel(self, run):
+        """Drop the pending jobs of a run.  Returns their ids."""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            ids = [r[0] for r in self._conn.execute(
+                "SELECT id FROM jobs WHERE run=? AND state='pending'", (run,))]
+            self._conn.execute("DELETE FROM jobs WHERE run=? AND state='pending'", (run,))
+            self._conn.execute('COMMIT')
+        return ids
+
+    def status(self):
+        """Number of jobs in each state and the workers running them."""
+        counts = dict(self._execute('SELECT state, COUNT(*) FROM jobs GROUP BY state'))
+        workers = [w for (w,) in self._execute(
+            "SELECT DISTINCT worker FROM jobs WHERE state='running'")]
+        return {state: counts.get(state, 0) for state in STATES}, workers
+
+
+class DirectoryQueue:
+    """Work queue of files in a directory on the shared filesystem.
+
+    A job is a file <id> in one of the state directories; it is claimed by
+    renaming it from pending/ to running/, which only one worker can do,
+    and its heartbeat is the modification time of the running file.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        for state in STATES:
+            os.makedirs(os.path.join(self.path, state), mode=0o700, exist_ok=True)
+
+    def _file(self, state, jobid):
+        return os.path.join(self.path, state, jobid)
+
+    def _read(self, path):
+        with open(path, 'rb') as fh:
+            return pickle.load(fh)
+
+    def _write(self, state, jobid, entry):
+        tmp = self._file(state, '.' + jobid + '.tmp')
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as fh:
+            pickle.dump(entry, fh)
+        os.replace(tmp, self._file(state, jobid))
+
+    def _ids(self, state):
+        return sorted(f for f in os.listdir(os.path.join(self.path, state))
+                      if not f.startswith('.'))
+
+    def submit(self, run, name, payload):
+        #ids sort in the order of submission
+        jobid = f'{time.time():017.6f}-{run}-{uuid.uuid4().hex[:8]}'
+        self._write('pending', jobid, {'name': name, 'attempts': 0,
+                                       'payload': payload, 'error': None})
+        return jobid
+
+    def claim(self, worker):
+        for jobid in self._ids('pending'):
+            try:
+                os.rename(self._file('pending', jobid), self._file('running', jobid))
+            except FileNotFoundError:
+                #another worker got there first
+                continue
+            os.utime(self._file('running', jobid))
+            entry = self._read(self._file('running', jobid))
+            entry['attempts'] += 1
+            entry['worker'] = worker
+            self._write('running', jobid, entry)
+            return jobid, entry['payload'], entry['attempts']
+        return None
+
+    def heartbeat(self, ids):
+        for jobid in ids:
+            try:
+                os.utime(self._file('running', jobid))
+            except FileNotFoundError:
+                pass
+
+    def _take(self, jobid, owner):
+        #take the file out of running/ first so only one caller moves it,
+        #and put it back if it is no longer the claim owner = (worker, attempt)
+        taken = self._file('running', '.' + jobid + '.taken')
+        try:
+            os.rename(self._file('running', jobid), taken)
+        except FileNotFoundError:
+            return None, None
+        entry = self._read(taken)
+        if owner is not None and (entry.get('worker'), entry['attempts']) != owner:
+            os.rename(taken, self._file('running', jobid))
+            return None, None
+        return taken, entry
+
+    def complete(self, jobid, result, worker, attempt):
+        taken, entry = self._take(jobid, (worker, attempt))
+        if taken is None:
+            #taken back as stale, another worker runs it again
+            return False
+        entry['result'] = result
+        self._write('done', jobid, entry)
+        os.remove(taken)
+        return True
+
+    def _move_back(self, jobid, error, max_attempts, owner=None, count=True):
+        taken, entry = self._take(jobid, owner)
+        if taken is None:
+            return
+        if not count:
+            entry['attempts'] -= 1
+        entry['error'] = error or entry['error']
+        state = 'pending' if entry['attempts'] < max_attempts else 'failed'
+        self._write(state, jobid, entry)
+        os.remove(taken)
+
+    def retry(self, jobid, error, max_attempts=MAX_ATTEMPTS, worker=None, attempt=None):
+        owner = None if worker is None else (worker, attempt)
+        self._move_back(jobid, error, max_attempts, owner)
+
+    def release(self, jobid, worker, attempt):
+        self._move_back(jobid, None, MAX_ATTEMPTS, (worker, attempt), count=False)
+
+    def requeue_stale(self, timeout=HEARTBEAT_TIMEOUT, max_attempts=MAX_ATTEMPTS):
+        n = 0
+        for jobid in self._ids('running'):
+            try:
+                stale = os.path.getmtime(self._file('running', jobid)) < time.time() - timeout
+            except FileNotFoundError:
+                continue
+            if stale:
+                self.retry(jobid, 'worker stopped responding', max_attempts)
+                n += 1
+        return n
+
+    def results(self, ids):
+        finished = {}
+        for jobid in ids:
+            for state in ('done', 'failed'):
+                path = self._file(state, jobid)
+                if os.path.exists(path):
+                    entry = self._read(path)
+                    finished[jobid] = (state, entry.get('result'), entry['error'])
+        return finished
+
+    def remove(self, ids):
+        for jobid in ids:
+            for state in ('done', 'failed'):
+                if os.path.exists(self._file(state, jobid)):
+                    os.remove(self._file(state, jobid))
+
+    def cancel(self, run):
+        ids = []
+        for jobid in self._ids('pending'):
+            if f'-{run}-' in jobid:
+                try:
+                    os.remove(self._file('pending', jobid))
+                    ids.append(jobid)
+                except FileNotFoundError:
+                    pass
+        return ids
+
+    def status(self):
+        counts = {state: len(self._ids(state)) for state in STATES}
+        workers = set()
+        for jobid in self._ids('running'):
+            try:
+                workers.add(self._read(self._file('running', jobid)).get('worker'))
+            except (FileNotFoundError, EOFError):
+                pass
+        return counts, sorted(w for w in workers if w)
+
+
+BACKENDS = {'sqlite': SQLiteQueue, 'dir': DirectoryQueue}
+
+
+def open_queue(spec):
+    """The queue at spec: sqlite:PATH, dir:PATH, or a path (.db is SQLite)."""
+    kind, sep, path = spec.partition(':')
+    if sep and kind in BACKENDS:
+        return BACKENDS[kind](path)
+    return (SQLiteQueue if spec.endswith('.db') else DirectoryQueue)(spec)
+
+
+class QueueExecutor:
+    """submit()/shutdown() like an executor, publishing the calls to a queue.
+
+    The calls are pickled, so fn must be importable by the workers.
+    """
+
+    def __init__(self, spec, poll=POLL):
+        self.queue = open_queue(spec)
+        self.run = uuid.uuid4().hex[:12]
+        self.poll = poll
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._collect, daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args):
+        future = Future()
+        name = args[0].get('name') if args and isinstance(args[0], dict) else fn.__name__
+        jobid = self.queue.submit(self.run, name, pickle.dumps((fn, args)))
+        with self._lock:
+            self._futures[jobid] = future
+        return future
+
+    def _collect(self):
+        while not self._stop.wait(self.poll):
+            with self._lock:
+                ids = list(self._futures)
+            if not ids:
+                continue
+            try:
+                #in case every worker holding a job is gone
+                self.queue.requeue_stale()
+                finished = self.queue.results(ids)
+            except Exception as err:
+                print(f'work queue: {err}')
+                continue
+            for jobid, (state, result, error) in finished.items():
+                with self._lock:
+                    future = self._futures.pop(jobid)
+                if state == 'done':
+                    future.set_result(pickle.loads(result))
+                else:
+                    future.set_exception(RuntimeError(
+                        f'failed on {MAX_ATTEMPTS} workers: {error}'))
+            self.queue.remove(list(finished))
+
+    def shutdown(self, wait=True):
+        #jobs nobody took yet are not left behind for the workers
+        for jobid in self.queue.cancel(self.run):
+            with self._lock:
+                future = self._futures.pop(jobid, None)
+            if future is not None:
+                future.cancel()
+        while wait:
+            with self._lock:
+                if not self._futures:
+                    break
+            time.sleep(self.poll)
+        self._stop.set()
+        self._thread.join()
+
+
+def _call(payload):
+    fn, args = pickle.loads(payload)
+    return pickle.dumps(fn(*args))
+
+
+class Worker:
+    """Take jobs from a queue and run them on a warm process pool."""
+
+    def __init__(self, spec, njobs=1, idle_exit=None):
+        self.queue = open_queue(spec)
+        self.njobs = njobs
+        self.idle_exit = idle_exit
+        self.name = worker_name()
+        self.done = 0
+        self.failed = 0
+        #id of the jobs running here to the attempt
+        self._running = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._idle_since = time.time()
+        self._executor = ProcessPoolExecutor(max_workers=njobs, mp_context=pool_context())
+
+    def _heartbeat(self):
+        while not self._stop.wait(HEARTBEAT):
+            with self._lock:
+                ids = list(self._running)
+            self.queue.heartbeat(ids)
+
+    def _slot(self):
+        #one thread per worker process, each running one job at a time
+        while not self._stop.is_set():
+            claimed = self.queue.claim(self.name)
+            if claimed is None:
+                if self.idle_exit is not None and time.time() - self._idle_since > self.idle_exit:
+                    self._stop.set()
+                self._stop.wait(POLL)
+                continue
+            jobid, payload, attempt = claimed
+            with self._lock:
+                self._running[jobid] = attempt
+            executor = self._executor
+            try:
+                result = executor.submit(_call, payload).result()
+                if self.queue.complete(jobid, result, self.name, attempt):
+                    self.done += 1
+                else:
+                    print(f'dropped the result of {jobid}: it was given to another worker')
+            except BrokenProcessPool:
+                self.queue.retry(jobid, f'worker process on {self.name} died',
+                                 worker=self.name, attempt=attempt)
+                self.failed += 1
+                with self._lock:
+                    if self._executor is executor:
+                        self._executor = ProcessPoolExecutor(max_workers=self.njobs,
+                                                             mp_context=pool_context())
+            except Exception:
+                self.queue.retry(jobid, traceback.format_exc(),
+                                 worker=self.name, attempt=attempt)
+                self.failed += 1
+            finally:
+                with self._lock:
+                    self._running.pop(jobid, None)
+                self._idle_since = time.time()
+
+    def serve(self):
+        print(f'worker {self.name} taking jobs from {self.queue.path} '
+              f'with {self.njobs} processes')
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+        slots = [threading.Thread(target=self._slot, daemon=True)
+                 for i in range(self.njobs)]
+        for t in slots:
+            t.start()
+        try:
+            while any(t.is_alive() for t in slots):
+                time.sleep(POLL)
+        except KeyboardInterrupt:
+            print('stopping, giving the running jobs back to the queue')
+            self._stop.set()
+            with self._lock:
+                for jobid, attempt in self._running.items():
+                    self.queue.release(jobid, self.name, attempt)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        print(f'worker {self.name}: {self.done} jobs done, {self.failed} failed')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Shared work queue for gem_reduce --queue')
+    parser.add_argument('command', choices=('worker', 'status'))
+    parser.add_argument('queue', help='sqlite:PATH, dir:PATH, or a path (.db is SQLite)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='default=number of CPUs; number of jobs to run at once')
+    parser.add_argument('--idle-exit', type=float, default=None,
+                        help='default=None; stop after this many seconds without a job')
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        counts, workers = open_queue(args.queue).status()
+        print(', '.join(f'{n} {state}' for state, n in counts.items()))
+        for w in workers:
+            print('  running on', w)
+        return 0
+    Worker(args.queue, args.jobs, args.idle_exit).serve()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())